@@ -0,0 +1,154 @@
+"""
+Compare the query plans and latency of the ways to select the roles having a
+right on an application.
+
+- legacy: outer joins on cor_roles with an OR on the role or its group
+  (implementation before the closure table)
+- join: joins on the group closure table
+- in: `User.filter_by_app`, IN semi-join on the closure table
+- exists: `has_app_right`, correlated EXISTS semi-join
+
+The data (one application, groups and users) is created in a transaction
+which is rolled back at the end, on a database with the `utilisateurs`
+schema up to date.
+
+Usage: python benchmarks/bench_filter_by_app.py postgresql://... [--users N]
+"""
+
+import argparse
+import time
+
+import sqlalchemy as sa
+from flask import Flask
+
+from pypnusershub.db.models import (
+    Application,
+    User,
+    UserApplicationRight,
+    cor_roles,
+    cor_roles_closure,
+)
+from pypnusershub.db.rights import has_app_right, resolve_application
+from pypnusershub.env import db
+
+CODE_APPLICATION = "BENCH_FILTER_BY_APP"
+
+
+def populate(users, groups):
+    db.session.execute(
+        sa.text("""
+            INSERT INTO utilisateurs.t_applications (code_application, nom_application)
+            VALUES (:code, 'benchmark');
+
+            INSERT INTO utilisateurs.t_roles (groupe, identifiant, active)
+            SELECT true, 'bench_group_' || i, true FROM generate_series(1, :groups) i;
+
+            INSERT INTO utilisateurs.t_roles (groupe, identifiant, active)
+            SELECT false, 'bench_user_' || i, true FROM generate_series(1, :users) i;
+
+            INSERT INTO utilisateurs.cor_roles (id_role_groupe, id_role_utilisateur)
+            SELECT g.id_role, u.id_role
+            FROM utilisateurs.t_roles u
+            JOIN utilisateurs.t_roles g
+              ON g.identifiant = 'bench_group_' || (substr(u.identifiant, 12)::int % :groups + 1)
+            WHERE u.identifiant LIKE 'bench_user_%';
+
+            -- half of the groups and one user out of ten get a right
+            INSERT INTO utilisateurs.cor_role_app_profil (id_role, id_application, id_profil)
+            SELECT r.id_role, a.id_application, (SELECT min(id_profil) FROM utilisateurs.t_profils)
+            FROM utilisateurs.t_roles r, utilisateurs.t_applications a
+            WHERE a.code_application = :code
+            AND (
+                (r.identifiant LIKE 'bench_group_%' AND substr(r.identifiant, 13)::int % 2 = 0)
+                OR (r.identifiant LIKE 'bench_user_%' AND substr(r.identifiant, 12)::int % 10 = 0)
+            );
+            ANALYZE utilisateurs.t_roles;
+            ANALYZE utilisateurs.cor_roles;
+            ANALYZE utilisateurs.cor_roles_closure;
+            ANALYZE utilisateurs.cor_role_app_profil;
+            """),
+        {"code": CODE_APPLICATION, "users": users, "groups": groups},
+    )
+
+
+def statements():
+    legacy = (
+        sa.select(User.id_role)
+        .outerjoin(cor_roles, User.id_role == cor_roles.c.id_role_utilisateur)
+        .outerjoin(
+            UserApplicationRight,
+            sa.or_(
+                UserApplicationRight.id_role == cor_roles.c.id_role_groupe,
+                UserApplicationRight.id_role == User.id_role,
+            ),
+        )
+        .join(
+            Application,
+            Application.id_application == UserApplicationRight.id_application,
+        )
+        .where(Application.code_application == CODE_APPLICATION)
+    )
+    join = (
+        sa.select(User.id_role)
+        .join(cor_roles_closure, User.id_role == cor_roles_closure.c.id_role_descendant)
+        .join(
+            UserApplicationRight,
+            UserApplicationRight.id_role == cor_roles_closure.c.id_role_ancestor,
+        )
+        .join(
+            Application,
+            Application.id_application == UserApplicationRight.id_application,
+        )
+        .where(Application.code_application == CODE_APPLICATION)
+    )
+    return {
+        "legacy": legacy,
+        "join": join,
+        "in": sa.select(User.id_role).where(User.filter_by_app(CODE_APPLICATION)),
+        "exists": sa.select(User.id_role).where(
+            has_app_right(resolve_application(CODE_APPLICATION))
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("database_uri")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--plans", action="store_true", help="print query plans")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_uri
+    app.config["CODE_APPLICATION"] = CODE_APPLICATION
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            populate(args.users, args.groups)
+            for name, statement in statements().items():
+                rows = db.session.execute(statement).all()
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    db.session.execute(statement).all()
+                duration = (time.perf_counter() - start) / args.repeat
+                print(
+                    f"{name:>8}: {duration * 1000:8.2f} ms, {len(rows)} rows "
+                    f"({len(set(rows))} distinct)"
+                )
+                if args.plans:
+                    compiled = statement.compile(
+                        db.engine, compile_kwargs={"literal_binds": True}
+                    )
+                    plan = db.session.execute(
+                        sa.text(f"EXPLAIN (ANALYZE, BUFFERS) {compiled}")
+                    ).scalars()
+                    print("\n".join(plan), end="\n\n")
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Load test of the token introspection service
+(`python -m pypnusershub serve-introspect`).
+
+Tokens are signed with the given secret key for the given roles, then
+concurrent clients introspect them for a duration; throughput and latency
+percentiles are printed.
+
+Usage:
+    python benchmarks/bench_introspect.py --secret-key KEY --url http://127.0.0.1:5100
+    python benchmarks/bench_introspect.py --secret-key KEY --socket /run/introspect.sock
+"""
+
+import argparse
+import http.client
+import json
+import socket
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+from authlib.jose import JsonWebToken
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def make_tokens(secret_key, id_roles):
+    jwt = JsonWebToken(["HS256"])
+    exp = int(time.time()) + 3600
+    return [
+        jwt.encode(
+            {"alg": "HS256"},
+            {"id_role": id_role, "identifiant": f"role_{id_role}", "exp": exp},
+            secret_key.encode("UTF-8"),
+        ).decode()
+        for id_role in id_roles
+    ]
+
+
+def worker(args, tokens, deadline, latencies, errors):
+    if args.socket:
+        connection = UnixHTTPConnection(args.socket)
+    else:
+        connection = http.client.HTTPConnection(urlsplit(args.url).netloc)
+    body = {"applications": [code for code in args.applications.split(",") if code]}
+    i = 0
+    while time.perf_counter() < deadline:
+        if args.batch > 1:
+            body["tokens"] = [tokens[(i + j) % len(tokens)] for j in range(args.batch)]
+        else:
+            body["token"] = tokens[i % len(tokens)]
+        i += args.batch
+        start = time.perf_counter()
+        connection.request(
+            "POST",
+            "/introspect",
+            json.dumps(body),
+            {"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors.append(response.status)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--secret-key", required=True)
+    parser.add_argument("--url", default="http://127.0.0.1:5100")
+    parser.add_argument("--socket", help="path of the Unix socket of the service")
+    parser.add_argument("--applications", default="GN")
+    parser.add_argument("--roles", default="1", help="first-last id_role")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--batch", type=int, default=1, help="tokens per request")
+    parser.add_argument("--duration", type=float, default=10, help="in seconds")
+    args = parser.parse_args()
+
+    first, _, last = args.roles.partition("-")
+    tokens = make_tokens(args.secret_key, range(int(first), int(last or first) + 1))
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(
+            target=worker, args=(args, tokens, deadline, latencies, errors)
+        )
+        for _ in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{len(latencies)} requests ({len(latencies) * args.batch} tokens), "
+        f"{len(errors)} errors, {len(latencies) / args.duration:.0f} req/s"
+    )
+    print(
+        f"latency p50 {quantiles[49] * 1000:.2f} ms, p95 {quantiles[94] * 1000:.2f} ms, "
+        f"p99 {quantiles[98] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Compare `max_levels` with the `User.max_level_profil` property called for
+each user.
+
+The data is created as in bench_filter_by_app.py, in a transaction which is
+rolled back at the end.
+
+Usage: python benchmarks/bench_max_levels.py postgresql://... [--roles N]
+"""
+
+import argparse
+import time
+
+import sqlalchemy as sa
+from flask import Flask
+
+from bench_filter_by_app import CODE_APPLICATION, populate
+from pypnusershub.db.models import User
+from pypnusershub.db.rights import get_rights_cache, max_levels, resolve_application
+from pypnusershub.env import db
+
+
+def timed(label, function):
+    start = time.perf_counter()
+    result = function()
+    print(f"{label:>24}: {(time.perf_counter() - start) * 1000:9.2f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("database_uri")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--roles", type=int, default=500, help="roles checked")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_uri
+    app.config["CODE_APPLICATION"] = CODE_APPLICATION
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            populate(args.users, args.groups)
+            id_application = resolve_application()
+            users = db.session.scalars(
+                sa.select(User)
+                .where(User.identifiant.like("bench_user_%"))
+                .limit(args.roles)
+            ).all()
+            id_roles = [user.id_role for user in users]
+
+            per_user = timed(
+                "User.max_level_profil",
+                lambda: {user.id_role: user.max_level_profil for user in users},
+            )
+            bulk = timed("max_levels", lambda: max_levels(id_roles, id_application))
+            assert per_user == bulk
+
+            app.config["RIGHTS_CACHE_TTL"] = 60
+            timed(
+                "max_levels (cache miss)", lambda: max_levels(id_roles, id_application)
+            )
+            timed(
+                "max_levels (cache hit)", lambda: max_levels(id_roles, id_application)
+            )
+            get_rights_cache().clear()
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
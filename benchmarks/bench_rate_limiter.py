@@ -0,0 +1,50 @@
+"""
+Overhead of the rate limiter per request.
+
+Usage: python benchmarks/bench_rate_limiter.py [--iterations N] [--keys N]
+"""
+
+import argparse
+import timeit
+
+from flask import Flask
+
+from pypnusershub.auth.rate_limit import MemoryBackend, rate_limiter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--keys", type=int, default=10000)
+    args = parser.parse_args()
+
+    backend = MemoryBackend()
+    keys = [f"login:ip:10.0.{i // 256}.{i % 256}" for i in range(args.keys)]
+    counter = iter(range(10**12))
+
+    def hit():
+        backend.hit(keys[next(counter) % args.keys], 30, 60)
+
+    duration = timeit.timeit(hit, number=args.iterations)
+    print(f"MemoryBackend.hit: {duration / args.iterations * 1e6:.2f} µs/call")
+
+    app = Flask(__name__)
+    app.config.update(RATE_LIMIT_IP=10**9, RATE_LIMIT_IDENTIFIANT=10**9)
+    rate_limiter.init_app(app)
+    for enabled in (False, True):
+        app.config["RATE_LIMIT_ENABLED"] = enabled
+        with app.test_request_context(
+            "/auth/login/local_provider", environ_base={"REMOTE_ADDR": "10.0.0.1"}
+        ):
+            duration = timeit.timeit(
+                lambda: rate_limiter.check("login", identifiant="admin"),
+                number=args.iterations,
+            )
+        print(
+            f"RateLimiter.check (enabled={enabled}): "
+            f"{duration / args.iterations * 1e6:.2f} µs/call"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Measure the latency of the search of roles by name, with the trigram and
+prefix indexes of the database and with the in-memory prefix index.
+
+The roles are created in a transaction which is rolled back at the end, on
+a database with the `utilisateurs` schema up to date.
+
+Usage: python benchmarks/bench_search_roles.py postgresql://... [--roles N]
+"""
+
+import argparse
+import time
+
+import sqlalchemy as sa
+from flask import Flask
+
+from pypnusershub.db.listing import PrefixIndex, search_roles
+from pypnusershub.env import db
+
+TEXTS = ("du", "dup", "martin", "heléne", "dupomt", "zzzz")
+
+
+def populate(roles):
+    # names built from a few syllables, so that searches match many roles
+    db.session.execute(
+        sa.text("""
+            INSERT INTO utilisateurs.t_roles (groupe, identifiant, nom_role, prenom_role, active)
+            SELECT false, 'bench_search_' || i,
+                initcap((ARRAY['du', 'mar', 'ber', 'lé', 'pon', 'tin'])[i % 6 + 1]
+                    || (ARRAY['pont', 'tin', 'nard', 'roux', 'fèvre'])[i % 5 + 1]
+                    || (i % 97)::text),
+                (ARRAY['Hélène', 'Pierre', 'Anne', 'Éloïse', 'Jean'])[i % 5 + 1],
+                true
+            FROM generate_series(1, :roles) i;
+            ANALYZE utilisateurs.t_roles;
+            """),
+        {"roles": roles},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("database_uri")
+    parser.add_argument("--roles", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = args.database_uri
+    db.init_app(app)
+
+    with app.app_context():
+        try:
+            populate(args.roles)
+            start = time.perf_counter()
+            PrefixIndex.load()
+            print(
+                f"prefix index built in {(time.perf_counter() - start) * 1000:.0f} ms"
+            )
+            for prefix_index in (False, True):
+                app.config["ROLES_SEARCH_PREFIX_INDEX"] = prefix_index
+                print("in-memory prefix index" if prefix_index else "database indexes")
+                for text in TEXTS:
+                    roles = search_roles(text)
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        search_roles(text)
+                    duration = (time.perf_counter() - start) / args.repeat
+                    print(f"{text:>10}: {duration * 1000:8.2f} ms, {len(roles)} roles")
+        finally:
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Throughput of signing and verifying tokens, per algorithm: HS256 with a
+secret key, and RS256, ES256 and EdDSA with the key ring.
+
+Usage: python benchmarks/bench_token_signing.py [--iterations N] [--rsa-bits N]
+"""
+
+import argparse
+import time
+import timeit
+
+from authlib.jose import JsonWebToken
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+from pypnusershub.keys import KeyRing
+
+PAYLOAD = {
+    "id_role": 1,
+    "identifiant": "admin",
+    "nom_role": "Administrateur",
+    "prenom_role": "test",
+    "id_organisme": 0,
+    "id_application": 1,
+}
+
+
+def private_pem(key):
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--rsa-bits", type=int, default=2048)
+    args = parser.parse_args()
+
+    now = int(time.time())
+    payload = {**PAYLOAD, "iat": now, "exp": now + 3600}
+
+    jwt = JsonWebToken(["HS256"])
+    secret = b"151VD61V6DF1V6F"
+    signers = {
+        "HS256": (
+            lambda: jwt.encode({"alg": "HS256"}, payload, secret),
+            lambda token: jwt.decode(token, secret),
+        )
+    }
+    keys = {
+        "RS256": rsa.generate_private_key(
+            public_exponent=65537, key_size=args.rsa_bits
+        ),
+        "ES256": ec.generate_private_key(ec.SECP256R1()),
+        "EdDSA": ed25519.Ed25519PrivateKey.generate(),
+    }
+    for algorithm, key in keys.items():
+        key_ring = KeyRing([private_pem(key)])
+        signers[algorithm] = (
+            lambda key_ring=key_ring: key_ring.encode({}, payload),
+            key_ring.decode,
+        )
+
+    for algorithm, (sign, verify) in signers.items():
+        token = sign()
+        sign_duration = timeit.timeit(sign, number=args.iterations)
+        verify_duration = timeit.timeit(
+            lambda: verify(token).validate(), number=args.iterations
+        )
+        print(
+            f"{algorithm:6} sign {args.iterations / sign_duration:9.0f}/s  "
+            f"verify {args.iterations / verify_duration:9.0f}/s  "
+            f"token {len(token)} bytes"
+        )
+
+
+if __name__ == "__main__":
+    main()
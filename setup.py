@@ -30,6 +30,11 @@ setuptools.setup(
             "pytest",
             "pytest-flask",
         ],
+        "async": [
+            "sqlalchemy[asyncio]",
+            "asyncpg",
+            "httpx",
+        ],
     },
     entry_points={
         "alembic": [
@@ -11,8 +11,6 @@ import argparse
 
 import sqlalchemy
 
-from pypnusershub.db.tools import init_schema, delete_schema, load_fixtures
-
 
 def run_db_cmd(func, db_uri, *args, **kwargs):
     """Run a function from pypnuserhub.db.tools with proper warnings"""
@@ -38,6 +36,8 @@ def run_db_cmd(func, db_uri, *args, **kwargs):
 # Wrap all calls to pypnuserhub.db.tools's function in run_db_cmd
 # to have good warning messages.
 def call_init_schema(args):
+    from pypnusershub.db.tools import init_schema
+
     print("Initializing schema")
     run_db_cmd(init_schema, args.db_uri)
 
@@ -51,6 +51,8 @@ def call_delete_schema(args):
         print("Abort")
         sys.exit(0)
 
+    from pypnusershub.db.tools import delete_schema
+
     print("Deleting schema")
     run_db_cmd(delete_schema, args.db_uri)
 
@@ -61,10 +63,30 @@ def call_reset_schema(args):
 
 
 def call_load_fixtures(args):
+    from pypnusershub.db.tools import load_fixtures
+
     print("Loading fixtures")
     run_db_cmd(load_fixtures, args.db_uri)
 
 
+def call_serve_introspect(args):
+    from werkzeug.serving import make_server
+
+    from pypnusershub.introspect import create_app
+
+    config = {}
+    if args.db_uri:
+        config["SQLALCHEMY_DATABASE_URI"] = args.db_uri
+    app = create_app(config, config_file=args.config)
+    host = "unix://" + args.socket if args.socket else args.host
+    server = make_server(host, args.port, app, threaded=True)
+    print("Serving token introspection on %s" % (args.socket or server.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
 def make_cmd_parser():
     """Create a CMD parser with subcommands for pypnuserhub.db.tools funcs"""
     parser = argparse.ArgumentParser("python -m pypnuserhub")
@@ -89,6 +111,18 @@ def make_cmd_parser():
     parser_load_fixture.add_argument("db_uri", type=str)
     parser_load_fixture.set_defaults(func=call_load_fixtures)
 
+    parser_introspect = subparsers.add_parser(
+        "serve-introspect", help="serve the token introspection endpoint"
+    )
+    parser_introspect.add_argument(
+        "--config", help="configuration file (SQLALCHEMY_DATABASE_URI, SECRET_KEY)"
+    )
+    parser_introspect.add_argument("--db-uri", dest="db_uri")
+    parser_introspect.add_argument("--host", default="127.0.0.1")
+    parser_introspect.add_argument("--port", type=int, default=5100)
+    parser_introspect.add_argument("--socket", help="path of a Unix socket")
+    parser_introspect.set_defaults(func=call_serve_introspect)
+
     return parser
 
 
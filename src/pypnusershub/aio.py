@@ -0,0 +1,261 @@
+# coding: utf8
+
+"""
+Asynchronous API, to validate tokens and read rights from an ASGI
+application (Quart, Starlette, FastAPI…) without a thread per request.
+
+Queries run on the SQLAlchemy asyncio engine with asyncpg, external
+providers are called with httpx (`fetch_user_async`,
+`validate_ticket_async`…). These packages are installed with the `async`
+extra: `pip install pypnusershub[async]`.
+
+The statements, claims checks and response parsing are shared with the
+synchronous Flask API, so both return the same results.
+
+Examples
+--------
+>>> auth = AsyncAuth.from_config(app.config)
+>>> user = await auth.user_from_token(token)
+>>> level = await auth.max_level_profil(user.id_role)
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, Mapping, Optional
+
+from authlib.jose.errors import ExpiredTokenError, JoseError
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm.exc import NoResultFound
+
+from pypnusershub.db.applications import ApplicationEntry, ApplicationIndex
+from pypnusershub.db.models import AppUser
+from pypnusershub.db.rights import max_levels_statement
+from pypnusershub.db.tools import (
+    AccessRightsExpiredError,
+    UnreadableAccessRightsError,
+    app_user_statement,
+    check_token_application,
+    check_token_stamp,
+    decode_token,
+    token_revoked_clause,
+)
+from pypnusershub.keys import KeyRing
+
+
+def async_database_uri(database_uri: str) -> str:
+    """
+    Return the URI of a PostgreSQL database with the asyncpg driver.
+    """
+    return str(make_url(database_uri).set(drivername="postgresql+asyncpg"))
+
+
+@asynccontextmanager
+async def http_client(client=None):
+    """
+    Yield `client`, or a new `httpx.AsyncClient` closed on exit.
+    """
+    if client is not None:
+        yield client
+        return
+    try:
+        import httpx
+    except ImportError:
+        raise ImportError("pypnusershub.aio requires the httpx package")
+    async with httpx.AsyncClient() as client:
+        yield client
+
+
+class AsyncAuth:
+    """
+    Token validation and rights resolution on an asyncio engine.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.ext.asyncio.AsyncEngine
+        engine of the UsersHub database
+    secret_key : str, optional
+        key signing the tokens with HS256, SECRET_KEY of the Flask
+        application. Such tokens are refused if it is None.
+    code_application : str, optional
+        code of the current application; tokens issued for other
+        applications are refused
+    rights_inheritance : bool, default=False
+        include rights granted on the parent applications, as
+        APPLICATION_RIGHTS_INHERITANCE
+    index_ttl : float, default=300
+        lifetime of the application index, in seconds
+    key_ring : pypnusershub.keys.KeyRing, optional
+        keys verifying the tokens signed with an asymmetric key
+    """
+
+    def __init__(
+        self,
+        engine,
+        secret_key: Optional[str],
+        code_application: Optional[str] = None,
+        rights_inheritance: bool = False,
+        index_ttl: float = 300,
+        key_ring: Optional[KeyRing] = None,
+    ) -> None:
+        if secret_key is None and key_ring is None:
+            raise ValueError("secret_key or key_ring is required")
+        self.engine = engine
+        self.secret_key = secret_key
+        self.key_ring = key_ring
+        self.code_application = code_application
+        self.rights_inheritance = rights_inheritance
+        self.index_ttl = index_ttl
+        self._index = None
+        self._index_loaded_at = 0.0
+        self._index_lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, config: Mapping, **engine_options) -> "AsyncAuth":
+        """
+        Build the API from the configuration of the Flask application.
+
+        SQLALCHEMY_DATABASE_URI is used with the asyncpg driver, the key
+        ring is built from TOKEN_SIGNING_KEYS.
+        """
+        try:
+            from sqlalchemy.ext.asyncio import create_async_engine
+        except ImportError:
+            raise ImportError("pypnusershub.aio requires sqlalchemy[asyncio]")
+        engine = create_async_engine(
+            async_database_uri(config["SQLALCHEMY_DATABASE_URI"]), **engine_options
+        )
+        key_ring = KeyRing.from_config(config)
+        allow_hs256 = key_ring is None or config.get("TOKEN_ALLOW_HS256", True)
+        return cls(
+            engine,
+            config["SECRET_KEY"] if allow_hs256 else None,
+            code_application=config.get("CODE_APPLICATION"),
+            rights_inheritance=config.get("APPLICATION_RIGHTS_INHERITANCE", False),
+            key_ring=key_ring,
+        )
+
+    async def dispose(self) -> None:
+        await self.engine.dispose()
+
+    async def decode_token(self, token: str) -> dict:
+        """
+        Return the validated claims of a token.
+
+        Raises
+        ------
+        authlib.jose.errors.JoseError
+            if the token is invalid or expired
+        """
+        return decode_token(token, self.secret_key, self.key_ring)
+
+    async def get_application_index(self, reload: bool = False) -> ApplicationIndex:
+        """
+        Return the application index, reloaded every `index_ttl` seconds.
+        """
+        async with self._index_lock:
+            expired = time.monotonic() - self._index_loaded_at > self.index_ttl
+            if reload or self._index is None or expired:
+                async with self.engine.connect() as connection:
+                    rows = await connection.execute(ApplicationIndex.statement())
+                self._index = ApplicationIndex(ApplicationEntry(*row) for row in rows)
+                self._index_loaded_at = time.monotonic()
+        return self._index
+
+    async def get_application_id(
+        self, code_application: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Return the id of an application, the current one by default, None if
+        the code is unknown.
+        """
+        code_application = code_application or self.code_application
+        if code_application is None:
+            return None
+        index = await self.get_application_index()
+        if code_application not in index:
+            # the application may have been created since the index was loaded
+            index = await self.get_application_index(reload=True)
+        return index.get_id(code_application)
+
+    async def user_from_token(self, token: str) -> AppUser:
+        """
+        Return the `AppUser` of a token, as `pypnusershub.db.tools.user_from_token`.
+
+        Revoked tokens and tokens issued before a change of the security
+        stamp of their user are refused, the revocation being read from
+        `t_revoked_tokens` in the query of the user.
+
+        Raises
+        ------
+        AccessRightsExpiredError
+            if the token expired
+        UnreadableAccessRightsError
+            if the token is invalid, revoked or outdated, was issued for
+            another application or its user has no right on the application
+        """
+        from sqlalchemy.ext.asyncio import AsyncSession
+
+        try:
+            data = await self.decode_token(token)
+        except ExpiredTokenError:
+            raise AccessRightsExpiredError("Token expired")
+        except JoseError:
+            raise UnreadableAccessRightsError("Invalid token", 403)
+        check_token_application(data, await self.get_application_id())
+        async with AsyncSession(self.engine, expire_on_commit=False) as session:
+            try:
+                app_user, security_stamp, revoked = (
+                    await session.execute(
+                        app_user_statement(data).add_columns(token_revoked_clause(data))
+                    )
+                ).one()
+            except NoResultFound:
+                raise UnreadableAccessRightsError(
+                    'No user withd id "{}" for app "{}"'.format(
+                        data["id_role"], data["id_application"]
+                    )
+                )
+        if revoked:
+            raise UnreadableAccessRightsError("Token revoked", 403)
+        check_token_stamp(data, security_stamp)
+        return app_user
+
+    async def max_levels(
+        self,
+        id_roles: Iterable[int],
+        id_application: Optional[int] = None,
+        inherited: Optional[bool] = None,
+    ) -> Dict[int, int]:
+        """
+        Return the highest profile of many roles on an application, as
+        `pypnusershub.db.rights.max_levels`.
+        """
+        id_roles = set(id_roles)
+        if id_application is None:
+            id_application = await self.get_application_id()
+            if id_application is None:
+                return dict.fromkeys(id_roles, 0)
+        if inherited is None:
+            inherited = self.rights_inheritance
+        applications = [id_application]
+        if inherited:
+            applications = (await self.get_application_index()).ancestors(
+                id_application
+            )
+        levels = dict.fromkeys(id_roles, 0)
+        async with self.engine.connect() as connection:
+            rows = await connection.execute(
+                max_levels_statement(id_roles, applications)
+            )
+        levels.update((id_role, level or 0) for id_role, level in rows)
+        return levels
+
+    async def max_level_profil(
+        self, id_role: int, id_application: Optional[int] = None
+    ) -> int:
+        """
+        Return the highest profile of a role on an application, the current
+        one by default.
+        """
+        return (await self.max_levels([id_role], id_application))[id_role]
@@ -1,15 +1,21 @@
 import importlib
+import logging
 
 import sqlalchemy as sa
+from pypnusershub.db.applications import get_application_index
 from pypnusershub.db.models import Provider
+from pypnusershub.db.purge import PurgeScheduler
 from pypnusershub.env import db
 
 from .authentication import Authentication
+from .rate_limit import rate_limiter
 from pypnusershub.login_manager import login_manager
 
 
 from typing import TypedDict
 
+log = logging.getLogger(__name__)
+
 ProviderType = TypedDict(
     "Provider",
     {
@@ -32,6 +38,7 @@ class AuthManager:
         Initializes the AuthManager instance.
         """
         self.provider_authentication_cls = {}
+        self.purge_scheduler = None
 
     def __contains__(self, item) -> bool:
         """
@@ -109,6 +116,21 @@ class AuthManager:
                 instance_provider.configure(configuration=provider_config)
                 self.add_provider(instance_provider.id_provider, instance_provider)
         login_manager.init_app(app)
+        rate_limiter.init_app(app)
+
+        if "CODE_APPLICATION" in app.config and "ID_APP" not in app.config:
+            # warm up the application index used by get_current_app_id
+            with app.app_context():
+                try:
+                    get_application_index()
+                except Exception:
+                    log.warning("Could not load the applications index", exc_info=True)
+
+        if app.config.get("AUTO_PURGE_INTERVAL"):
+            self.purge_scheduler = PurgeScheduler(
+                app, app.config["AUTO_PURGE_INTERVAL"]
+            )
+            self.purge_scheduler.start()
 
     def get_provider(self, instance_name: str) -> Authentication:
         """
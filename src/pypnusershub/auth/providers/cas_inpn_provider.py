@@ -44,33 +44,13 @@ class AuthenficationCASINPN(Authentication):
         base_url = (
             f"{current_app.config['API_ENDPOINT']}/auth/authorize/{self.id_provider}"
         )
-        url_validate = f"{self.URL_VALIDATION}?ticket={ticket}&service={base_url}"
-
-        response = requests.get(url_validate)
-        xml_dict = xmltodict.parse(response.content)
-
-        if "cas:authenticationSuccess" in xml_dict["cas:serviceResponse"]:
-            user = xml_dict["cas:serviceResponse"]["cas:authenticationSuccess"][
-                "cas:user"
-            ]
+        user = self.validate_ticket(ticket, base_url)
         if not user:
             log.info("Erreur d'authentification lié au CAS, voir log du CAS")
             log.error("Erreur d'authentification lié au CAS, voir log du CAS")
             return redirect(self.logout_url)
 
-        ws_user_url = f"{self.URL_INFO}/{user}/?verify=false"
-        response = requests.get(
-            ws_user_url,
-            auth=(
-                self.WS_ID,
-                self.WS_PASSWORD,
-            ),
-        )
-
-        if response.status_code != 200:
-            raise InternalServerError("Error with the inpn authentification service")
-
-        info_user = response.json()
+        info_user = self.fetch_user_info(user)
         user = self.insert_user_and_org(info_user)
         db.session.commit()
         organism_id = info_user["codeOrganisme"]
@@ -85,6 +65,68 @@ class AuthenficationCASINPN(Authentication):
         # user.id_organisme = organism_id
         return user
 
+    def validate_ticket(self, ticket: str, service: str) -> Optional[str]:
+        """
+        Validate a CAS ticket and return the login of the user, None if the
+        ticket is refused.
+        """
+        response = requests.get(
+            self.URL_VALIDATION, params={"ticket": ticket, "service": service}
+        )
+        return self.parse_validation(response.content)
+
+    async def validate_ticket_async(
+        self, ticket: str, service: str, client=None
+    ) -> Optional[str]:
+        """
+        Asynchronous variant of `validate_ticket`, see `pypnusershub.aio`.
+        """
+        from pypnusershub.aio import http_client
+
+        async with http_client(client) as client:
+            response = await client.get(
+                self.URL_VALIDATION, params={"ticket": ticket, "service": service}
+            )
+        return self.parse_validation(response.content)
+
+    @staticmethod
+    def parse_validation(content) -> Optional[str]:
+        xml_dict = xmltodict.parse(content)
+        if "cas:authenticationSuccess" in xml_dict["cas:serviceResponse"]:
+            return xml_dict["cas:serviceResponse"]["cas:authenticationSuccess"][
+                "cas:user"
+            ]
+        return None
+
+    def fetch_user_info(self, user: str) -> dict:
+        """
+        Return the information of a user from the INPN web service.
+        """
+        response = requests.get(
+            f"{self.URL_INFO}/{user}/?verify=false",
+            auth=(self.WS_ID, self.WS_PASSWORD),
+        )
+        return self.parse_user_info(response.status_code, response.json)
+
+    async def fetch_user_info_async(self, user: str, client=None) -> dict:
+        """
+        Asynchronous variant of `fetch_user_info`, see `pypnusershub.aio`.
+        """
+        from pypnusershub.aio import http_client
+
+        async with http_client(client) as client:
+            response = await client.get(
+                f"{self.URL_INFO}/{user}/?verify=false",
+                auth=(self.WS_ID, self.WS_PASSWORD),
+            )
+        return self.parse_user_info(response.status_code, response.json)
+
+    @staticmethod
+    def parse_user_info(status_code: int, get_json) -> dict:
+        if status_code != 200:
+            raise InternalServerError("Error with the inpn authentification service")
+        return get_json()
+
     def revoke(self) -> Any:
         return redirect(self.logout_url)
 
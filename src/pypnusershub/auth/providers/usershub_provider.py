@@ -18,13 +18,41 @@ class ExternalUsersHubAuthProvider(Authentication):
 
     def authenticate(self):
         params = request.json
+        return self.insert_or_update_role(
+            self.fetch_user(params.get("login"), params.get("password"))
+        )
+
+    def fetch_user(self, login: str, password: str) -> dict:
+        """
+        Log in to the remote UsersHub-authentification-module and return the
+        fields of the user to insert or update.
+        """
         login_response = requests.post(
-            self.login_url,
-            json={"login": params.get("login"), "password": params.get("password")},
+            self.login_url, json={"login": login, "password": password}
         )
-        if login_response.status_code != 200:
+        return self.user_dict(login_response.status_code, login_response.json)
+
+    async def fetch_user_async(self, login: str, password: str, client=None) -> dict:
+        """
+        Asynchronous variant of `fetch_user`, see `pypnusershub.aio`.
+
+        Parameters
+        ----------
+        client : httpx.AsyncClient, optional
+            client sending the request, a new one by default
+        """
+        from pypnusershub.aio import http_client
+
+        async with http_client(client) as client:
+            login_response = await client.post(
+                self.login_url, json={"login": login, "password": password}
+            )
+        return self.user_dict(login_response.status_code, login_response.json)
+
+    def user_dict(self, status_code: int, get_json) -> dict:
+        if status_code != 200:
             raise Unauthorized(f"Connexion impossible à {self.label} ")
-        user_resp = login_response.json()["user"]
+        user_resp = get_json()["user"]
         user_dict = dict(
             identifiant=user_resp["identifiant"],
             email=user_resp["email"],
@@ -33,7 +61,7 @@ class ExternalUsersHubAuthProvider(Authentication):
         )
         if "uuid_role" in user_dict:
             user_dict["uuid_role"] = user_resp.get("uuid_role")
-        return self.insert_or_update_role(user_dict)
+        return user_dict
 
     def configure(self, configuration: Union[dict, Any]) -> None:
 
@@ -0,0 +1,189 @@
+"""
+Rate limiting of the authentication endpoints.
+
+Requests are counted per client IP and per identifiant (login or email) and
+rejected with a 429 error before any database query or password hashing.
+"""
+
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from flask import current_app, has_request_context, request
+from werkzeug.exceptions import TooManyRequests
+
+
+class RateLimitBackend:
+    """
+    Abstract class for rate limit storage backends.
+    """
+
+    def hit(self, key: str, limit: int, period: float) -> bool:
+        """
+        Count a hit for a key.
+
+        Parameters
+        ----------
+        key : str
+            the rate limited key (scope, IP or identifiant)
+        limit : int
+            maximum number of hits allowed per period
+        period : float
+            period in seconds
+
+        Returns
+        -------
+        bool
+            True if the hit is allowed, False if the limit is exceeded
+        """
+        raise NotImplementedError()
+
+    def reset(self) -> None:
+        """
+        Forget every counter.
+        """
+        raise NotImplementedError()
+
+
+class MemoryBackend(RateLimitBackend):
+    """
+    Token buckets kept in the memory of the current process.
+
+    Each worker has its own counters. The least recently used buckets are
+    dropped beyond `max_keys` keys to bound memory.
+    """
+
+    def __init__(self, max_keys: int = 100000) -> None:
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, limit: int, period: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (limit, now))
+            tokens = min(limit, tokens + (now - last) * limit / period)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def reset(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBackend(RateLimitBackend):
+    """
+    Sliding window counters shared by every worker, stored in Redis.
+
+    Hits are counted per window of `period` seconds. A hit is allowed if
+    the count of the current window, plus the count of the previous one
+    weighted by the part of it still in the sliding period, is within the
+    limit: unlike fixed windows, twice the limit cannot be reached around
+    the boundary of two windows.
+
+    Requires the `redis` package.
+    """
+
+    def __init__(
+        self, url: str = "redis://localhost:6379/0", prefix: str = "pypnusershub:rl:"
+    ) -> None:
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("RedisBackend requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def hit(self, key: str, limit: int, period: float) -> bool:
+        window, elapsed = divmod(time.time(), period)
+        window_key = f"{self.prefix}{key}:{int(window)}"
+        pipeline = self.client.pipeline()
+        pipeline.incr(window_key)
+        # still read as the previous window during the next one
+        pipeline.expire(window_key, int(2 * period) + 1)
+        pipeline.get(f"{self.prefix}{key}:{int(window) - 1}")
+        count, _, previous = pipeline.execute()
+        return int(previous or 0) * (1 - elapsed / period) + count <= limit
+
+    def reset(self) -> None:
+        for key in self.client.scan_iter(f"{self.prefix}*"):
+            self.client.delete(key)
+
+
+class RateLimiter:
+    """
+    Rate limiter of the authentication endpoints.
+
+    Configuration (Flask config):
+
+    - RATE_LIMIT_ENABLED: enable the limiter (default: False)
+    - RATE_LIMIT_PERIOD: period in seconds (default: 60)
+    - RATE_LIMIT_IP: allowed requests per IP and period (default: 30)
+    - RATE_LIMIT_IDENTIFIANT: allowed requests per identifiant and period (default: 5)
+    - RATE_LIMIT_BACKEND: python path of the backend class
+      (default: "pypnusershub.auth.rate_limit.MemoryBackend")
+    - RATE_LIMIT_BACKEND_OPTIONS: keyword arguments given to the backend
+    """
+
+    def init_app(self, app) -> None:
+        path_backend = app.config.get(
+            "RATE_LIMIT_BACKEND", "pypnusershub.auth.rate_limit.MemoryBackend"
+        )
+        import_path, class_name = path_backend.rsplit(".", 1)
+        class_ = getattr(importlib.import_module(import_path), class_name)
+        app.extensions["pypnusershub_rate_limiter"] = class_(
+            **app.config.get("RATE_LIMIT_BACKEND_OPTIONS", {})
+        )
+
+    @property
+    def backend(self) -> RateLimitBackend:
+        if "pypnusershub_rate_limiter" not in current_app.extensions:
+            self.init_app(current_app)
+        return current_app.extensions["pypnusershub_rate_limiter"]
+
+    def check(self, scope: str, identifiant: Optional[str] = None) -> None:
+        """
+        Count a request and reject it if a limit is exceeded.
+
+        Parameters
+        ----------
+        scope : str
+            name of the rate limited action (e.g. "login")
+        identifiant : str, optional
+            login or email the request is about
+
+        Raises
+        ------
+        TooManyRequests
+            if the client IP or the identifiant exceeded its limit
+        """
+        config = current_app.config
+        if not config.get("RATE_LIMIT_ENABLED", False):
+            return
+        period = config.get("RATE_LIMIT_PERIOD", 60)
+        if has_request_context() and request.remote_addr:
+            if not self.backend.hit(
+                f"{scope}:ip:{request.remote_addr}",
+                config.get("RATE_LIMIT_IP", 30),
+                period,
+            ):
+                raise TooManyRequests("Too many requests, please retry later")
+        if identifiant:
+            if not self.backend.hit(
+                f"{scope}:id:{str(identifiant).lower()}",
+                config.get("RATE_LIMIT_IDENTIFIANT", 5),
+                period,
+            ):
+                raise TooManyRequests(
+                    f"Too many attempts for {identifiant}, please retry later"
+                )
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,150 @@
+"""
+Rotating refresh tokens.
+
+With ACCESS_TOKEN_EXPIRATION set, the access tokens returned on login are
+short-lived and trusted without database access (see
+`pypnusershub.login_manager`). They are renewed on the `/refresh` route with
+a refresh token, which is the only moment the database is read: a
+deactivated user or a revoked token is then refused, so revocation takes
+effect after at most ACCESS_TOKEN_EXPIRATION seconds.
+
+A refresh token can be used once: each use revokes it and issues a new one
+of the same family (the tokens descending from a login). Using an already
+revoked token means it was stolen, and the whole family is revoked. As for
+password reset tokens, only the SHA-256 digest of the tokens is stored in
+`t_refresh_tokens` (indexed).
+"""
+
+import uuid
+from datetime import timedelta
+from typing import Optional, Tuple
+
+import sqlalchemy as sa
+from flask import current_app
+
+from pypnusershub.auth.reset_tokens import generate_token, hash_token
+from pypnusershub.db.models import RefreshToken
+from pypnusershub.env import db
+
+
+def refresh_token_expiration() -> int:
+    """
+    Return the lifetime of refresh tokens, in seconds:
+    REFRESH_TOKEN_EXPIRATION, 30 days by default.
+    """
+    return current_app.config.get("REFRESH_TOKEN_EXPIRATION", 30 * 86400)
+
+
+def refresh_tokens_enabled() -> bool:
+    """
+    Tell if refresh tokens are issued, i.e. if ACCESS_TOKEN_EXPIRATION is set.
+    """
+    return bool(current_app.config.get("ACCESS_TOKEN_EXPIRATION"))
+
+
+def issue_refresh_token(id_role: int, family: Optional[uuid.UUID] = None) -> str:
+    """
+    Create a refresh token for a role.
+
+    Parameters
+    ----------
+    id_role : int
+        identifier of the role
+    family : uuid.UUID, optional
+        family of the token, a new one (new login) by default
+
+    Returns
+    -------
+    str
+        the clear token, to be sent to the client. It is not stored.
+    """
+    token = generate_token()
+    db.session.add(
+        RefreshToken(
+            id_role=id_role,
+            token=hash_token(token),
+            family=family or uuid.uuid4(),
+            expires_at=sa.func.now() + timedelta(seconds=refresh_token_expiration()),
+            revoked=False,
+        )
+    )
+    return token
+
+
+def rotate_refresh_token(token: str) -> Optional[Tuple[int, str]]:
+    """
+    Revoke a refresh token and issue the next one of its family.
+
+    The token is looked up through the index on its digest and revoked in
+    the same statement, so concurrent uses cannot both succeed.
+
+    Parameters
+    ----------
+    token : str
+        the clear refresh token
+
+    Returns
+    -------
+    Optional[tuple]
+        the id_role and the new clear refresh token, None if the token is
+        unknown, expired or revoked. The family of a revoked token is
+        revoked.
+    """
+    digest = hash_token(token)
+    row = db.session.execute(
+        sa.update(RefreshToken)
+        .where(RefreshToken.token == digest)
+        .where(RefreshToken.revoked.is_(False))
+        .where(RefreshToken.expires_at > sa.func.now())
+        .values(revoked=True)
+        .returning(RefreshToken.id_role, RefreshToken.family)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        # reuse of a revoked token: revoke the tokens issued after it
+        family = db.session.scalar(
+            sa.select(RefreshToken.family)
+            .where(RefreshToken.token == digest)
+            .where(RefreshToken.revoked.is_(True))
+        )
+        if family is not None:
+            revoke_refresh_tokens(family=family)
+        return None
+    return row.id_role, issue_refresh_token(row.id_role, row.family)
+
+
+def revoke_refresh_tokens(
+    token: Optional[str] = None,
+    family: Optional[uuid.UUID] = None,
+    id_role: Optional[int] = None,
+) -> int:
+    """
+    Revoke the refresh tokens of the family of a token, of a family, or of a
+    role (e.g. on logout or deactivation).
+
+    Returns
+    -------
+    int
+        the number of revoked tokens
+    """
+    if token is not None:
+        family = db.session.scalar(
+            sa.select(RefreshToken.family).where(
+                RefreshToken.token == hash_token(token)
+            )
+        )
+        if family is None:
+            return 0
+    if family is not None:
+        whereclause = RefreshToken.family == family
+    elif id_role is not None:
+        whereclause = RefreshToken.id_role == id_role
+    else:
+        raise ValueError("token, family or id_role is required")
+    return db.session.execute(
+        sa.update(RefreshToken)
+        .where(whereclause)
+        .where(RefreshToken.revoked.is_(False))
+        .values(revoked=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
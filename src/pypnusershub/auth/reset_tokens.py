@@ -0,0 +1,108 @@
+"""
+Password reset tokens.
+
+Tokens are random strings generated with `secrets`. Only their SHA-256 digest
+is stored in `cor_role_token` (indexed), with an expiration date and a
+one-time-use flag, so a leaked table does not leak usable tokens.
+"""
+
+import hashlib
+import secrets
+from datetime import timedelta
+from typing import Optional
+
+import sqlalchemy as sa
+from flask import current_app
+
+from pypnusershub.db.models import CorRoleToken
+from pypnusershub.env import db
+
+
+def generate_token() -> str:
+    """
+    Generate a random URL-safe token of 256 bits.
+
+    Returns
+    -------
+    str
+        the generated token
+    """
+    return secrets.token_urlsafe(32)
+
+
+def hash_token(token: str) -> str:
+    """
+    Return the digest of a token, as stored in the database.
+
+    Parameters
+    ----------
+    token : str
+        the clear token
+
+    Returns
+    -------
+    str
+        the SHA-256 hexadecimal digest of the token
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def issue_role_token(id_role: int, expiration: Optional[int] = None) -> str:
+    """
+    Create a password reset token for a role, replacing any previous one.
+
+    Parameters
+    ----------
+    id_role : int
+        identifier of the role
+    expiration : int, optional
+        lifetime of the token in seconds, PASSWORD_RESET_TOKEN_EXPIRATION
+        (one day by default) if not given
+
+    Returns
+    -------
+    str
+        the clear token, to be sent to the user. It is not stored.
+    """
+    if expiration is None:
+        expiration = current_app.config.get("PASSWORD_RESET_TOKEN_EXPIRATION", 86400)
+    token = generate_token()
+    db.session.execute(sa.delete(CorRoleToken).where(CorRoleToken.id_role == id_role))
+    db.session.add(
+        CorRoleToken(
+            id_role=id_role,
+            token=hash_token(token),
+            expires_at=sa.func.now() + timedelta(seconds=expiration),
+            used=False,
+        )
+    )
+    return token
+
+
+def consume_role_token(token: str) -> Optional[int]:
+    """
+    Mark a password reset token as used and return the associated role.
+
+    The lookup goes through the index on the token digest and the token is
+    flagged in the same statement, so it can only be used once.
+
+    Parameters
+    ----------
+    token : str
+        the clear token
+
+    Returns
+    -------
+    Optional[int]
+        the id_role associated with the token, None if the token is unknown,
+        expired or already used
+    """
+    return db.session.scalar(
+        sa.update(CorRoleToken)
+        .where(CorRoleToken.token == hash_token(token))
+        .where(CorRoleToken.used.is_(False))
+        .where(CorRoleToken.expires_at > sa.func.now())
+        .values(used=True)
+        .returning(CorRoleToken.id_role)
+        .execution_options(synchronize_session=False)
+    )
@@ -1,12 +1,14 @@
-import random
-from datetime import datetime, timedelta
-
 from pypnusershub.schemas import UserSchema
 import sqlalchemy as sa
 from flask import current_app, request
+from pypnusershub.auth.rate_limit import rate_limiter
+from pypnusershub.auth.reset_tokens import (
+    consume_role_token,
+    generate_token,
+    issue_role_token,
+)
 from pypnusershub.db import db
 from pypnusershub.db.models import (
-    CorRoleToken,
     CorRoles,
     TempUser,
     User,
@@ -15,18 +17,6 @@ from pypnusershub.db.models import (
 from pypnusershub.db.tools import DifferentPasswordError
 
 
-def generate_token():
-    """
-    Generate a random token of 128 bits.
-
-    Returns
-    -------
-    str
-        The generated token as a string of 128 bits.
-    """
-    return str(random.getrandbits(128))
-
-
 def create_cor_role_token(email):
     """
     Create a token associated with an id_role
@@ -44,6 +34,7 @@ def create_cor_role_token(email):
 
     if not email:
         raise Exception("No email was found")
+    rate_limiter.check("password_reset", identifiant=email)
 
     user = db.session.execute(
         sa.select(User).where(User.email == email)
@@ -52,13 +43,8 @@ def create_cor_role_token(email):
     if not user:
         raise KeyError("No user was found with the following email address : " + email)
 
-    token = generate_token()
-    # Remove old token
-    db.session.execute(
-        sa.delete(CorRoleToken).where(CorRoleToken.id_role == user.id_role)
-    )
-    # Create new token
-    db.session.add(CorRoleToken(**{"id_role": user.id_role, "token": token}))
+    # Replace the previous token of the user, only its digest is stored
+    token = issue_role_token(user.id_role)
     db.session.commit()
 
     return {"token": token, "id_role": user.id_role, "role": user.as_dict()}
@@ -84,6 +70,8 @@ def create_temp_user(user_data):
         if the password and password_confirmation are different or if the user_data is invalid
     """
 
+    rate_limiter.check("signup", identifiant=user_data.get("identifiant"))
+
     # Create new temp user
     role_data = {}
     for att in user_data:
@@ -112,13 +100,9 @@ def create_temp_user(user_data):
         sa.delete(TempUser).where(TempUser.identifiant == temp_user.identifiant)
     )
 
-    # Delete old entries (cleaning)
-    days = 7 if not "AUTO_ACCOUNT_DELETION_DAYS" in current_app.config else 7
-    db.session.execute(
-        sa.delete(TempUser).where(
-            TempUser.date_insert <= (datetime.now() - timedelta(days=days))
-        )
-    )
+    # Old entries are deleted by the `user purge` command or the purge
+    # scheduler (see AUTO_PURGE_INTERVAL), not on the signup path
+
     # Update attributes
     temp_user.token_role = generate_token()
 
@@ -194,10 +178,13 @@ def change_password(token: str, password: str, password_confirmation: str):
 
     if not password_confirmation or not password:
         raise ValueError("Password non défini dans paramètres POST")
+    rate_limiter.check("password_change")
 
-    associated_id_role = db.session.scalar(
-        sa.select(CorRoleToken.id_role).where(CorRoleToken.token == token)
-    )
+    if not password == password_confirmation:
+        raise ValueError("Les deux mots de passes ne correspondent pas")
+
+    # The token is flagged as used, it can't be used twice
+    associated_id_role = consume_role_token(token)
     if not associated_id_role:
         raise ValueError("Pas d'id role associée au token")
 
@@ -205,13 +192,7 @@ def change_password(token: str, password: str, password_confirmation: str):
 
     if not role:
         raise ValueError("Pas d'utilisateur correspondant à id_role")
-    if not password == password_confirmation:
-        raise ValueError("Les deux mots de passes ne correspondent pas")
     role.password = password
     db.session.commit()
 
-    # delete cors
-    db.session.query(CorRoleToken).filter(CorRoleToken.token == token).delete()
-    db.session.commit()
-
     return role.as_dict()
@@ -1,9 +1,23 @@
+import csv
+import json
+import uuid
+
 import click
+from flask import current_app
 from flask.cli import with_appcontext
 import sqlalchemy as sa
 
-from pypnusershub.db.models import User
+from pypnusershub.db.models import (
+    AppRole,
+    Application,
+    Provider,
+    User,
+    cor_role_provider,
+    cor_roles,
+)
+from pypnusershub.db.purge import purge_expired_rows
 from pypnusershub.env import db
+from pypnusershub.passwords import hash_passwords
 
 
 @click.group(help="User management commands")
@@ -107,6 +121,80 @@ def change_password(identifiant, password):
     db.session.commit()
 
 
+@user.command()
+@click.argument("passwords_file", type=click.File("r", encoding="utf-8"))
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=500,
+    show_default=True,
+    help="Number of passwords hashed and committed at once",
+)
+@with_appcontext
+def change_passwords(passwords_file, batch_size):
+    """
+    Change the password of many users at once.
+
+    Passwords are hashed in parallel over a pool sized to the CPU count.
+
+    Parameters
+    ----------
+    passwords_file : file
+        CSV file with an "identifiant" and a "password" column
+    batch_size : int
+        number of passwords hashed and committed at once
+
+    Raises
+    ------
+    click.UsageError
+        if the file lacks a column or references an unknown user
+    """
+    reader = csv.DictReader(passwords_file)
+    if not {"identifiant", "password"}.issubset(reader.fieldnames or []):
+        raise click.UsageError(
+            "The file must contain an 'identifiant' and a 'password' column"
+        )
+    pass_method = current_app.config["PASS_METHOD"]
+    t_roles = User.__table__
+    column = t_roles.c["pass"] if pass_method == "md5" else t_roles.c["pass_plus"]
+
+    def update(batch):
+        users = dict(
+            db.session.execute(
+                sa.select(User.identifiant, User.id_role).where(
+                    User.identifiant.in_(batch)
+                )
+            ).all()
+        )
+        unknown = set(batch) - set(users)
+        if unknown:
+            raise click.UsageError(f"Unknown users: {', '.join(sorted(unknown))}")
+        hashes = hash_passwords(batch.values(), pass_method)
+        db.session.execute(
+            sa.update(t_roles)
+            .where(t_roles.c.id_role == sa.bindparam("_id_role"))
+            .values({column: sa.bindparam("_hash")}),
+            [
+                {"_id_role": users[identifiant], "_hash": hash_}
+                for identifiant, hash_ in zip(batch, hashes)
+            ],
+        )
+        db.session.commit()
+
+    batch = {}
+    count = 0
+    for row in reader:
+        batch[row["identifiant"]] = row["password"]
+        if len(batch) >= batch_size:
+            update(batch)
+            count += len(batch)
+            batch = {}
+    if batch:
+        update(batch)
+        count += len(batch)
+    click.echo(f"{count} password(s) changed")
+
+
 @user.command()
 @click.argument("identifiant")
 @click.option("-y", "--yes", is_flag=True, help="Do not ask for confirmation")
@@ -134,3 +222,203 @@ def remove(identifiant, yes):
         raise click.UsageError(f"User {identifiant} does not exist")
     db.session.delete(user)
     db.session.commit()
+
+
+@user.command()
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Maximum number of rows deleted per transaction",
+)
+@with_appcontext
+def purge(batch_size):
+    """
+    Delete expired temporary users, password reset, refresh and revoked
+    tokens, and server-side sessions.
+
+    Temporary users are kept AUTO_ACCOUNT_DELETION_DAYS days (7 by default),
+    password reset tokens are deleted once expired or used, refresh and
+    revoked tokens and the sessions of SESSION_STORE once expired.
+
+    Parameters
+    ----------
+    batch_size : int
+        maximum number of rows deleted per transaction
+    """
+    deleted = purge_expired_rows(current_app.config, batch_size)
+    for kind, count in deleted.items():
+        click.echo(f"{count} {kind.replace('_', ' ')} deleted")
+
+
+EXPORT_DATASETS = ("users", "groups", "rights", "providers")
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+
+
+def _export_statement(dataset):
+    """Return the SELECT statement streamed by ``user export`` for a dataset"""
+    if dataset == "users":
+        return sa.select(
+            User.id_role,
+            User.uuid_role,
+            User.groupe,
+            User.identifiant,
+            User.nom_role,
+            User.prenom_role,
+            User.email,
+            User.id_organisme,
+            User.active,
+            User.date_insert,
+            User.date_update,
+        ).order_by(User.id_role)
+    elif dataset == "groups":
+        return sa.select(
+            cor_roles.c.id_role_groupe,
+            cor_roles.c.id_role_utilisateur,
+        ).order_by(cor_roles.c.id_role_groupe, cor_roles.c.id_role_utilisateur)
+    elif dataset == "rights":
+        return (
+            sa.select(
+                AppRole.id_role,
+                AppRole.id_application,
+                Application.code_application,
+                AppRole.id_droit_max,
+            )
+            .join(Application, Application.id_application == AppRole.id_application)
+            .order_by(AppRole.id_role, AppRole.id_application)
+        )
+    elif dataset == "providers":
+        return (
+            sa.select(
+                cor_role_provider.c.id_role,
+                Provider.id_provider,
+                Provider.name,
+            )
+            .join(Provider, Provider.id_provider == cor_role_provider.c.id_provider)
+            .order_by(cor_role_provider.c.id_role, Provider.id_provider)
+        )
+    raise ValueError(f"Unknown dataset {dataset}")
+
+
+def _jsonable(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _write_csv(columns, partitions, output):
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for rows in partitions:
+        writer.writerows([_jsonable(value) for value in row] for row in rows)
+
+
+def _write_jsonl(columns, partitions, output):
+    for rows in partitions:
+        output.writelines(
+            json.dumps(
+                {column: _jsonable(value) for column, value in zip(columns, row)}
+            )
+            + "\n"
+            for row in rows
+        )
+
+
+def _write_parquet(columns, column_types, partitions, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.UsageError("The parquet format requires pyarrow to be installed")
+
+    def arrow_type(column_type):
+        if isinstance(column_type, sa.Boolean):
+            return pa.bool_()
+        if isinstance(column_type, sa.Integer):
+            return pa.int64()
+        if isinstance(column_type, sa.DateTime):
+            return pa.timestamp("us")
+        return pa.string()
+
+    schema = pa.schema(
+        [(column, arrow_type(type_)) for column, type_ in zip(columns, column_types)]
+    )
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in partitions:
+            data = {
+                column: [
+                    str(value) if isinstance(value, uuid.UUID) else value
+                    for value in values
+                ]
+                for column, values in zip(columns, zip(*rows))
+            }
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+
+@user.command()
+@click.argument("dataset", type=click.Choice(EXPORT_DATASETS))
+@click.option(
+    "--format",
+    "export_format",
+    type=click.Choice(EXPORT_FORMATS),
+    default="csv",
+    show_default=True,
+    help="Output format",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+    default="-",
+    help="Output file (default: standard output)",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help="Number of rows fetched at once from the server-side cursor",
+)
+@with_appcontext
+def export(dataset, export_format, output, batch_size):
+    """
+    Export users, group memberships, application rights or providers.
+
+    Rows are streamed from a server-side cursor and written batch by batch,
+    so memory use does not depend on the number of roles.
+
+    Parameters
+    ----------
+    dataset : str
+        one of "users", "groups", "rights" (as resolved by
+        v_roleslist_forall_applications) or "providers"
+    export_format : str
+        one of "csv", "jsonl" or "parquet" (requires pyarrow)
+    output : str
+        path of the output file, "-" for the standard output
+    batch_size : int
+        number of rows fetched from the database at once
+    """
+    if export_format == "parquet" and output == "-":
+        raise click.UsageError("The parquet format requires an --output file")
+
+    statement = _export_statement(dataset).execution_options(
+        stream_results=True, yield_per=batch_size
+    )
+    result = db.session.execute(statement)
+    columns = list(result.keys())
+    partitions = result.partitions(batch_size)
+
+    if export_format == "parquet":
+        column_types = [column["type"] for column in statement.column_descriptions]
+        _write_parquet(columns, column_types, partitions, output)
+        return
+
+    with click.open_file(output, "w", encoding="utf-8", newline="") as stream:
+        if export_format == "csv":
+            _write_csv(columns, partitions, stream)
+        else:
+            _write_jsonl(columns, partitions, stream)
@@ -0,0 +1,221 @@
+# coding: utf8
+
+"""
+In-memory index of the applications (`t_applications`).
+
+Applications rarely change, so the code → id resolution done on every
+request by `get_current_app_id` is answered from an index cached per Flask
+app. The index is dropped whenever `Application` rows are flushed, updated
+or deleted through the session, and can be dropped explicitly with
+`invalidate_application_index` (e.g. after raw SQL changes).
+"""
+
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.orm.exc import NoResultFound
+
+from pypnusershub.db.models import Application
+from pypnusershub.env import db
+
+EXTENSION_KEY = "pypnusershub_applications"
+
+
+class ApplicationEntry(NamedTuple):
+    id_application: int
+    code_application: str
+    id_parent: Optional[int]
+
+
+class ApplicationIndex:
+    """
+    Code, id and parent of every application, indexed by code and by id.
+    """
+
+    def __init__(self, entries: Iterable[ApplicationEntry]) -> None:
+        self.loaded_at = time.monotonic()
+        self.by_id: Dict[int, ApplicationEntry] = {}
+        self.by_code: Dict[str, ApplicationEntry] = {}
+        for entry in entries:
+            self.by_id[entry.id_application] = entry
+            if entry.code_application is not None:
+                self.by_code[entry.code_application] = entry
+
+    @staticmethod
+    def statement() -> sa.sql.Select:
+        return sa.select(
+            Application.id_application,
+            Application.code_application,
+            Application.id_parent,
+        )
+
+    @classmethod
+    def load(cls) -> "ApplicationIndex":
+        """
+        Build the index with a single query on `t_applications`.
+        """
+        rows = db.session.execute(cls.statement())
+        return cls(ApplicationEntry(*row) for row in rows)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __contains__(self, code_application: str) -> bool:
+        return code_application in self.by_code
+
+    def get_id(self, code_application: str) -> Optional[int]:
+        entry = self.by_code.get(code_application)
+        return entry.id_application if entry else None
+
+    def get_code(self, id_application: int) -> Optional[str]:
+        entry = self.by_id.get(id_application)
+        return entry.code_application if entry else None
+
+    def get_parent(self, id_application: int) -> Optional[int]:
+        entry = self.by_id.get(id_application)
+        return entry.id_parent if entry else None
+
+    def resolve(self, codes_application: Iterable[str]) -> Dict[str, int]:
+        """
+        Resolve several application codes at once.
+
+        Parameters
+        ----------
+        codes_application : Iterable[str]
+            codes of the applications
+
+        Returns
+        -------
+        dict
+            id_application by code, unknown codes are left out
+        """
+        return {
+            code: self.by_code[code].id_application
+            for code in codes_application
+            if code in self.by_code
+        }
+
+    def ancestors(self, id_application: int) -> List[int]:
+        """
+        Return the application followed by its parents, up to the root.
+
+        Parameters
+        ----------
+        id_application : int
+            identifier of the application
+
+        Returns
+        -------
+        list
+            ids of the application and of its ancestors, nearest first
+        """
+        ancestors = [id_application]
+        entry = self.by_id.get(id_application)
+        while entry is not None and entry.id_parent is not None:
+            if entry.id_parent in ancestors:  # guard against cycles
+                break
+            ancestors.append(entry.id_parent)
+            entry = self.by_id.get(entry.id_parent)
+        return ancestors
+
+    def children(self, id_application: int) -> List[int]:
+        """
+        Return the ids of the applications whose parent is `id_application`.
+        """
+        return [
+            entry.id_application
+            for entry in self.by_id.values()
+            if entry.id_parent == id_application
+        ]
+
+
+def get_application_index() -> ApplicationIndex:
+    """
+    Return the application index of the current Flask app, loading it if
+    needed.
+    """
+    index = current_app.extensions.get(EXTENSION_KEY)
+    if index is None:
+        index = current_app.extensions[EXTENSION_KEY] = ApplicationIndex.load()
+    return index
+
+
+def invalidate_application_index(app=None) -> None:
+    """
+    Drop the cached application index so it is reloaded on next use.
+
+    Parameters
+    ----------
+    app : Flask, optional
+        application whose index is dropped, the current app by default
+    """
+    if app is None:
+        if not has_app_context():
+            return
+        app = current_app
+    app.extensions.pop(EXTENSION_KEY, None)
+
+
+def get_application_id(code_application: str) -> int:
+    """
+    Return the id of an application from its code.
+
+    An unknown code reloads the index once, in case the application was
+    created by another process, unless it was loaded less than
+    APPLICATION_INDEX_RELOAD_INTERVAL seconds ago (10 by default): requests
+    for unknown codes cannot reload it on every call.
+
+    Raises
+    ------
+    NoResultFound
+        if no application has this code
+    """
+    index = get_application_index()
+    id_application = index.get_id(code_application)
+    reload_interval = current_app.config.get("APPLICATION_INDEX_RELOAD_INTERVAL", 10)
+    if id_application is None and time.monotonic() - index.loaded_at >= (
+        reload_interval
+    ):
+        invalidate_application_index()
+        id_application = get_application_index().get_id(code_application)
+    if id_application is None:
+        raise NoResultFound(f"No application with code {code_application}")
+    return id_application
+
+
+def _changes_applications(session) -> bool:
+    return any(
+        isinstance(obj, Application)
+        for obj in (*session.new, *session.dirty, *session.deleted)
+    )
+
+
+@sa.event.listens_for(db.session, "before_flush")
+def _track_application_changes(session, flush_context, instances):
+    if _changes_applications(session):
+        session.info[EXTENSION_KEY] = True
+
+
+@sa.event.listens_for(db.session, "do_orm_execute")
+def _track_application_statements(orm_execute_state):
+    if (
+        orm_execute_state.is_update or orm_execute_state.is_delete
+    ) and orm_execute_state.bind_mapper is sa.inspect(Application):
+        orm_execute_state.session.info[EXTENSION_KEY] = True
+        invalidate_application_index()
+
+
+@sa.event.listens_for(db.session, "after_flush")
+def _invalidate_after_flush(session, flush_context):
+    if session.info.get(EXTENSION_KEY):
+        invalidate_application_index()
+
+
+@sa.event.listens_for(db.session, "after_commit")
+@sa.event.listens_for(db.session, "after_soft_rollback")
+def _invalidate_after_transaction(session, *args):
+    # the index may have been reloaded with uncommitted rows in between
+    if session.info.pop(EXTENSION_KEY, False):
+        invalidate_application_index()
@@ -0,0 +1,468 @@
+# coding: utf8
+
+"""
+Listing and search of roles.
+
+Roles are ordered by `id_role` and a page starts after the last `id_role`
+of the previous one, so every page is an index range scan whatever its
+position, and only the requested columns are read.
+
+Roles are searched by name, accents and case ignored, with the trigram and
+prefix indexes on `utilisateurs.fct_role_search_text(nom_role, prenom_role)`.
+Small deployments can instead keep a prefix index of the names in memory
+(ROLES_SEARCH_PREFIX_INDEX).
+
+The operator and functions of `pg_trgm` are qualified with the schema of
+the extension, read once per Flask app, so the search does not depend on
+the `search_path` of the connections.
+"""
+
+import bisect
+import threading
+import time
+import unicodedata
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.sql.selectable import Select
+
+from pypnusershub.db.models import User, cor_role_liste, cor_roles_closure
+from pypnusershub.db.replica import read_bind_arguments
+from pypnusershub.db.rights import has_app_right
+from pypnusershub.env import db
+
+ROLE_FIELDS = {
+    "id_role": User.id_role,
+    "uuid_role": User.uuid_role,
+    "groupe": User.groupe,
+    "identifiant": User.identifiant,
+    "nom_role": User.nom_role,
+    "prenom_role": User.prenom_role,
+    "nom_complet": User.nom_complet,
+    "email": User.email,
+    "id_organisme": User.id_organisme,
+    "active": User.active,
+}
+
+DEFAULT_ROLE_FIELDS = ("id_role", "nom_role", "prenom_role", "nom_complet")
+
+# fields identifying or reaching a person, see ROLES_PRIVATE_FIELDS_MIN_LEVEL
+PRIVATE_ROLE_FIELDS = frozenset(("uuid_role", "identifiant", "email"))
+
+
+def roles_statement(
+    fields: Sequence[str] = DEFAULT_ROLE_FIELDS,
+    after: Optional[int] = None,
+    limit: Optional[int] = None,
+    id_application: Optional[int] = None,
+    id_group: Optional[int] = None,
+    id_liste: Optional[int] = None,
+    id_organisme: Optional[int] = None,
+    groupe: Optional[bool] = None,
+    active: Optional[bool] = None,
+) -> Select:
+    """
+    Build the select of a page of roles.
+
+    Parameters
+    ----------
+    fields : Sequence[str]
+        names of the returned columns, among `ROLE_FIELDS`
+    after : int, optional
+        return the roles whose id_role is greater than this one
+    limit : int, optional
+        maximum number of roles
+    id_application : int, optional
+        only roles having a right on this application, by themselves or
+        through their groups
+    id_group : int, optional
+        only members of this group, members of nested groups included
+    id_liste : int, optional
+        only roles of this list (`t_listes`)
+    id_organisme : int, optional
+        only roles of this organism
+    groupe : bool, optional
+        only groups (True) or only users (False)
+    active : bool, optional
+        only active (True) or inactive (False) roles
+
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        the select, ordered by id_role
+
+    Raises
+    ------
+    KeyError
+        if a field is unknown
+    """
+    unknown = set(fields) - ROLE_FIELDS.keys()
+    if unknown:
+        raise KeyError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    query = sa.select(*(ROLE_FIELDS[field].label(field) for field in fields)).order_by(
+        User.id_role
+    )
+    if "id_role" not in fields:
+        # the id_role is needed to get the next page
+        query = query.add_columns(User.id_role.label("id_role"))
+    if after is not None:
+        query = query.where(User.id_role > after)
+    if id_application is not None:
+        query = query.where(has_app_right(id_application))
+    if id_group is not None:
+        query = query.where(
+            User.id_role.in_(
+                sa.select(cor_roles_closure.c.id_role_descendant)
+                .where(cor_roles_closure.c.id_role_ancestor == id_group)
+                .where(cor_roles_closure.c.depth > 0)
+            )
+        )
+    if id_liste is not None:
+        query = query.where(
+            User.id_role.in_(
+                sa.select(cor_role_liste.c.id_role).where(
+                    cor_role_liste.c.id_liste == id_liste
+                )
+            )
+        )
+    if id_organisme is not None:
+        query = query.where(User.id_organisme == id_organisme)
+    if groupe is not None:
+        query = query.where(User.groupe.is_(groupe))
+    if active is not None:
+        query = query.where(User.active.is_(active))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def list_roles(
+    fields: Sequence[str] = DEFAULT_ROLE_FIELDS,
+    after: Optional[int] = None,
+    limit: int = 100,
+    **filters,
+) -> List[Dict]:
+    """
+    Return a page of roles as dicts.
+
+    Parameters are those of `roles_statement`. The next page is requested
+    with `after` set to the id_role of the last returned role.
+    """
+    return [
+        _role_dict(row, fields)
+        for row in db.session.execute(
+            roles_statement(fields, after=after, limit=limit, **filters),
+            bind_arguments=read_bind_arguments(),
+        )
+    ]
+
+
+def iter_roles(
+    fields: Sequence[str] = DEFAULT_ROLE_FIELDS,
+    after: Optional[int] = None,
+    limit: Optional[int] = None,
+    batch_size: int = 1000,
+    **filters,
+) -> Iterator[Dict]:
+    """
+    Iterate over roles, reading them page by page.
+
+    At most `batch_size` roles are held in memory at once. Other
+    parameters are those of `roles_statement`.
+
+    Yields
+    ------
+    dict
+        a role, with the requested fields
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        rows = db.session.execute(
+            roles_statement(fields, after=after, limit=size, **filters),
+            bind_arguments=read_bind_arguments(),
+        ).all()
+        for row in rows:
+            yield _role_dict(row, fields)
+        if len(rows) < size:
+            return
+        after = rows[-1].id_role
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def _role_dict(row, fields: Sequence[str]) -> Dict:
+    mapping = row._mapping
+    return {field: mapping[field] for field in fields}
+
+
+# texts shorter than this only match the beginning of names: trigrams
+# cannot select them efficiently
+SEARCH_MIN_TRIGRAM_LENGTH = 3
+
+
+def role_search_text():
+    """
+    Return the normalized name of roles, as indexed for the search.
+    """
+    return sa.func.utilisateurs.fct_role_search_text(User.nom_role, User.prenom_role)
+
+
+TRGM_SCHEMA_KEY = "pypnusershub_trgm_schema"
+
+
+def get_trgm_schema() -> str:
+    """
+    Return the schema of the `pg_trgm` extension, cached per Flask app.
+    """
+    schema = current_app.extensions.get(TRGM_SCHEMA_KEY)
+    if schema is None:
+        schema = current_app.extensions[TRGM_SCHEMA_KEY] = db.session.scalar(
+            sa.text(
+                "SELECT nspname FROM pg_extension "
+                "JOIN pg_namespace ON pg_namespace.oid = extnamespace "
+                "WHERE extname = 'pg_trgm'"
+            )
+        )
+    return schema
+
+
+def search_clauses(text: str) -> Tuple[sa.sql.ColumnElement, list]:
+    """
+    Build the condition and the ranking of a search of roles by name.
+
+    Names starting with the text come first, then names containing it or a
+    word similar to it (typos), by decreasing similarity.
+
+    Parameters
+    ----------
+    text : str
+        searched text
+
+    Returns
+    -------
+    tuple
+        the where clause and the order by clauses
+    """
+    target = role_search_text()
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    pattern = sa.func.utilisateurs.fct_unaccent(sa.func.lower(escaped))
+    search = sa.func.utilisateurs.fct_unaccent(sa.func.lower(text))
+    prefix = target.like(pattern + "%")
+    if len(text.strip()) < SEARCH_MIN_TRIGRAM_LENGTH:
+        return prefix, [target, User.id_role]
+    trgm_schema = get_trgm_schema()
+    quoted_schema = db.session.get_bind().dialect.identifier_preparer.quote_schema(
+        trgm_schema
+    )
+    condition = sa.or_(
+        target.like("%" + pattern + "%"),
+        # word similarity operator, served by the trigram index
+        search.op(f"OPERATOR({quoted_schema}.<%)")(target),
+    )
+    word_similarity = sa.sql.functions.Function(
+        "word_similarity", search, target, packagenames=(trgm_schema,)
+    )
+    return condition, [
+        prefix.desc(),
+        word_similarity.desc(),
+        target,
+        User.id_role,
+    ]
+
+
+def search_statement(
+    text: str,
+    fields: Sequence[str] = DEFAULT_ROLE_FIELDS,
+    limit: int = 20,
+    **filters,
+) -> Select:
+    """
+    Build the select of the roles matching a text, best matches first.
+
+    Parameters
+    ----------
+    text : str
+        searched text
+    fields : Sequence[str]
+        names of the returned columns, among `ROLE_FIELDS`
+    limit : int, default=20
+        maximum number of roles
+    **filters
+        filters of `roles_statement`
+
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        the select
+    """
+    condition, order_by = search_clauses(text)
+    return (
+        roles_statement(fields, limit=limit, **filters)
+        .where(condition)
+        .order_by(None)
+        .order_by(*order_by)
+    )
+
+
+def search_roles(
+    text: str,
+    fields: Sequence[str] = DEFAULT_ROLE_FIELDS,
+    limit: int = 20,
+    **filters,
+) -> List[Dict]:
+    """
+    Return the roles matching a text, best matches first.
+
+    The in-memory prefix index is used if ROLES_SEARCH_PREFIX_INDEX is set,
+    the trigram and prefix indexes of the database otherwise. Parameters are
+    those of `search_statement`.
+    """
+    index = get_prefix_index()
+    if index is None:
+        statement = search_statement(text, fields, limit, **filters)
+        return [
+            _role_dict(row, fields)
+            for row in db.session.execute(
+                statement, bind_arguments=read_bind_arguments()
+            )
+        ]
+
+    candidates = index.search(text, limit=PrefixIndex.MAX_CANDIDATES)
+    if not candidates:
+        return []
+    rows = {
+        row.id_role: _role_dict(row, fields)
+        for row in db.session.execute(
+            roles_statement(fields, **filters).where(User.id_role.in_(candidates)),
+            bind_arguments=read_bind_arguments(),
+        )
+    }
+    return [rows[id_role] for id_role in candidates if id_role in rows][:limit]
+
+
+def normalize(text: str) -> str:
+    """
+    Lower a text and remove its accents.
+    """
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+class PrefixIndex:
+    """
+    In-memory prefix index of the names of roles.
+
+    Every word of a name starts a key, so "Dupont Pierre" is found with
+    "dup" as well as "pie". Keys are kept in a sorted list: a prefix lookup
+    is a binary search followed by a scan of the matching keys.
+    """
+
+    MAX_CANDIDATES = 1000
+
+    def __init__(self, names: Iterable[Tuple[int, Optional[str], Optional[str]]]):
+        entries = []
+        for id_role, nom_role, prenom_role in names:
+            words = normalize(f"{nom_role or ''} {prenom_role or ''}").split()
+            for position in range(len(words)):
+                entries.append((" ".join(words[position:]), position, id_role))
+        entries.sort()
+        self.keys = [key for key, _, _ in entries]
+        self.entries = entries
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def load(cls) -> "PrefixIndex":
+        return cls(
+            db.session.execute(
+                sa.select(User.id_role, User.nom_role, User.prenom_role),
+                bind_arguments=read_bind_arguments(),
+            )
+        )
+
+    def search(self, text: str, limit: int = 20) -> List[int]:
+        """
+        Return the ids of the roles whose name has a word starting with
+        `text`, names starting with it first.
+        """
+        prefix = " ".join(normalize(text).split())
+        if not prefix:
+            return []
+        start = bisect.bisect_left(self.keys, prefix)
+        matches = []
+        for key, position, id_role in self.entries[start:]:
+            if not key.startswith(prefix):
+                break
+            matches.append((position, key, id_role))
+        ids = []
+        for _, _, id_role in sorted(matches):
+            if id_role not in ids:
+                ids.append(id_role)
+                if len(ids) >= limit:
+                    break
+        return ids
+
+
+PREFIX_INDEX_KEY = "pypnusershub_roles_prefix_index"
+_prefix_index_lock = threading.Lock()
+
+
+def get_prefix_index() -> Optional[PrefixIndex]:
+    """
+    Return the in-memory prefix index of the current Flask app.
+
+    It is enabled with ROLES_SEARCH_PREFIX_INDEX and rebuilt every
+    ROLES_SEARCH_PREFIX_INDEX_TTL seconds (300 by default) or when roles are
+    changed through the session.
+
+    Returns
+    -------
+    Optional[PrefixIndex]
+        the index, None if it is disabled
+    """
+    config = current_app.config
+    if not config.get("ROLES_SEARCH_PREFIX_INDEX", False):
+        return None
+    index = current_app.extensions.get(PREFIX_INDEX_KEY)
+    ttl = config.get("ROLES_SEARCH_PREFIX_INDEX_TTL", 300)
+    if index is None or time.monotonic() - index.built_at > ttl:
+        with _prefix_index_lock:
+            index = current_app.extensions[PREFIX_INDEX_KEY] = PrefixIndex.load()
+    return index
+
+
+def invalidate_prefix_index() -> None:
+    if has_app_context():
+        current_app.extensions.pop(PREFIX_INDEX_KEY, None)
+
+
+@sa.event.listens_for(db.session, "before_flush")
+def _track_role_changes(session, flush_context, instances):
+    if any(
+        isinstance(obj, User)
+        for obj in (*session.new, *session.dirty, *session.deleted)
+    ):
+        session.info[PREFIX_INDEX_KEY] = True
+
+
+@sa.event.listens_for(db.session, "do_orm_execute")
+def _track_role_statements(orm_execute_state):
+    statement = orm_execute_state.statement
+    if statement.is_dml and getattr(statement, "table", None) in {User.__table__}:
+        orm_execute_state.session.info[PREFIX_INDEX_KEY] = True
+        invalidate_prefix_index()
+
+
+@sa.event.listens_for(db.session, "after_flush")
+def _invalidate_after_flush(session, flush_context):
+    if session.info.get(PREFIX_INDEX_KEY):
+        invalidate_prefix_index()
+
+
+@sa.event.listens_for(db.session, "after_commit")
+@sa.event.listens_for(db.session, "after_soft_rollback")
+def _invalidate_after_transaction(session, *args):
+    # the index may have been rebuilt with uncommitted rows in between
+    if session.info.pop(PREFIX_INDEX_KEY, False):
+        invalidate_prefix_index()
@@ -9,10 +9,9 @@ mappings applications et utilisateurs
 """
 
 import hashlib
-
+import os
 import re
 
-import bcrypt
 import flask_sqlalchemy
 from bcrypt import checkpw
 from packaging import version
@@ -26,27 +25,75 @@ from flask import current_app
 from flask_login import UserMixin
 from pypnusershub.db.tools import DifferentPasswordError, NoPasswordError
 from pypnusershub.env import db
+from pypnusershub.passwords import hash_password
 from pypnusershub.utils import get_current_app_id
 from sqlalchemy import ForeignKey, func, or_
 from sqlalchemy.dialects.postgresql import JSONB, UUID, array
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref, relationship
-from sqlalchemy.orm.session import object_session
 from sqlalchemy.schema import FetchedValue
 from sqlalchemy.sql import func, select
 from utils_flask_sqla.serializers import serializable
 
+# Loading strategies of relationships ("Model.attribute": lazy), by profile.
+# The profile is chosen with the USERSHUB_AUTH_LOADING_PROFILE environment
+# variable, read when the models are imported: strategies are fixed when the
+# relationships are declared, so the profile applies to every Flask app of
+# the process and cannot be set in the app config nor changed afterwards
+# (e.g. by a test). "default" keeps the lazy
+# select loading of SQLAlchemy, except for the members of groups and
+# organisms, which may be thousands: they are dynamic, see `members_page`
+# and `members_count`. "optimized" also loads the small collections read on
+# login with the users and forbids the implicit load of the other large
+# collections. "legacy" loads the members as lists, for code not yet
+# adapted to dynamic relationships.
+LOADING_PROFILES = {
+    "default": {},
+    "optimized": {
+        "User.groups": "selectin",
+        "User.providers": "selectin",
+        "User.app_users": "raise",
+        "Application.app_users": "raise",
+        "UserList.users": "raise",
+    },
+    "legacy": {
+        "User.members": "select",
+        "Organisme.members": "select",
+    },
+}
+
+LOADING_PROFILE = os.environ.get("USERSHUB_AUTH_LOADING_PROFILE", "default")
+if LOADING_PROFILE not in LOADING_PROFILES:
+    raise ValueError(
+        f"Unknown USERSHUB_AUTH_LOADING_PROFILE {LOADING_PROFILE!r}, "
+        f"expected one of {', '.join(LOADING_PROFILES)}"
+    )
+
+
+def loading_strategy(attribute, default="select"):
+    """
+    Return the loading strategy of a relationship in the current profile.
+
+    Parameters
+    ----------
+    attribute : str
+        name of the relationship, as "Model.attribute"
+    default : str, default="select"
+        strategy used if the profile does not set one
+    """
+    return LOADING_PROFILES[LOADING_PROFILE].get(attribute, default)
+
 
 def check_and_encrypt_password(password, password_confirmation, md5=False):
     if not password:
         raise NoPasswordError
     if password != password_confirmation:
         raise DifferentPasswordError
-    pass_plus = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
+    pass_plus = hash_password(password, "hash")
     pass_md5 = None
     if md5:
-        pass_md5 = hashlib.md5(password.encode("utf-8")).hexdigest()
-    return pass_plus.decode("utf-8"), pass_md5
+        pass_md5 = hash_password(password, "md5")
+    return pass_plus, pass_md5
 
 
 def fn_check_password(self, pwd):
@@ -85,6 +132,27 @@ class CorRoles(db.Model):
     __table__ = cor_roles
 
 
+# Transitive closure of cor_roles, maintained by triggers: every role is
+# linked to itself (depth 0) and to all its direct or nested groups
+cor_roles_closure = db.Table(
+    "cor_roles_closure",
+    db.Column(
+        "id_role_ancestor",
+        db.Integer,
+        db.ForeignKey("utilisateurs.t_roles.id_role"),
+        primary_key=True,
+    ),
+    db.Column(
+        "id_role_descendant",
+        db.Integer,
+        db.ForeignKey("utilisateurs.t_roles.id_role"),
+        primary_key=True,
+    ),
+    db.Column("depth", db.Integer),
+    schema="utilisateurs",
+)
+
+
 cor_role_provider = db.Table(
     "cor_role_provider",
     db.Column(
@@ -105,23 +173,9 @@ cor_role_provider = db.Table(
 
 class UserQuery(Query):
     def filter_by_app(self, code_app=None):
-        if code_app is None:
-            code_app = current_app.config["CODE_APPLICATION"]
-        return (
-            self.outerjoin(cor_roles, User.id_role == cor_roles.c.id_role_utilisateur)
-            .outerjoin(
-                UserApplicationRight,
-                or_(
-                    UserApplicationRight.id_role == cor_roles.c.id_role_groupe,
-                    UserApplicationRight.id_role == User.id_role,
-                ),
-            )
-            .join(
-                Application,
-                Application.id_application == UserApplicationRight.id_application,
-            )
-            .where(Application.code_application == code_app)
-        )
+        from pypnusershub.db.rights import has_app_right, resolve_application
+
+        return self.filter(has_app_right(resolve_application(code_app)))
 
 
 @serializable(exclude=["_password", "password", "_password_plus"])
@@ -153,34 +207,37 @@ class User(db.Model, UserMixin):
     date_insert = db.Column(db.DateTime)
     date_update = db.Column(db.DateTime)
     active = db.Column(db.Boolean)
+    # bumped by triggers when the password, activation, groups or rights of
+    # the role change
+    security_stamp = db.Column(
+        db.Integer, server_default=FetchedValue(), server_onupdate=FetchedValue()
+    )
     groups = db.relationship(
         "User",
         secondary=cor_roles,
         primaryjoin="User.id_role == utilisateurs.cor_roles.c.id_role_utilisateur",
         secondaryjoin="User.id_role == utilisateurs.cor_roles.c.id_role_groupe",
-        backref=backref("members", cascade_backrefs=False),
+        backref=backref(
+            "members",
+            cascade_backrefs=False,
+            lazy=loading_strategy("User.members", "dynamic"),
+        ),
+        lazy=loading_strategy("User.groups"),
+    )
+    providers = db.relationship(
+        "Provider",
+        secondary=cor_role_provider,
+        lazy=loading_strategy("User.providers"),
     )
-    providers = db.relationship("Provider", secondary=cor_role_provider)
 
     @property
     def max_level_profil(self):
-        q = (
-            object_session(self)
-            .query(func.max(Profils.code_profil))
-            .select_from(User)
-            .join(
-                UserApplicationRight,
-                or_(
-                    UserApplicationRight.id_role == self.id_role,
-                    UserApplicationRight.id_role.in_(
-                        [role.id_role for role in self.groups]
-                    ),
-                ),
-            )
-            .join(Profils, UserApplicationRight.id_profil == Profils.id_profil)
-            .where(UserApplicationRight.id_application == get_current_app_id())
+        from pypnusershub.db.rights import get_max_level_profil
+
+        # the stamp is not queried if it was not loaded
+        return get_max_level_profil(
+            self.id_role, security_stamp=self.__dict__.get("security_stamp")
         )
-        return q.scalar() or 0
 
     @hybrid_property
     def nom_complet(self):
@@ -208,11 +265,10 @@ class User(db.Model, UserMixin):
     # as bcrypt. This need to be done at usershub level first.
     @password.setter
     def password(self, pwd):
-        pwd = pwd.encode("utf-8")
         if current_app.config["PASS_METHOD"] == "md5":
-            self._password = hashlib.md5(pwd).hexdigest()
+            self._password = hash_password(pwd, "md5")
         elif current_app.config["PASS_METHOD"] == "hash":
-            self._password_plus = bcrypt.hashpw(pwd, bcrypt.gensalt()).decode("utf-8")
+            self._password_plus = hash_password(pwd, "hash")
         else:
             raise Exception("Unknown pass method")
 
@@ -231,26 +287,65 @@ class User(db.Model, UserMixin):
     def __str__(self):
         return self.identifiant or self.nom_complet
 
+    def members_page(self, after=None, limit=100):
+        """
+        Return a page of the members of the group, ordered by id_role.
+
+        Parameters
+        ----------
+        after : int, optional
+            return the members whose id_role is greater than this one, the
+            id_role of the last member of the previous page
+        limit : int, default=100
+            maximum number of members
+
+        Returns
+        -------
+        list
+            the members, as `User`
+        """
+        return _members_page(
+            select(User)
+            .join(cor_roles, cor_roles.c.id_role_utilisateur == User.id_role)
+            .where(cor_roles.c.id_role_groupe == self.id_role),
+            after,
+            limit,
+        )
+
+    def members_count(self):
+        """
+        Return the number of direct members of the group.
+        """
+        return db.session.scalar(
+            select(func.count())
+            .select_from(cor_roles)
+            .where(cor_roles.c.id_role_groupe == self.id_role)
+        )
+
+    @classmethod
+    def search(cls, text, limit=20):
+        """
+        Select the roles whose name matches `text`, accents and case
+        ignored, best matches first (see `pypnusershub.db.listing`).
+        """
+        from pypnusershub.db.listing import search_clauses
+
+        condition, order_by = search_clauses(text)
+        return select(cls).where(condition).order_by(*order_by).limit(limit)
+
     @qfilter
     def filter_by_app(cls, code_app=None, **kwargs):
-        if code_app is None:
-            code_app = current_app.config["CODE_APPLICATION"]
-        query = kwargs["query"]
-        return (
-            query.outerjoin(cor_roles, User.id_role == cor_roles.c.id_role_utilisateur)
-            .outerjoin(
-                UserApplicationRight,
-                or_(
-                    UserApplicationRight.id_role == cor_roles.c.id_role_groupe,
-                    UserApplicationRight.id_role == User.id_role,
-                ),
-            )
-            .join(
-                Application,
-                Application.id_application == UserApplicationRight.id_application,
-            )
-            .where(Application.code_application == code_app)
-        ).whereclause
+        from pypnusershub.db.rights import resolve_application, roles_with_app_right
+
+        # IN on a subquery is planned as a semi-join, like EXISTS
+        return User.id_role.in_(roles_with_app_right(resolve_application(code_app)))
+
+
+def _members_page(query, after, limit):
+    query = query.order_by(User.id_role)
+    if after is not None:
+        query = query.where(User.id_role > after)
+    return db.session.scalars(query.limit(limit)).all()
 
 
 @serializable
@@ -277,7 +372,27 @@ class Organisme(db.Model):
     additional_data = db.Column(JSONB, nullable=True, server_default="{}")
     meta_create_date = db.Column(db.DateTime)
     meta_update_date = db.Column(db.DateTime)
-    members = db.relationship(User, backref="organisme")
+    members = db.relationship(
+        User, backref="organisme", lazy=loading_strategy("Organisme.members", "dynamic")
+    )
+
+    def members_page(self, after=None, limit=100):
+        """
+        Return a page of the users of the organism, see `User.members_page`.
+        """
+        return _members_page(
+            select(User).where(User.id_organisme == self.id_organisme), after, limit
+        )
+
+    def members_count(self):
+        """
+        Return the number of users of the organism.
+        """
+        return db.session.scalar(
+            select(func.count())
+            .select_from(User)
+            .where(User.id_organisme == self.id_organisme)
+        )
 
     def __str__(self):
         return self.nom_organisme
@@ -314,7 +429,10 @@ class Profils(db.Model):
     desc_profil = db.Column(db.Unicode)
 
     applications = relationship(
-        "Application", secondary=profils_for_app, back_populates="profils"
+        "Application",
+        secondary=profils_for_app,
+        back_populates="profils",
+        lazy=loading_strategy("Profils.applications"),
     )
 
 
@@ -333,7 +451,10 @@ class Application(db.Model):
     id_parent = db.Column(db.Integer)
 
     profils = relationship(
-        Profils, secondary=profils_for_app, back_populates="applications"
+        Profils,
+        secondary=profils_for_app,
+        back_populates="applications",
+        lazy=loading_strategy("Application.profils"),
     )
 
     def __repr__(self):
@@ -387,9 +508,13 @@ class UserApplicationRight(db.Model):
     )
     is_default_group_for_app = db.Column(db.Boolean, default=False)
 
-    role = relationship("User")
-    profil = relationship("Profils")
-    application = relationship("Application")
+    role = relationship("User", lazy=loading_strategy("UserApplicationRight.role"))
+    profil = relationship(
+        "Profils", lazy=loading_strategy("UserApplicationRight.profil")
+    )
+    application = relationship(
+        "Application", lazy=loading_strategy("UserApplicationRight.application")
+    )
 
     def __repr__(self):
         return "<UserApplicationRight role='{}' profil='{}' app='{}'>".format(
@@ -418,7 +543,9 @@ class AppUser(db.Model):
     id_role = db.Column(
         db.Integer, db.ForeignKey("utilisateurs.t_roles.id_role"), primary_key=True
     )
-    role = relationship("User", backref="app_users")
+    role = relationship(
+        "User", backref=backref("app_users", lazy=loading_strategy("User.app_users"))
+    )
     nom_role = db.Column(db.Unicode)
     prenom_role = db.Column(db.Unicode)
     id_application = db.Column(
@@ -427,7 +554,10 @@ class AppUser(db.Model):
         primary_key=True,
     )
     id_organisme = db.Column(db.Integer)
-    application = relationship("Application", backref="app_users")
+    application = relationship(
+        "Application",
+        backref=backref("app_users", lazy=loading_strategy("Application.app_users")),
+    )
     identifiant = db.Column(db.Unicode)
     _password = db.Column("pass", db.Unicode)
     _password_plus = db.Column("pass_plus", db.Unicode)
@@ -464,6 +594,7 @@ class AppRole(db.Model):
     )
     id_organisme = db.Column(db.Integer)
     identifiant = db.Column(db.Unicode)
+    id_droit_max = db.Column(db.Integer)
 
     application = db.relationship(Application)
 
@@ -500,7 +631,49 @@ class UserList(db.Model):
     nom_liste = db.Column(db.Unicode(length=50))
     desc_liste = db.Column(db.Unicode)
 
-    users = db.relationship(User, secondary=cor_role_liste)
+    users = db.relationship(
+        User, secondary=cor_role_liste, lazy=loading_strategy("UserList.users")
+    )
+    members = db.relationship(
+        "UserListMember", viewonly=True, order_by="UserListMember.id_role"
+    )
+
+
+@serializable
+class UserListMember(db.Model):
+    """
+    Utilisateurs actifs des listes, directement ou via leurs groupes
+
+    Remplace la vue v_userslist_forall_menu : seuls les identifiants et les
+    colonnes d'affichage sont renvoyés, sans dédoublonnage par UNION.
+    """
+
+    __tablename__ = "v_roles_listes"
+    __table_args__ = {"schema": "utilisateurs"}
+
+    id_menu = db.Column(
+        db.Integer,
+        db.ForeignKey("utilisateurs.t_listes.id_liste"),
+        primary_key=True,
+    )
+    id_role = db.Column(
+        db.Integer, db.ForeignKey("utilisateurs.t_roles.id_role"), primary_key=True
+    )
+    uuid_role = db.Column(UUID)
+    identifiant = db.Column(db.Unicode)
+    nom_role = db.Column(db.Unicode)
+    prenom_role = db.Column(db.Unicode)
+    nom_complet = db.Column(db.Unicode)
+    email = db.Column(db.Unicode)
+    id_organisme = db.Column(db.Integer)
+    organisme = db.Column(db.Unicode)
+
+    role = relationship("User", viewonly=True)
+
+    def __repr__(self):
+        return "<UserListMember role='{}' liste='{}'>".format(
+            self.id_role, self.id_menu
+        )
 
 
 @serializable
@@ -521,7 +694,11 @@ class CorRoleToken(db.Model):
     __table_args__ = {"schema": "utilisateurs", "extend_existing": True}
 
     id_role = db.Column(db.Integer, primary_key=True)
+    # SHA-256 digest of the token, see pypnusershub.auth.reset_tokens
     token = db.Column(db.Unicode)
+    date_insert = db.Column(db.DateTime, server_default=FetchedValue())
+    expires_at = db.Column(db.DateTime, server_default=FetchedValue())
+    used = db.Column(db.Boolean, server_default=FetchedValue())
 
     def as_dict(self, recursif=False, columns=(), depth=None):
         """
@@ -531,6 +708,64 @@ class CorRoleToken(db.Model):
         return {"id_role": self.id_role, "token": self.token}
 
 
+class RefreshToken(db.Model):
+    """
+    Jeton de renouvellement des tokens d'accès, voir
+    pypnusershub.auth.refresh_tokens
+    """
+
+    __tablename__ = "t_refresh_tokens"
+    __table_args__ = {"schema": "utilisateurs"}
+
+    id_refresh_token = db.Column(db.Integer, primary_key=True)
+    id_role = db.Column(
+        db.Integer, ForeignKey("utilisateurs.t_roles.id_role"), nullable=False
+    )
+    # SHA-256 digest of the token
+    token = db.Column(db.Unicode(64), nullable=False)
+    family = db.Column(UUID(as_uuid=True), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
+    date_insert = db.Column(db.DateTime, server_default=FetchedValue())
+
+    def __repr__(self):
+        return "<RefreshToken role='{}' family='{}'>".format(self.id_role, self.family)
+
+
+class RevokedToken(db.Model):
+    """
+    Token révoqué avant son expiration, voir pypnusershub.auth.revocation
+    """
+
+    __tablename__ = "t_revoked_tokens"
+    __table_args__ = {"schema": "utilisateurs"}
+
+    jti = db.Column(db.Unicode(64), primary_key=True)
+    id_role = db.Column(db.Integer, ForeignKey("utilisateurs.t_roles.id_role"))
+    expires_at = db.Column(db.DateTime, nullable=False)
+    date_insert = db.Column(db.DateTime, server_default=FetchedValue())
+
+    def __repr__(self):
+        return "<RevokedToken jti='{}' role='{}'>".format(self.jti, self.id_role)
+
+
+class ServerSession(db.Model):
+    """
+    Session Flask conservée côté serveur, voir pypnusershub.sessions
+    """
+
+    __tablename__ = "t_sessions"
+    __table_args__ = {"schema": "utilisateurs"}
+
+    # SHA-256 digest of the session id
+    sid = db.Column(db.Unicode(64), primary_key=True)
+    data = db.Column(db.UnicodeText, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<ServerSession expires_at='{}'>".format(self.expires_at)
+
+
 @serializable
 class CorRoleListe(db.Model):
     """Classe de correspondance entre la table t_roles et la table t_listes"""
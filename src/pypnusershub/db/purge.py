@@ -0,0 +1,190 @@
+# coding: utf8
+
+"""
+Purge of expired rows (temporary users, password reset, refresh and
+revoked tokens, server-side sessions).
+
+Rows are deleted in small batches, each committed separately, so row
+locks are held briefly and concurrent signups are not blocked.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from flask import current_app
+
+from pypnusershub.db import models
+from pypnusershub.env import db
+
+log = logging.getLogger(__name__)
+
+
+def delete_in_batches(model, whereclause, batch_size=1000):
+    """
+    Delete the rows of a model matching a condition, batch by batch.
+
+    Parameters
+    ----------
+    model : db.Model
+        model whose rows are deleted (it must have a single-column primary key)
+    whereclause : sqlalchemy.sql.ColumnElement
+        condition selecting the rows to delete
+    batch_size : int, default=1000
+        maximum number of rows deleted per transaction
+
+    Returns
+    -------
+    int
+        the number of deleted rows
+    """
+    (pk,) = sa.inspect(model).primary_key
+    total = 0
+    while True:
+        batch = (
+            sa.select(pk)
+            .where(whereclause)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        result = db.session.execute(
+            sa.delete(model).where(pk.in_(batch)),
+            execution_options={"synchronize_session": False},
+        )
+        db.session.commit()
+        total += result.rowcount
+        if result.rowcount < batch_size:
+            return total
+
+
+def purge_temp_users(days, batch_size=1000):
+    """
+    Delete temporary users (account requests) older than `days` days.
+
+    Returns
+    -------
+    int
+        the number of deleted temporary users
+    """
+    limit = datetime.now() - timedelta(days=days)
+    return delete_in_batches(
+        models.TempUser, models.TempUser.date_insert <= limit, batch_size
+    )
+
+
+def purge_role_tokens(batch_size=1000):
+    """
+    Delete expired or already used password reset tokens.
+
+    Returns
+    -------
+    int
+        the number of deleted tokens
+    """
+    return delete_in_batches(
+        models.CorRoleToken,
+        sa.or_(
+            models.CorRoleToken.used.is_(True),
+            models.CorRoleToken.expires_at <= sa.func.now(),
+        ),
+        batch_size,
+    )
+
+
+def purge_refresh_tokens(batch_size=1000):
+    """
+    Delete expired refresh tokens. Revoked tokens are kept until they
+    expire, to detect their reuse.
+
+    Returns
+    -------
+    int
+        the number of deleted tokens
+    """
+    return delete_in_batches(
+        models.RefreshToken,
+        models.RefreshToken.expires_at <= sa.func.now(),
+        batch_size,
+    )
+
+
+def purge_revoked_tokens(batch_size=1000):
+    """
+    Delete the revoked tokens which expired, they are refused anyway.
+
+    Returns
+    -------
+    int
+        the number of deleted tokens
+    """
+    return delete_in_batches(
+        models.RevokedToken,
+        models.RevokedToken.expires_at <= sa.func.now(),
+        batch_size,
+    )
+
+
+def purge_expired_rows(config, batch_size=1000):
+    """
+    Purge every kind of expired rows according to the application config.
+
+    Parameters
+    ----------
+    config : flask.Config
+        configuration providing the retention of temporary users
+        (AUTO_ACCOUNT_DELETION_DAYS, 7 days by default)
+    batch_size : int, default=1000
+        maximum number of rows deleted per transaction
+
+    Returns
+    -------
+    dict
+        the number of deleted rows per kind
+    """
+    # the session stores use this module
+    from pypnusershub.sessions import get_session_store
+
+    deleted = {
+        "temp_users": purge_temp_users(
+            config.get("AUTO_ACCOUNT_DELETION_DAYS", 7), batch_size
+        ),
+        "role_tokens": purge_role_tokens(batch_size),
+        "refresh_tokens": purge_refresh_tokens(batch_size),
+        "revoked_tokens": purge_revoked_tokens(batch_size),
+    }
+    # expired server-side sessions (SESSION_STORE)
+    store = get_session_store(current_app)
+    if store is not None:
+        deleted["sessions"] = store.purge()
+    return deleted
+
+
+class PurgeScheduler(threading.Thread):
+    """
+    Background thread running `purge_expired_rows` every `interval` seconds.
+
+    It is started by `AuthManager.init_app` when AUTO_PURGE_INTERVAL is set.
+    """
+
+    def __init__(self, app, interval, batch_size=1000):
+        super().__init__(name="pypnusershub-purge", daemon=True)
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    deleted = purge_expired_rows(self.app.config, self.batch_size)
+                    log.debug("Expired rows purged: %s", deleted)
+                except Exception:
+                    db.session.rollback()
+                    log.exception("Error while purging expired rows")
+                finally:
+                    db.session.remove()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,57 @@
+"""
+Read replica answering the read-only queries.
+
+With DB_READ_REPLICA_URI set (see `pypnusershub.pool`), the user of a token
+(`user_from_token`), the max levels of roles and the role listings are read
+from the replica. A session which wrote in its current transaction reads
+from the primary database, so that it sees its own changes; other sessions
+may read data as old as the replication lag.
+"""
+
+from typing import Optional
+
+import sqlalchemy as sa
+from flask import current_app
+
+from pypnusershub.env import db
+from pypnusershub.pool import REPLICA_BIND
+
+WROTE_KEY = "pypnusershub_wrote"
+
+
+def read_bind_arguments() -> Optional[dict]:
+    """
+    Return the `bind_arguments` of a read-only query, sent to the read
+    replica if any and if the session did not write.
+
+    Examples
+    --------
+    >>> db.session.execute(statement, bind_arguments=read_bind_arguments())
+    """
+    if REPLICA_BIND not in current_app.config.get("SQLALCHEMY_BINDS", {}):
+        return None
+    session = db.session()
+    if session.info.get(WROTE_KEY) or session.new or session.dirty or session.deleted:
+        return None
+    return {"bind": db.engines[REPLICA_BIND]}
+
+
+@sa.event.listens_for(db.session, "after_flush")
+def _track_flush(session, flush_context):
+    session.info[WROTE_KEY] = True
+
+
+@sa.event.listens_for(db.session, "do_orm_execute")
+def _track_execute(orm_execute_state):
+    if (
+        orm_execute_state.is_insert
+        or orm_execute_state.is_update
+        or orm_execute_state.is_delete
+    ):
+        orm_execute_state.session.info[WROTE_KEY] = True
+
+
+@sa.event.listens_for(db.session, "after_commit")
+@sa.event.listens_for(db.session, "after_rollback")
+def _reset_writes(session):
+    session.info.pop(WROTE_KEY, None)
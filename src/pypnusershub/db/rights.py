@@ -0,0 +1,498 @@
+# coding: utf8
+
+"""
+Effective rights of roles on applications.
+
+With APPLICATION_RIGHTS_INHERITANCE enabled, the rights granted on an
+application also apply to its children (`t_applications.id_parent`), e.g. to
+every GeoNature module. The ancestors of an application are read from the
+cached application index, so the effective profile is a single query
+whatever the depth of the hierarchy.
+
+Roles holding a right on an application are selected with
+`roles_with_app_right` / `has_app_right`, semi-joins on the group closure
+table which do not duplicate rows per group.
+
+The max levels of many roles are computed at once by `max_levels`, with an
+optional in-memory cache (RIGHTS_CACHE_TTL). Cached levels are tied to the
+security stamp of their role (`t_roles.security_stamp`, bumped by triggers
+when its groups or rights change): expired levels are revalidated by
+reading the stamps of all their roles in one query, and levels whose role
+changed, or older than RIGHTS_CACHE_MAX_AGE, are recomputed.
+"""
+
+import threading
+import time
+from typing import Dict, Hashable, Iterable, List, Mapping, Optional
+
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql.selectable import Exists, Select
+
+from pypnusershub.db.applications import get_application_id, get_application_index
+from pypnusershub.db.models import (
+    CorRoles,
+    Profils,
+    User,
+    UserApplicationRight,
+    cor_roles_closure,
+)
+from pypnusershub.db.replica import read_bind_arguments
+from pypnusershub.env import db
+from pypnusershub.utils import get_current_app_id
+
+RIGHTS_CACHE_KEY = "pypnusershub_rights_cache"
+
+
+def resolve_application(code_application: Optional[str] = None) -> Optional[int]:
+    """
+    Return the id of an application from the cached application index.
+
+    Parameters
+    ----------
+    code_application : str, optional
+        code of the application, CODE_APPLICATION by default
+
+    Returns
+    -------
+    Optional[int]
+        the id of the application, None if the code is unknown
+    """
+    if code_application is None:
+        code_application = current_app.config["CODE_APPLICATION"]
+    try:
+        return get_application_id(code_application)
+    except NoResultFound:
+        return None
+
+
+def roles_with_app_right(id_application: Optional[int]) -> Select:
+    """
+    Select the ids of the roles having a right on an application, by
+    themselves or through one of their (nested) groups.
+
+    The group closure table replaces the OR on `cor_roles` and the
+    application is given by id, so the statement only reads indexed
+    columns. Its structure does not depend on the application, so it is
+    compiled once and then reused from the SQLAlchemy statement cache.
+
+    Parameters
+    ----------
+    id_application : int
+        identifier of the application
+
+    Returns
+    -------
+    sqlalchemy.sql.Select
+        select of `id_role_descendant`, usable in an IN clause
+    """
+    return (
+        sa.select(cor_roles_closure.c.id_role_descendant)
+        .join(
+            UserApplicationRight,
+            UserApplicationRight.id_role == cor_roles_closure.c.id_role_ancestor,
+        )
+        .where(UserApplicationRight.id_application == id_application)
+    )
+
+
+def has_app_right(id_application: Optional[int], id_role=User.id_role) -> Exists:
+    """
+    EXISTS semi-join telling if a role has a right on an application.
+
+    Parameters
+    ----------
+    id_application : int
+        identifier of the application
+    id_role : sqlalchemy.sql.ColumnElement, default=User.id_role
+        role column (or value) the semi-join is correlated to
+
+    Returns
+    -------
+    sqlalchemy.sql.selectable.Exists
+        clause usable in a where clause
+
+    Examples
+    --------
+    >>> db.session.scalars(
+    ...     select(User).where(has_app_right(resolve_application("GN")))
+    ... )
+    """
+    return (
+        roles_with_app_right(id_application)
+        .where(cor_roles_closure.c.id_role_descendant == id_role)
+        .exists()
+    )
+
+
+def get_rights_applications(
+    id_application: int, inherited: Optional[bool] = None
+) -> List[int]:
+    """
+    Return the applications whose rights apply to `id_application`.
+
+    Parameters
+    ----------
+    id_application : int
+        identifier of the application
+    inherited : bool, optional
+        include the ancestors of the application, APPLICATION_RIGHTS_INHERITANCE
+        (False by default) if not given
+
+    Returns
+    -------
+    list
+        the application followed by its ancestors if rights are inherited
+    """
+    if inherited is None:
+        inherited = current_app.config.get("APPLICATION_RIGHTS_INHERITANCE", False)
+    if not inherited:
+        return [id_application]
+    return get_application_index().ancestors(id_application)
+
+
+def get_security_stamps(id_roles: Iterable[int]) -> Dict[int, int]:
+    """
+    Return the security stamps of many roles in a single query.
+
+    Parameters
+    ----------
+    id_roles : Iterable[int]
+        identifiers of the roles
+
+    Returns
+    -------
+    dict
+        the `security_stamp` by id_role, unknown roles being left out
+    """
+    return dict(
+        db.session.execute(
+            sa.select(User.id_role, User.security_stamp).where(
+                User.id_role
+                == sa.any_(
+                    sa.bindparam("id_roles", list(id_roles), type_=ARRAY(sa.Integer))
+                )
+            ),
+            bind_arguments=read_bind_arguments(),
+        ).all()
+    )
+
+
+def get_max_level_profil(
+    id_role: int,
+    id_application: Optional[int] = None,
+    inherited: Optional[bool] = None,
+    security_stamp: Optional[int] = None,
+) -> int:
+    """
+    Return the highest profile of a role on an application.
+
+    Rights granted to the role itself and to its groups, nested groups
+    included, are taken into account, as well as those granted on the
+    ancestors of the application if rights are inherited.
+
+    Parameters
+    ----------
+    id_role : int
+        identifier of the role
+    id_application : int, optional
+        identifier of the application, the current application by default
+    inherited : bool, optional
+        include rights granted on the ancestors of the application,
+        APPLICATION_RIGHTS_INHERITANCE (False by default) if not given
+    security_stamp : int, optional
+        current security stamp of the role, if known (e.g. from its token)
+
+    Returns
+    -------
+    int
+        the highest `code_profil`, 0 if the role has no right
+    """
+    stamps = None if security_stamp is None else {id_role: security_stamp}
+    return max_levels([id_role], id_application, inherited, stamps)[id_role]
+
+
+def max_levels(
+    id_roles: Iterable[int],
+    id_application: Optional[int] = None,
+    inherited: Optional[bool] = None,
+    stamps: Optional[Mapping[int, int]] = None,
+) -> Dict[int, int]:
+    """
+    Return the highest profile of many roles on an application.
+
+    Levels found in the rights cache (see `get_rights_cache`) are reused,
+    as well as expired ones whose role kept its security stamp; the others
+    are computed by a single grouped query.
+
+    Parameters
+    ----------
+    id_roles : Iterable[int]
+        identifiers of the roles
+    id_application : int, optional
+        identifier of the application, the current application by default
+    inherited : bool, optional
+        include rights granted on the ancestors of the application,
+        APPLICATION_RIGHTS_INHERITANCE (False by default) if not given
+    stamps : Mapping[int, int], optional
+        current security stamps of roles, if known: cached levels of other
+        stamps are ignored. The missing stamps are read from the database
+        on cache misses.
+
+    Returns
+    -------
+    dict
+        the highest `code_profil` by id_role, 0 for roles without right
+    """
+    id_roles = set(id_roles)
+    if id_application is None:
+        id_application = get_current_app_id()
+        if id_application is None:
+            return dict.fromkeys(id_roles, 0)
+    applications = tuple(get_rights_applications(id_application, inherited))
+
+    cache = get_rights_cache()
+    stamps = dict(stamps or {})
+    levels = {}
+    if cache is not None:
+        keys = {id_role: (id_role, applications) for id_role in id_roles}
+        hits = cache.get_many(
+            keys.values(),
+            {
+                keys[id_role]: stamp
+                for id_role, stamp in stamps.items()
+                if id_role in keys
+            },
+        )
+        levels = {id_role: level for (id_role, _), level in hits.items()}
+        missing = id_roles - levels.keys()
+        # the stamps are read before the levels: a change in between leaves
+        # an outdated stamp, and the level is computed again on next use
+        unknown = missing - stamps.keys()
+        if unknown:
+            stamps.update(get_security_stamps(unknown))
+        renewed = cache.revalidate(
+            {keys[id_role]: stamps.get(id_role) for id_role in missing}
+        )
+        levels.update((id_role, level) for (id_role, _), level in renewed.items())
+    missing = id_roles - levels.keys()
+    if not missing:
+        return levels
+
+    computed = dict.fromkeys(missing, 0)
+    rows = db.session.execute(
+        max_levels_statement(missing, applications),
+        bind_arguments=read_bind_arguments(),
+    )
+    computed.update((id_role, level or 0) for id_role, level in rows)
+    if cache is not None:
+        cache.set_many(
+            {(id_role, applications): level for id_role, level in computed.items()},
+            {(id_role, applications): stamps.get(id_role) for id_role in computed},
+        )
+    levels.update(computed)
+    return levels
+
+
+def max_levels_statement(
+    id_roles: Iterable[int], applications: Iterable[int]
+) -> Select:
+    """
+    Select the id_role and highest `code_profil` of roles on applications.
+
+    Roles without right on the applications are left out.
+
+    Parameters
+    ----------
+    id_roles : Iterable[int]
+        identifiers of the roles
+    applications : Iterable[int]
+        identifiers of the applications whose rights are taken into account
+    """
+    # a single array parameter keeps one cached statement whatever the
+    # number of roles
+    return (
+        sa.select(
+            cor_roles_closure.c.id_role_descendant,
+            sa.func.max(Profils.code_profil),
+        )
+        .join(
+            UserApplicationRight,
+            UserApplicationRight.id_role == cor_roles_closure.c.id_role_ancestor,
+        )
+        .join(Profils, UserApplicationRight.id_profil == Profils.id_profil)
+        .where(
+            cor_roles_closure.c.id_role_descendant
+            == sa.any_(
+                sa.bindparam("id_roles", list(id_roles), type_=ARRAY(sa.Integer))
+            )
+        )
+        .where(UserApplicationRight.id_application.in_(applications))
+        .group_by(cor_roles_closure.c.id_role_descendant)
+    )
+
+
+class RightsCache:
+    """
+    Cache of the max levels of roles, kept in memory for `ttl` seconds.
+
+    Each value may be stored with the security stamp of its role: it is then
+    ignored if a more recent stamp is known, and can be renewed once expired
+    if the stamp did not change (see `revalidate`), until it is `max_age`
+    seconds old.
+
+    It is cleared when rights, profiles or roles are changed through the
+    session of the current process. Other processes see changes of the
+    groups and rights of a role (which bump its stamp) after at most `ttl`
+    seconds, and the other changes (e.g. of `t_profils.code_profil`) after
+    at most `max_age` seconds.
+    """
+
+    def __init__(
+        self, ttl: float, max_size: int = 100000, max_age: Optional[float] = None
+    ) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_age = max_age if max_age is not None else 10 * ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_many(
+        self, keys: Iterable[Hashable], stamps: Optional[Mapping] = None
+    ) -> dict:
+        """
+        Return the cached values of the keys that did not expire, and whose
+        stamp is the one given in `stamps` if any.
+        """
+        now = time.monotonic()
+        stamps = stamps or {}
+        hits = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry[1] > now
+                and stamps.get(key, entry[2]) == entry[2]
+            ):
+                hits[key] = entry[0]
+        return hits
+
+    def revalidate(self, stamps: Mapping) -> dict:
+        """
+        Renew the entries, expired or not, whose stamp is the given one and
+        which are less than `max_age` seconds old, and return their values.
+        """
+        now = time.monotonic()
+        expires = now + self.ttl
+        renewed = {}
+        with self._lock:
+            for key, stamp in stamps.items():
+                entry = self._entries.get(key)
+                if (
+                    stamp is not None
+                    and entry is not None
+                    and entry[2] == stamp
+                    and now - entry[3] < self.max_age
+                ):
+                    self._entries[key] = (entry[0], expires, stamp, entry[3])
+                    renewed[key] = entry[0]
+        return renewed
+
+    def set_many(self, values: dict, stamps: Optional[Mapping] = None) -> None:
+        now = time.monotonic()
+        expires = now + self.ttl
+        stamps = stamps or {}
+        with self._lock:
+            if len(self._entries) + len(values) > self.max_size:
+                self._entries.clear()
+            self._entries.update(
+                (key, (value, expires, stamps.get(key), now))
+                for key, value in values.items()
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def get_rights_cache() -> Optional[RightsCache]:
+    """
+    Return the rights cache of the current Flask app.
+
+    The cache is enabled by setting RIGHTS_CACHE_TTL (in seconds, disabled
+    by default). Values whose role did not change are renewed until they are
+    RIGHTS_CACHE_MAX_AGE seconds old (10 times the TTL by default).
+
+    Returns
+    -------
+    Optional[RightsCache]
+        the cache, None if it is disabled
+    """
+    ttl = current_app.config.get("RIGHTS_CACHE_TTL")
+    if not ttl:
+        return None
+    cache = current_app.extensions.get(RIGHTS_CACHE_KEY)
+    if cache is None:
+        cache = current_app.extensions[RIGHTS_CACHE_KEY] = RightsCache(
+            ttl,
+            current_app.config.get("RIGHTS_CACHE_MAX_SIZE", 100000),
+            current_app.config.get("RIGHTS_CACHE_MAX_AGE"),
+        )
+    return cache
+
+
+def clear_rights_cache() -> None:
+    """
+    Clear the rights cache of the current Flask app, if any.
+    """
+    if has_app_context() and RIGHTS_CACHE_KEY in current_app.extensions:
+        current_app.extensions[RIGHTS_CACHE_KEY].clear()
+
+
+_RIGHTS_MODELS = (User, CorRoles, UserApplicationRight, Profils)
+_RIGHTS_TABLES = frozenset(model.__table__ for model in _RIGHTS_MODELS)
+
+
+def changes_rights(statement) -> bool:
+    """
+    Return True if a statement inserts, updates or deletes rows of the
+    roles, groups, rights or profiles tables.
+    """
+    return statement.is_dml and getattr(statement, "table", None) in _RIGHTS_TABLES
+
+
+@sa.event.listens_for(db.session, "before_flush")
+def _track_rights_changes(session, flush_context, instances):
+    if any(
+        isinstance(obj, _RIGHTS_MODELS)
+        for obj in (*session.new, *session.dirty, *session.deleted)
+    ):
+        session.info[RIGHTS_CACHE_KEY] = True
+
+
+@sa.event.listens_for(db.session, "do_orm_execute")
+def _track_rights_statements(orm_execute_state):
+    # bulk updates and deletes, and Core statements run by the session
+    if changes_rights(orm_execute_state.statement):
+        orm_execute_state.session.info[RIGHTS_CACHE_KEY] = True
+        clear_rights_cache()
+
+
+@sa.event.listens_for(db.session, "after_flush")
+def _clear_after_flush(session, flush_context):
+    if session.info.get(RIGHTS_CACHE_KEY):
+        clear_rights_cache()
+
+
+@sa.event.listens_for(db.session, "after_commit")
+@sa.event.listens_for(db.session, "after_soft_rollback")
+def _clear_after_transaction(session, *args):
+    # levels may have been cached from uncommitted rows in between
+    if session.info.pop(RIGHTS_CACHE_KEY, False):
+        clear_rights_cache()
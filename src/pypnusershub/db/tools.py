@@ -6,7 +6,8 @@ from __future__ import unicode_literals, print_function, absolute_import, divisi
     DB tools not related to any model in particular.
 """
 import logging
-from datetime import datetime, timedelta
+import time
+import uuid
 
 from flask import current_app
 
@@ -16,6 +17,8 @@ from authlib.jose import JsonWebToken
 from authlib.jose.errors import ExpiredTokenError, JoseError
 
 from pypnusershub.db import models
+from pypnusershub.db.replica import read_bind_arguments
+from pypnusershub.keys import get_key_ring
 from pypnusershub.utils import text_resource_stream, get_current_app_id
 
 from pypnusershub.env import db
@@ -81,57 +84,151 @@ def load_fixtures(con_uri):
             engine.execute("COMMIT")
 
 
+# the signer holds no per-token state: it is built once and shared
+_jwt = JsonWebToken(["HS256"])
+
+
+def token_expiration():
+    """
+    Return the lifetime of the tokens issued by `encode_token`, in seconds.
+
+    ACCESS_TOKEN_EXPIRATION if set (short-lived access tokens, renewed with
+    a refresh token), COOKIE_EXPIRATION otherwise.
+    """
+    config = current_app.config
+    return config.get("ACCESS_TOKEN_EXPIRATION") or config["COOKIE_EXPIRATION"]
+
+
 def encode_token(payload):
-    expire = datetime.now() + timedelta(seconds=current_app.config["COOKIE_EXPIRATION"])
+    """
+    Sign a token, with the key ring (TOKEN_SIGNING_KEYS, see
+    `pypnusershub.keys`) if configured, with HS256 and SECRET_KEY otherwise.
+    """
+    issued_at = int(time.time())
+    expire = issued_at + token_expiration()
     header = {
         "alg": "HS256",
-        "exp": int(datetime.timestamp(expire)),
+        "exp": expire,
     }
-    jwt = JsonWebToken(["HS256"])
+    # the expiration is also a claim, so that decode_token refuses expired
+    # tokens; jti identifies the token in the revocation list
+    payload = {**payload, "iat": issued_at, "exp": expire, "jti": uuid.uuid4().hex}
+    key_ring = get_key_ring()
+    if key_ring is not None:
+        return key_ring.encode(header, payload)
     key = current_app.config["SECRET_KEY"].encode("UTF-8")
-    return jwt.encode(header, payload, key)
+    return _jwt.encode(header, payload, key)
+
+
+def decode_claims(payload, secret_key=None, key_ring=None):
+    """
+    Verify a token and return its validated claims, its header being
+    available as `claims.header`.
+
+    Without `secret_key` nor `key_ring`, those of the current app are used:
+    tokens are verified with its key ring if configured, and with SECRET_KEY
+    and HS256 unless TOKEN_ALLOW_HS256 is False.
+    """
+    if secret_key is None and key_ring is None:
+        config = current_app.config
+        key_ring = get_key_ring()
+        if key_ring is None or config.get("TOKEN_ALLOW_HS256", True):
+            secret_key = config["SECRET_KEY"]
+    if key_ring is not None:
+        claims = key_ring.decode(payload, secret_key)
+    else:
+        claims = _jwt.decode(payload, secret_key.encode("UTF-8"))
+    claims.validate()
+    return claims
 
 
-def decode_token(payload):
-    jwt = JsonWebToken(["HS256"])
-    key = current_app.config["SECRET_KEY"].encode("UTF-8")
-    claims = jwt.decode(payload, key)
-    claims.validate()
-    return dict(claims)
+def decode_token(payload, secret_key=None, key_ring=None):
+    return dict(decode_claims(payload, secret_key, key_ring))
 
 
 def user_to_token(user):
     return encode_token(user.as_dict())
 
 
+def check_token_application(data, id_application):
+    """
+    Check that a token was issued for the current application.
+
+    This prevents the use of a token of another application on the same
+    domain. Tokens are not checked if the current application is unknown, for
+    retro-compatibility reasons.
+
+    Raises
+    ------
+    UnreadableAccessRightsError
+        if the token was issued for another application
+    """
+    if id_application and data["id_application"] != id_application:
+        log.info("Invalid token: the token not corespoding to the current app")
+        raise UnreadableAccessRightsError("Token BadSignature", 403)
+
+
+def app_user_statement(data):
+    """
+    Select the `AppUser` matching the claims of a token, and the current
+    `security_stamp` of its user.
+    """
+    return (
+        sa.select(models.AppUser, models.User.security_stamp)
+        .join(models.User, models.User.id_role == models.AppUser.id_role)
+        .where(models.AppUser.id_role == data["id_role"])
+        .where(models.AppUser.id_application == data["id_application"])
+    )
+
+
+def token_revoked_clause(data):
+    """
+    Return whether a token is in `t_revoked_tokens`, for APIs without the
+    in-memory revocation list.
+    """
+    return (
+        sa.exists()
+        .where(models.RevokedToken.jti == data.get("jti"))
+        .where(models.RevokedToken.expires_at > sa.func.now())
+    )
+
+
+def check_token_stamp(data, security_stamp):
+    """
+    Check that a token was issued after the last change of the security
+    stamp of its user (password, activation, groups or rights). Tokens
+    without `security_stamp` claim predate it.
+
+    Raises
+    ------
+    UnreadableAccessRightsError
+        if the token is outdated
+    """
+    if "security_stamp" in data and data["security_stamp"] != security_stamp:
+        raise UnreadableAccessRightsError("Token outdated", 403)
+
+
 def user_from_token(token, secret_key=None):
     """Given a, authentification token, return the matching AppUser instance"""
-
-    secret_key = secret_key or current_app.config["SECRET_KEY"]
+    # models import this module
+    from pypnusershub.auth.revocation import is_token_revoked
 
     try:
-        data = decode_token(token)
-
-        id_role = data["id_role"]
-        id_app = data["id_application"]
-        id_app_from_config = get_current_app_id()
-        # check that the id_app from the token well corespond to the current_app id_application
-        # for prevent conflit of token between applications on the same domain
-        # if no ID_APP is passed to the app config, we don't check the conformiity of the token
-        # for retro-compatibility reasons
-        if id_app_from_config:
-            if id_app != id_app_from_config:
-                log.info("Invalid token: the token not corespoding to the current app")
-                raise UnreadableAccessRightsError("Token BadSignature", 403)
-        return db.session.execute(
-            sa.select(models.AppUser)
-            .where(models.AppUser.id_role == id_role)
-            .where(models.AppUser.id_application == id_app)
-        ).scalar_one()
+        data = decode_token(token, secret_key)
+        if is_token_revoked(data):
+            raise UnreadableAccessRightsError("Token revoked", 403)
+        check_token_application(data, get_current_app_id())
+        app_user, security_stamp = db.session.execute(
+            app_user_statement(data), bind_arguments=read_bind_arguments()
+        ).one()
+        check_token_stamp(data, security_stamp)
+        return app_user
 
     except NoResultFound:
         raise UnreadableAccessRightsError(
-            'No user withd id "{}" for app "{}"'.format(id_role, id_app)
+            'No user withd id "{}" for app "{}"'.format(
+                data["id_role"], data["id_application"]
+            )
         )
     except ExpiredTokenError:
         raise AccessRightsExpiredError("Token expired")
@@ -1,7 +1,7 @@
 from os import environ
 from importlib import import_module
 from flask_marshmallow import Marshmallow
-from flask_sqlalchemy import SQLAlchemy
+from pypnusershub.pool import PooledSQLAlchemy
 
 db_path = environ.get("FLASK_SQLALCHEMY_DB")
 if db_path:
@@ -9,7 +9,7 @@ if db_path:
     db_module = import_module(db_module_name)
     db = getattr(db_module, db_object_name)
 else:
-    db = SQLAlchemy()
+    db = PooledSQLAlchemy()
 
 marsmallow_path = environ.get("FLASK_MARSHMALLOW")
 if marsmallow_path:
@@ -0,0 +1,176 @@
+# coding: utf8
+
+"""
+Token introspection service.
+
+A minimal Flask application telling whether tokens are valid and the levels
+of their roles on applications, for services which do not need the routes,
+login manager and identity providers of the module.
+
+Tokens are verified with the shared signer of `pypnusershub.db.tools` and
+the in-memory revocation list, without database access. Levels of all the
+tokens of a request are computed with one query per application by
+`max_levels`, through the rights cache (RIGHTS_CACHE_TTL, 60 seconds by
+default in this service). A request lists at most INTROSPECT_MAX_BATCH_SIZE
+tokens and applications (100 by default).
+
+Run it with `python -m pypnusershub serve-introspect` or with any WSGI
+server, e.g.:
+
+    gunicorn 'pypnusershub.introspect:create_app()' --bind unix:/run/introspect.sock
+"""
+
+import time
+from typing import Dict, List, Mapping, Optional
+
+from authlib.jose.errors import JoseError
+from flask import Blueprint, Flask, current_app, jsonify, request
+from werkzeug.exceptions import BadRequest
+
+from pypnusershub.auth.revocation import is_token_revoked
+from pypnusershub.db.rights import max_levels, resolve_application
+from pypnusershub.db.tools import decode_claims
+from pypnusershub.env import db
+
+introspect = Blueprint("introspect", __name__)
+
+
+def introspect_token(token: str) -> Optional[dict]:
+    """
+    Verify a token and return the claims describing its role, None if the
+    token is invalid or expired.
+    """
+    try:
+        claims = decode_claims(token)
+    except (JoseError, ValueError):
+        return None
+    # older tokens only carry their expiration in the header
+    exp = claims.get("exp", claims.header.get("exp"))
+    if exp is not None and exp < time.time():
+        return None
+    if is_token_revoked(claims):
+        return None
+    return {
+        "active": True,
+        "id_role": claims.get("id_role"),
+        "identifiant": claims.get("identifiant"),
+        "id_application": claims.get("id_application"),
+        "exp": exp,
+    }
+
+
+def _string_list(values, name: str) -> List[str]:
+    if not isinstance(values, list) or not all(
+        isinstance(value, str) for value in values
+    ):
+        raise BadRequest(f"{name} must be a list of strings")
+    max_size = current_app.config.get("INTROSPECT_MAX_BATCH_SIZE", 100)
+    if len(values) > max_size:
+        raise BadRequest(f"At most {max_size} {name} per request")
+    return values
+
+
+def _application_codes(payload: dict) -> List[str]:
+    if "applications" in payload:
+        codes = _string_list(payload["applications"], "applications")
+    elif "applications" in request.values:
+        codes = _string_list(
+            [code for code in request.values["applications"].split(",") if code],
+            "applications",
+        )
+    else:
+        default = current_app.config.get("CODE_APPLICATION")
+        codes = [default] if default else []
+    return codes
+
+
+def _applications(codes: List[str]) -> Dict[str, int]:
+    applications = {}
+    for code in codes:
+        applications[code] = resolve_application(code)
+        if applications[code] is None:
+            raise BadRequest(f"Unknown application {code}")
+    return applications
+
+
+def _tokens(payload: dict) -> List[str]:
+    if "tokens" in payload:
+        return _string_list(payload["tokens"], "tokens")
+    token = payload.get("token") or request.values.get("token")
+    if token is not None and not isinstance(token, str):
+        raise BadRequest("token must be a string")
+    if token is None:
+        authorization = request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer ") :]
+    if not token:
+        raise BadRequest("Missing token")
+    return [token]
+
+
+@introspect.route("/introspect", methods=["GET", "POST"])
+def introspect_tokens():
+    """
+    Introspect tokens.
+
+    The token is given by the `token` parameter (query string, form or
+    JSON) or the Authorization header. A JSON `tokens` list introspects
+    several tokens at once. `applications` (JSON list or comma separated
+    codes, CODE_APPLICATION by default) lists the applications whose levels
+    are returned.
+
+    Malformed requests, or requests listing more than
+    INTROSPECT_MAX_BATCH_SIZE tokens or applications, get a 400 error.
+
+    Returns `{"active": false}` for an invalid or expired token, and
+    otherwise `{"active": true, "id_role", "identifiant", "id_application",
+    "exp", "levels": {code: level}}`. Several tokens are answered with
+    `{"results": [...]}`, in the order of the request.
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {}
+    elif not isinstance(payload, dict):
+        raise BadRequest("The JSON body must be an object")
+    tokens = _tokens(payload)
+    codes = _application_codes(payload)
+    results = [introspect_token(token) or {"active": False} for token in tokens]
+    id_roles = {result["id_role"] for result in results if result["active"]}
+    # invalid tokens are answered without any database access
+    if id_roles:
+        levels = {
+            code: max_levels(id_roles, id_application)
+            for code, id_application in _applications(codes).items()
+        }
+        for result in results:
+            if result["active"]:
+                result["levels"] = {
+                    code: levels_by_role[result["id_role"]]
+                    for code, levels_by_role in levels.items()
+                }
+    if "tokens" in payload:
+        return jsonify({"results": results})
+    return jsonify(results[0])
+
+
+def create_app(
+    config: Optional[Mapping] = None, config_file: Optional[str] = None
+) -> Flask:
+    """
+    Create the introspection application.
+
+    The configuration is read from `config_file`, or the file named by the
+    USERSHUB_AUTH_MODULE_SETTINGS environment variable, then from `config`.
+    SQLALCHEMY_DATABASE_URI and SECRET_KEY are required.
+    """
+    app = Flask("pypnusershub.introspect")
+    if config_file:
+        app.config.from_pyfile(config_file)
+    else:
+        app.config.from_envvar("USERSHUB_AUTH_MODULE_SETTINGS", silent=True)
+    if config:
+        app.config.update(config)
+    app.config.setdefault("RIGHTS_CACHE_TTL", 60)
+    db.init_app(app)
+    app.register_blueprint(introspect)
+    return app
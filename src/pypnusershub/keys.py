@@ -0,0 +1,151 @@
+"""
+Asymmetric keys signing the tokens.
+
+By default tokens are signed with HS256 and SECRET_KEY, so every service
+verifying them must know the secret. With TOKEN_SIGNING_KEYS, tokens are
+signed with a private key (RSA, EC P-256 or Ed25519) and other services
+verify them offline with the public keys published on the `/jwks.json`
+route.
+
+The first key of TOKEN_SIGNING_KEYS signs the tokens, the following ones
+only verify them: to rotate keys, put the new private key first and keep
+the former one until the tokens it signed have expired. Each key is
+identified by the `kid` header of the tokens, its RFC 7638 thumbprint.
+"""
+
+from typing import Dict, Iterable, Mapping, Optional, Union
+
+from authlib.jose import JsonWebKey, JsonWebToken
+from authlib.jose.errors import DecodeError
+from flask import current_app
+
+KEY_RING_KEY = "pypnusershub_key_ring"
+
+# algorithm used by default for each type of key
+DEFAULT_ALGORITHMS = {"RSA": "RS256", "EC": "ES256", "OKP": "EdDSA"}
+
+KeySource = Union[str, bytes, dict]
+
+
+def load_key(source: KeySource):
+    """
+    Load a key from the path of a PEM file, a PEM string or a JWK dict.
+    """
+    if isinstance(source, str) and not source.lstrip().startswith("-----BEGIN"):
+        with open(source, "rb") as key_file:
+            source = key_file.read()
+    return JsonWebKey.import_key(source)
+
+
+class KeyRing:
+    """
+    Keys signing and verifying the tokens.
+
+    Parameters
+    ----------
+    keys : Iterable
+        keys, as paths of PEM files, PEM strings or JWK dicts. The first one
+        must be a private key and signs the tokens; the others, public or
+        private, only verify them.
+    algorithm : str, optional
+        algorithm of the signing key, deduced from its type by default
+        (RS256, ES256 or EdDSA)
+    """
+
+    def __init__(self, keys: Iterable[KeySource], algorithm: Optional[str] = None):
+        self.keys: Dict[str, object] = {}
+        self.algorithms: Dict[str, str] = {}
+        for source in keys:
+            key = load_key(source)
+            kid = key.thumbprint()
+            self.keys[kid] = key
+            self.algorithms[kid] = DEFAULT_ALGORITHMS[key.kty]
+        if not self.keys:
+            raise ValueError("The key ring requires at least one key")
+        self.signing_kid = next(iter(self.keys))
+        self.signing_key = self.keys[self.signing_kid]
+        if self.signing_key.public_only:
+            raise ValueError("The first key of the key ring must be a private key")
+        if algorithm:
+            self.algorithms[self.signing_kid] = algorithm
+        self.algorithm = self.algorithms[self.signing_kid]
+        algorithms = sorted(set(self.algorithms.values()))
+        self._jwt = JsonWebToken(algorithms)
+        # tokens signed with a secret key, see `decode`
+        self._jwt_with_secret = JsonWebToken(algorithms + ["HS256"])
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> Optional["KeyRing"]:
+        """
+        Build the key ring from TOKEN_SIGNING_KEYS and TOKEN_SIGNING_ALGORITHM,
+        None if no key is configured.
+        """
+        keys = config.get("TOKEN_SIGNING_KEYS")
+        if not keys:
+            return None
+        return cls(keys, config.get("TOKEN_SIGNING_ALGORITHM"))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def encode(self, header: dict, payload: dict) -> bytes:
+        """
+        Sign a token with the signing key, adding `alg` and `kid` to its
+        header.
+        """
+        header = {**header, "alg": self.algorithm, "kid": self.signing_kid}
+        return self._jwt.encode(header, payload, self.signing_key)
+
+    def decode(self, token: Union[str, bytes], secret_key: Optional[str] = None):
+        """
+        Verify a token with the key named by its `kid` header and return its
+        claims, not yet validated.
+
+        Parameters
+        ----------
+        token : str or bytes
+            the token
+        secret_key : str, optional
+            also accept tokens signed with this key and HS256 (tokens issued
+            before the key ring was configured)
+
+        Raises
+        ------
+        authlib.jose.errors.JoseError
+            if the token is invalid, or its key or algorithm unknown
+        """
+
+        def find_key(header, payload):
+            if header["alg"] == "HS256" and secret_key:
+                return secret_key.encode("UTF-8")
+            kid = header.get("kid")
+            # a key only verifies tokens of its own algorithm
+            if kid not in self.keys or self.algorithms[kid] != header["alg"]:
+                raise DecodeError("Unknown signing key")
+            return self.keys[kid]
+
+        jwt = self._jwt_with_secret if secret_key else self._jwt
+        return jwt.decode(token, find_key)
+
+    def jwks(self) -> dict:
+        """
+        Return the public keys as a JSON Web Key Set.
+        """
+        return {
+            "keys": [
+                key.as_dict(
+                    is_private=False, kid=kid, alg=self.algorithms[kid], use="sig"
+                )
+                for kid, key in self.keys.items()
+            ]
+        }
+
+
+def get_key_ring() -> Optional[KeyRing]:
+    """
+    Return the key ring of the current Flask app, loaded from its
+    configuration on first use, None if TOKEN_SIGNING_KEYS is not set.
+    """
+    if KEY_RING_KEY not in current_app.extensions:
+        current_app.extensions[KEY_RING_KEY] = KeyRing.from_config(current_app.config)
+    return current_app.extensions[KEY_RING_KEY]
@@ -1,24 +1,222 @@
-from flask import current_app, g
-from flask.sessions import SecureCookieSessionInterface
+import time
+from datetime import datetime, timedelta
 
-from flask_login import LoginManager
+from flask import current_app, g, request, session
+
+from flask_login import LoginManager, current_user
+from flask_login.config import (
+    COOKIE_DURATION,
+    COOKIE_HTTPONLY,
+    COOKIE_NAME,
+    COOKIE_SAMESITE,
+    COOKIE_SECURE,
+)
+from flask_login.signals import user_loaded_from_cookie
 from authlib.jose.errors import ExpiredTokenError, JoseError
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy.orm import make_transient_to_detached
 
 from pypnusershub.db.models import User
 from pypnusershub.db.tools import decode_token
 
 from pypnusershub.env import db
+from pypnusershub.sessions import DigestSessionInterface
+
+# columns of User read from trusted tokens, the others are loaded on access
+TOKEN_USER_FIELDS = (
+    "id_role",
+    "uuid_role",
+    "groupe",
+    "identifiant",
+    "nom_role",
+    "prenom_role",
+    "email",
+    "id_organisme",
+    "active",
+    "security_stamp",
+)
+
+
+def is_short_lived(claims):
+    """
+    Tell if a token is a short-lived access token (ACCESS_TOKEN_EXPIRATION),
+    whose claims can be trusted without reading the database.
+    """
+    lifetime = current_app.config.get("ACCESS_TOKEN_EXPIRATION")
+    return bool(
+        lifetime
+        and "iat" in claims
+        and "exp" in claims
+        and claims["exp"] - claims["iat"] <= lifetime
+    )
+
+
+def user_from_claims(claims):
+    """
+    Build the user of a trusted token without querying the database.
+
+    The user is attached to the session as if it had been loaded; columns
+    missing from the token are loaded if they are accessed.
+    """
+    user = User(
+        **{field: claims[field] for field in TOKEN_USER_FIELDS if field in claims}
+    )
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def remember_cookie_duration():
+    duration = current_app.config.get("REMEMBER_COOKIE_DURATION", COOKIE_DURATION)
+    if isinstance(duration, timedelta):
+        return duration
+    return timedelta(seconds=duration)
+
+
+def _remember_serializer():
+    return URLSafeTimedSerializer(
+        current_app.config["SECRET_KEY"], salt="pypnusershub-remember"
+    )
+
+
+def remember_claims():
+    """
+    Return the claims of the remember cookie of the request, None if it is
+    missing, invalid, expired or of the former Flask-Login format.
+
+    The cookie carries the identity of the user (TOKEN_USER_FIELDS, its
+    security stamp included) and `iat`, the time the user was last read
+    from the database.
+    """
+    if "remember_claims" not in g:
+        claims = None
+        cookie = request.cookies.get(
+            current_app.config.get("REMEMBER_COOKIE_NAME", COOKIE_NAME)
+        )
+        if cookie:
+            try:
+                claims = _remember_serializer().loads(
+                    cookie, max_age=remember_cookie_duration().total_seconds()
+                )
+            except BadSignature:
+                pass
+        g.remember_claims = claims
+    return g.remember_claims
+
 
-login_manager = LoginManager()
+def is_validated(claims):
+    """
+    Tell if the claims of a remember cookie were read from the database less
+    than REMEMBER_COOKIE_REVALIDATE_INTERVAL seconds ago (5 minutes by
+    default), and can be trusted without reading it again.
+    """
+    interval = current_app.config.get("REMEMBER_COOKIE_REVALIDATE_INTERVAL", 300)
+    return time.time() - claims["iat"] < interval
+
+
+class RememberCookieLoginManager(LoginManager):
+    """
+    Login manager whose remember cookie is signed and self-describing.
+
+    Flask-Login's cookie only holds the user id, so every request loads the
+    user from the database. This cookie also carries the identity of the
+    user and its security stamp: the user is built from it, and the cookie
+    renewed, without database access. Every
+    REMEMBER_COOKIE_REVALIDATE_INTERVAL seconds, the user is read again and
+    the cookie refused if their security stamp changed (password,
+    activation, groups or rights).
+    """
+
+    def _load_user_from_remember_cookie(self, cookie):
+        claims = remember_claims()
+        if claims is None:
+            # cookie of the former format, issued again by `load_user`
+            return super()._load_user_from_remember_cookie(cookie)
+        session["_user_id"] = str(claims["id_role"])
+        session["_fresh"] = False
+        user = self._user_callback(session["_user_id"])
+        if user is not None:
+            app = current_app._get_current_object()
+            user_loaded_from_cookie.send(app, user=user)
+        return user
+
+    def encode_remember_cookie(self, user):
+        claims = remember_claims()
+        if (
+            claims is not None
+            and str(claims["id_role"]) == str(user.id_role)
+            and is_validated(claims)
+        ):
+            # renewal: the user was not read from the database
+            validated_at = claims["iat"]
+        else:
+            validated_at = int(time.time())
+        return _remember_serializer().dumps(
+            {
+                **{field: getattr(user, field) for field in TOKEN_USER_FIELDS},
+                "iat": validated_at,
+            }
+        )
+
+    def _set_cookie(self, response):
+        config = current_app.config
+        if "_remember_seconds" in session:
+            duration = timedelta(seconds=session["_remember_seconds"])
+        else:
+            duration = remember_cookie_duration()
+        user = current_user._get_current_object()
+        if not user.is_authenticated:
+            return
+        response.set_cookie(
+            config.get("REMEMBER_COOKIE_NAME", COOKIE_NAME),
+            value=self.encode_remember_cookie(user),
+            expires=datetime.utcnow() + duration,
+            domain=config.get("REMEMBER_COOKIE_DOMAIN"),
+            path=config.get("REMEMBER_COOKIE_PATH", "/"),
+            secure=config.get("REMEMBER_COOKIE_SECURE", COOKIE_SECURE),
+            httponly=config.get("REMEMBER_COOKIE_HTTPONLY", COOKIE_HTTPONLY),
+            samesite=config.get("REMEMBER_COOKIE_SAMESITE", COOKIE_SAMESITE),
+        )
+
+
+login_manager = RememberCookieLoginManager()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, user_id)
+    claims = remember_claims()
+    if claims is None or str(claims["id_role"]) != str(user_id):
+        user = db.session.get(User, user_id)
+        config = current_app.config
+        if user is not None and config.get("REMEMBER_COOKIE_NAME", COOKIE_NAME) in (
+            request.cookies
+        ):
+            # remember cookie of the former format
+            session["_remember"] = "set"
+        return user
+    if is_validated(claims):
+        return user_from_claims(claims)
+    user = db.session.get(User, user_id)
+    if (
+        user is None
+        or not user.active
+        or user.security_stamp != claims.get("security_stamp")
+    ):
+        # the user is logged out, from the session as well
+        session.pop("_user_id", None)
+        session.pop("_fresh", None)
+        session["_remember"] = "clear"
+        return None
+    # the cookie is issued again with the new validation time
+    g.remember_claims = None
+    session["_remember"] = "set"
+    return user
 
 
 @login_manager.request_loader
 def load_user_from_request(request):
+    # the auth package imports this module
+    from pypnusershub.auth.revocation import is_token_revoked
+
     bearer = request.headers.get("Authorization", default=None, type=str)
     if bearer:
         jwt = bearer.replace("Bearer ", "")
@@ -26,17 +224,27 @@ def load_user_from_request(request):
         return None
     try:
         user_dict = decode_token(jwt)
-        user = db.session.get(User, user_dict["id_role"])
+        if is_token_revoked(user_dict):
+            return None
+        if is_short_lived(user_dict):
+            user = user_from_claims(user_dict)
+        else:
+            user = db.session.get(User, user_dict["id_role"])
+            # tokens issued before a password, activation or rights change
+            if (
+                user is not None
+                and "security_stamp" in user_dict
+                and user.security_stamp != user_dict["security_stamp"]
+            ):
+                return None
         g.login_via_request = True
         return user
     except (ExpiredTokenError, JoseError):
         return None
 
 
-class CustomSessionInterface(SecureCookieSessionInterface):
-    """Prevent creating session from API requests."""
-
-    def save_session(self, *args, **kwargs):
-        if g.get("login_via_request"):
-            return
-        return super(CustomSessionInterface, self).save_session(*args, **kwargs)
+class CustomSessionInterface(DigestSessionInterface):
+    """
+    Prevent creating session from API requests, and skip unchanged
+    sessions (see `pypnusershub.sessions.DigestSessionInterface`).
+    """
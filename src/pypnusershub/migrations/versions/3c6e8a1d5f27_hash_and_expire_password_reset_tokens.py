@@ -0,0 +1,65 @@
+"""hash and expire password reset tokens
+
+Revision ID: 3c6e8a1d5f27
+Revises: ad2e110523f9
+Create Date: 2026-10-19 10:02:47.518204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3c6e8a1d5f27"
+down_revision = "ad2e110523f9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "cor_role_token",
+        sa.Column(
+            "expires_at",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.text("now() + interval '1 day'"),
+        ),
+        schema="utilisateurs",
+    )
+    op.add_column(
+        "cor_role_token",
+        sa.Column("used", sa.Boolean, nullable=False, server_default=sa.false()),
+        schema="utilisateurs",
+    )
+    # Only the SHA-256 digest of a token is stored from now on
+    op.execute(
+        """
+        UPDATE utilisateurs.cor_role_token
+        SET token = encode(sha256(convert_to(token, 'UTF8')), 'hex')
+        WHERE token IS NOT NULL
+        """
+    )
+    op.create_index(
+        "i_cor_role_token_token",
+        "cor_role_token",
+        ["token"],
+        unique=True,
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_cor_role_token_expires_at",
+        "cor_role_token",
+        ["expires_at"],
+        schema="utilisateurs",
+    )
+
+
+def downgrade():
+    op.drop_index("i_cor_role_token_expires_at", schema="utilisateurs")
+    op.drop_index("i_cor_role_token_token", schema="utilisateurs")
+    # Hashed tokens cannot be used anymore by the previous version
+    op.execute("DELETE FROM utilisateurs.cor_role_token")
+    op.drop_column("cor_role_token", "used", schema="utilisateurs")
+    op.drop_column("cor_role_token", "expires_at", schema="utilisateurs")
@@ -0,0 +1,220 @@
+"""add cor_roles_closure, the transitive closure of group membership
+
+Revision ID: 7d4e2b9c1a83
+Revises: 3c6e8a1d5f27
+Create Date: 2026-10-19 11:24:05.731942
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7d4e2b9c1a83"
+down_revision = "3c6e8a1d5f27"
+branch_labels = None
+depends_on = None
+
+
+ROLESLIST_VIEW_COLUMNS = """
+    a.groupe,
+    a.active,
+    a.id_role,
+    a.identifiant,
+    a.nom_role,
+    a.prenom_role,
+    a.desc_role,
+    a.pass,
+    a.pass_plus,
+    a.email,
+    a.id_organisme,
+    a.organisme,
+    a.id_unite,
+    a.remarques,
+    a.date_insert,
+    a.date_update,
+    max(a.id_droit) AS id_droit_max,
+    a.id_application
+"""
+
+ROLESLIST_VIEW_GROUP_BY = """
+  WHERE a.active = true
+  GROUP BY a.groupe, a.active, a.id_role, a.identifiant, a.nom_role, a.prenom_role, a.desc_role, a.pass, a.pass_plus, a.email, a.id_organisme, a.organisme, a.id_unite, a.remarques, a.date_insert, a.date_update, a.id_application;
+"""
+
+ROLE_COLUMNS = """
+            u.groupe,
+            u.id_role,
+            u.identifiant,
+            u.nom_role,
+            u.prenom_role,
+            u.desc_role,
+            u.pass,
+            u.pass_plus,
+            u.email,
+            u.id_organisme,
+            u.active,
+            o.nom_organisme AS organisme,
+            0 AS id_unite,
+            u.remarques,
+            u.date_insert,
+            u.date_update,
+            c.id_profil AS id_droit,
+            c.id_application
+"""
+
+
+def upgrade():
+    op.create_table(
+        "cor_roles_closure",
+        sa.Column(
+            "id_role_ancestor",
+            sa.Integer,
+            sa.ForeignKey(
+                "utilisateurs.t_roles.id_role", onupdate="CASCADE", ondelete="CASCADE"
+            ),
+            primary_key=True,
+        ),
+        sa.Column(
+            "id_role_descendant",
+            sa.Integer,
+            sa.ForeignKey(
+                "utilisateurs.t_roles.id_role", onupdate="CASCADE", ondelete="CASCADE"
+            ),
+            primary_key=True,
+        ),
+        sa.Column("depth", sa.Integer, nullable=False),
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_cor_roles_closure_descendant",
+        "cor_roles_closure",
+        ["id_role_descendant", "id_role_ancestor", "depth"],
+        schema="utilisateurs",
+    )
+    op.execute(
+        """
+        COMMENT ON TABLE utilisateurs.cor_roles_closure IS
+        'Fermeture transitive de cor_roles : chaque role est relié à lui-même (depth = 0) et à tous ses groupes, directs ou imbriqués. Table maintenue par triggers.';
+
+        CREATE FUNCTION utilisateurs.fct_refresh_roles_closure(roles integer[])
+        RETURNS void AS
+        $$
+        BEGIN
+            DELETE FROM utilisateurs.cor_roles_closure
+            WHERE id_role_descendant = ANY(roles);
+
+            INSERT INTO utilisateurs.cor_roles_closure (id_role_ancestor, id_role_descendant, depth)
+            WITH RECURSIVE ancestors (id_role_descendant, id_role_ancestor, depth, path) AS (
+                SELECT r.id_role, r.id_role, 0, ARRAY[r.id_role]
+                FROM utilisateurs.t_roles r
+                WHERE r.id_role = ANY(roles)
+              UNION ALL
+                SELECT a.id_role_descendant, g.id_role_groupe, a.depth + 1, a.path || g.id_role_groupe
+                FROM ancestors a
+                JOIN utilisateurs.cor_roles g ON g.id_role_utilisateur = a.id_role_ancestor
+                -- stop on membership cycles
+                WHERE NOT g.id_role_groupe = ANY(a.path)
+            )
+            SELECT id_role_ancestor, id_role_descendant, min(depth)
+            FROM ancestors
+            GROUP BY id_role_ancestor, id_role_descendant;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION utilisateurs.fct_trg_refresh_roles_closure()
+        RETURNS trigger AS
+        $$
+        DECLARE
+            changed_roles integer[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                changed_roles := ARRAY[NEW.id_role_utilisateur];
+            ELSIF TG_OP = 'DELETE' THEN
+                changed_roles := ARRAY[OLD.id_role_utilisateur];
+            ELSE
+                changed_roles := ARRAY[OLD.id_role_utilisateur, NEW.id_role_utilisateur];
+            END IF;
+            -- the role and every role below it get new ancestors
+            PERFORM utilisateurs.fct_refresh_roles_closure(
+                array_agg(DISTINCT d.id_role)
+            )
+            FROM (
+                SELECT unnest(changed_roles) AS id_role
+                UNION
+                SELECT id_role_descendant
+                FROM utilisateurs.cor_roles_closure
+                WHERE id_role_ancestor = ANY(changed_roles)
+            ) d;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION utilisateurs.fct_trg_insert_role_closure()
+        RETURNS trigger AS
+        $$
+        BEGIN
+            INSERT INTO utilisateurs.cor_roles_closure (id_role_ancestor, id_role_descendant, depth)
+            VALUES (NEW.id_role, NEW.id_role, 0);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER tri_refresh_roles_closure
+        AFTER INSERT OR UPDATE OR DELETE ON utilisateurs.cor_roles
+        FOR EACH ROW EXECUTE PROCEDURE utilisateurs.fct_trg_refresh_roles_closure();
+
+        CREATE TRIGGER tri_insert_role_closure
+        AFTER INSERT ON utilisateurs.t_roles
+        FOR EACH ROW EXECUTE PROCEDURE utilisateurs.fct_trg_insert_role_closure();
+
+        SELECT utilisateurs.fct_refresh_roles_closure(array_agg(id_role))
+        FROM utilisateurs.t_roles;
+        """
+    )
+    op.execute(
+        f"""
+        CREATE OR REPLACE VIEW utilisateurs.v_roleslist_forall_applications AS
+        SELECT {ROLESLIST_VIEW_COLUMNS}
+        FROM ( SELECT {ROLE_COLUMNS}
+           FROM utilisateurs.t_roles u
+             JOIN utilisateurs.cor_roles_closure cl ON cl.id_role_descendant = u.id_role
+             JOIN utilisateurs.cor_role_app_profil c ON c.id_role = cl.id_role_ancestor
+             LEFT JOIN utilisateurs.bib_organismes o ON o.id_organisme = u.id_organisme
+          ) a
+        {ROLESLIST_VIEW_GROUP_BY}
+        """
+    )
+
+
+def downgrade():
+    op.execute(
+        f"""
+        CREATE OR REPLACE VIEW utilisateurs.v_roleslist_forall_applications AS
+        SELECT {ROLESLIST_VIEW_COLUMNS}
+        FROM ( SELECT {ROLE_COLUMNS}
+           FROM utilisateurs.t_roles u
+             JOIN utilisateurs.cor_role_app_profil c ON c.id_role = u.id_role
+             LEFT JOIN utilisateurs.bib_organismes o ON o.id_organisme = u.id_organisme
+        UNION
+         SELECT {ROLE_COLUMNS}
+           FROM utilisateurs.t_roles u
+             JOIN utilisateurs.cor_roles g ON g.id_role_utilisateur = u.id_role OR g.id_role_groupe = u.id_role
+             JOIN utilisateurs.cor_role_app_profil c ON c.id_role = g.id_role_groupe
+             LEFT JOIN utilisateurs.bib_organismes o ON o.id_organisme = u.id_organisme
+          ) a
+        {ROLESLIST_VIEW_GROUP_BY}
+        """
+    )
+    op.execute(
+        """
+        DROP TRIGGER tri_insert_role_closure ON utilisateurs.t_roles;
+        DROP TRIGGER tri_refresh_roles_closure ON utilisateurs.cor_roles;
+        DROP FUNCTION utilisateurs.fct_trg_insert_role_closure();
+        DROP FUNCTION utilisateurs.fct_trg_refresh_roles_closure();
+        DROP FUNCTION utilisateurs.fct_refresh_roles_closure(integer[]);
+        """
+    )
+    op.drop_index("i_cor_roles_closure_descendant", schema="utilisateurs")
+    op.drop_table("cor_roles_closure", schema="utilisateurs")
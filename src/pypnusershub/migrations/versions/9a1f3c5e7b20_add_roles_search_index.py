@@ -0,0 +1,73 @@
+"""add trigram and prefix indexes for the search of roles by name
+
+Revision ID: 9a1f3c5e7b20
+Revises: 7d4e2b9c1a83
+Create Date: 2026-10-19 14:08:52.190385
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9a1f3c5e7b20"
+down_revision = "7d4e2b9c1a83"
+branch_labels = None
+depends_on = None
+
+
+def extension_schema(name):
+    return (
+        op.get_bind()
+        .execute(
+            sa.text(
+                "SELECT extnamespace::regnamespace::text FROM pg_extension WHERE extname = :name"
+            ),
+            {"name": name},
+        )
+        .scalar_one()
+    )
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+    unaccent_schema = extension_schema("unaccent")
+    trgm_schema = extension_schema("pg_trgm")
+    # unaccent() is only STABLE: the dictionary is given explicitly so the
+    # wrapper can be declared IMMUTABLE and used in indexes
+    op.execute(
+        f"""
+        CREATE FUNCTION utilisateurs.fct_unaccent(text)
+        RETURNS text AS
+        $$
+            SELECT {unaccent_schema}.unaccent('{unaccent_schema}.unaccent'::regdictionary, $1)
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT;
+
+        CREATE FUNCTION utilisateurs.fct_role_search_text(nom_role text, prenom_role text)
+        RETURNS text AS
+        $$
+            SELECT utilisateurs.fct_unaccent(
+                lower(coalesce(nom_role, '') || ' ' || coalesce(prenom_role, ''))
+            )
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+        CREATE INDEX i_t_roles_search_trgm ON utilisateurs.t_roles
+        USING gin (utilisateurs.fct_role_search_text(nom_role, prenom_role) {trgm_schema}.gin_trgm_ops);
+
+        CREATE INDEX i_t_roles_search_prefix ON utilisateurs.t_roles
+        (utilisateurs.fct_role_search_text(nom_role, prenom_role) text_pattern_ops);
+        """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+        DROP INDEX utilisateurs.i_t_roles_search_prefix;
+        DROP INDEX utilisateurs.i_t_roles_search_trgm;
+        DROP FUNCTION utilisateurs.fct_role_search_text(text, text);
+        DROP FUNCTION utilisateurs.fct_unaccent(text);
+        """
+    )
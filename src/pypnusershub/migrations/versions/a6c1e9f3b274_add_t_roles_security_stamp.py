@@ -0,0 +1,131 @@
+"""add t_roles.security_stamp, bumped when the user's security state changes
+
+Revision ID: a6c1e9f3b274
+Revises: e2b7f04a9c35
+Create Date: 2026-10-19 19:06:48.215930
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a6c1e9f3b274"
+down_revision = "e2b7f04a9c35"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "t_roles",
+        sa.Column("security_stamp", sa.Integer, nullable=False, server_default="0"),
+        schema="utilisateurs",
+    )
+    op.execute(
+        """
+        COMMENT ON COLUMN utilisateurs.t_roles.security_stamp IS
+        'Version de l''état de sécurité du role, incrémentée par triggers lorsque son mot de passe, son activation, son identifiant, son organisme, ses groupes ou ses droits (directs ou hérités de ses groupes) changent.';
+
+        CREATE FUNCTION utilisateurs.fct_bump_security_stamps(roles integer[])
+        RETURNS void AS
+        $$
+        BEGIN
+            -- members of a group get the rights of the group
+            UPDATE utilisateurs.t_roles r
+            SET security_stamp = r.security_stamp + 1
+            FROM (
+                SELECT DISTINCT id_role_descendant
+                FROM utilisateurs.cor_roles_closure
+                WHERE id_role_ancestor = ANY(roles)
+            ) d
+            WHERE r.id_role = d.id_role_descendant;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION utilisateurs.fct_trg_bump_role_security_stamp()
+        RETURNS trigger AS
+        $$
+        BEGIN
+            IF (NEW.pass, NEW.pass_plus, NEW.active, NEW.identifiant, NEW.groupe, NEW.id_organisme)
+                IS DISTINCT FROM
+                (OLD.pass, OLD.pass_plus, OLD.active, OLD.identifiant, OLD.groupe, OLD.id_organisme)
+            THEN
+                NEW.security_stamp := OLD.security_stamp + 1;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION utilisateurs.fct_trg_bump_security_stamps()
+        RETURNS trigger AS
+        $$
+        DECLARE
+            changed_roles integer[];
+        BEGIN
+            IF TG_TABLE_NAME = 'cor_roles' THEN
+                IF TG_OP = 'INSERT' THEN
+                    changed_roles := ARRAY[NEW.id_role_utilisateur];
+                ELSIF TG_OP = 'DELETE' THEN
+                    changed_roles := ARRAY[OLD.id_role_utilisateur];
+                ELSE
+                    changed_roles := ARRAY[OLD.id_role_utilisateur, NEW.id_role_utilisateur];
+                END IF;
+            ELSE
+                IF TG_OP = 'INSERT' THEN
+                    changed_roles := ARRAY[NEW.id_role];
+                ELSIF TG_OP = 'DELETE' THEN
+                    changed_roles := ARRAY[OLD.id_role];
+                ELSE
+                    changed_roles := ARRAY[OLD.id_role, NEW.id_role];
+                END IF;
+            END IF;
+            PERFORM utilisateurs.fct_bump_security_stamps(changed_roles);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER tri_bump_role_security_stamp
+        BEFORE UPDATE ON utilisateurs.t_roles
+        FOR EACH ROW EXECUTE PROCEDURE utilisateurs.fct_trg_bump_role_security_stamp();
+
+        -- date_update is not changed when only the stamp is bumped, e.g. for
+        -- the members of a group whose rights changed
+        DROP TRIGGER tri_modify_date_update_t_roles ON utilisateurs.t_roles;
+        CREATE TRIGGER tri_modify_date_update_t_roles
+        BEFORE UPDATE ON utilisateurs.t_roles
+        FOR EACH ROW
+        WHEN (
+            NEW.security_stamp IS NOT DISTINCT FROM OLD.security_stamp
+            OR to_jsonb(NEW) - 'security_stamp' IS DISTINCT FROM to_jsonb(OLD) - 'security_stamp'
+        )
+        EXECUTE PROCEDURE utilisateurs.modify_date_update();
+
+        CREATE TRIGGER tri_bump_security_stamps
+        AFTER INSERT OR UPDATE OR DELETE ON utilisateurs.cor_roles
+        FOR EACH ROW EXECUTE PROCEDURE utilisateurs.fct_trg_bump_security_stamps();
+
+        CREATE TRIGGER tri_bump_security_stamps
+        AFTER INSERT OR UPDATE OR DELETE ON utilisateurs.cor_role_app_profil
+        FOR EACH ROW EXECUTE PROCEDURE utilisateurs.fct_trg_bump_security_stamps();
+        """
+    )
+
+
+def downgrade():
+    op.execute(
+        """
+        DROP TRIGGER tri_bump_security_stamps ON utilisateurs.cor_role_app_profil;
+        DROP TRIGGER tri_bump_security_stamps ON utilisateurs.cor_roles;
+        DROP TRIGGER tri_modify_date_update_t_roles ON utilisateurs.t_roles;
+        CREATE TRIGGER tri_modify_date_update_t_roles
+        BEFORE UPDATE ON utilisateurs.t_roles
+        FOR EACH ROW EXECUTE PROCEDURE utilisateurs.modify_date_update();
+        DROP TRIGGER tri_bump_role_security_stamp ON utilisateurs.t_roles;
+        DROP FUNCTION utilisateurs.fct_trg_bump_security_stamps();
+        DROP FUNCTION utilisateurs.fct_trg_bump_role_security_stamp();
+        DROP FUNCTION utilisateurs.fct_bump_security_stamps(integer[]);
+        """
+    )
+    op.drop_column("t_roles", "security_stamp", schema="utilisateurs")
@@ -0,0 +1,48 @@
+"""add date_insert to cor_role_token and indexes used by the purge
+
+Revision ID: ad2e110523f9
+Revises: b3dec57f13d8
+Create Date: 2026-10-19 09:12:31.412870
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "ad2e110523f9"
+down_revision = "b3dec57f13d8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "cor_role_token",
+        sa.Column(
+            "date_insert",
+            sa.DateTime,
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_cor_role_token_date_insert",
+        "cor_role_token",
+        ["date_insert"],
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_temp_users_date_insert",
+        "temp_users",
+        ["date_insert"],
+        schema="utilisateurs",
+    )
+
+
+def downgrade():
+    op.drop_index("i_temp_users_date_insert", schema="utilisateurs")
+    op.drop_index("i_cor_role_token_date_insert", schema="utilisateurs")
+    op.drop_column("cor_role_token", "date_insert", schema="utilisateurs")
@@ -0,0 +1,63 @@
+"""add v_roles_listes, a lean view of the members of lists
+
+Revision ID: b5e2d8f14c06
+Revises: 9a1f3c5e7b20
+Create Date: 2026-10-19 15:37:20.418825
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b5e2d8f14c06"
+down_revision = "9a1f3c5e7b20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the primary key (id_role, id_liste) cannot serve a search by list
+    op.create_index(
+        "i_cor_role_liste_id_liste",
+        "cor_role_liste",
+        ["id_liste"],
+        schema="utilisateurs",
+    )
+    # Active users of each list, by themselves or through their (nested)
+    # groups. The closure table holds a row of depth 0 for each role, so a
+    # single join replaces the UNION of direct and group memberships, and
+    # DISTINCT ON removes the users reached through several groups.
+    # Filters on id_menu are pushed down to cor_role_liste.
+    op.execute(
+        """
+        CREATE VIEW utilisateurs.v_roles_listes AS
+        SELECT DISTINCT ON (c.id_liste, u.id_role)
+            c.id_liste AS id_menu,
+            u.id_role,
+            u.uuid_role,
+            u.identifiant,
+            u.nom_role,
+            u.prenom_role,
+            (upper(u.nom_role::text) || ' '::text) || u.prenom_role::text AS nom_complet,
+            u.email,
+            u.id_organisme,
+            o.nom_organisme AS organisme
+        FROM utilisateurs.cor_role_liste c
+        JOIN utilisateurs.cor_roles_closure cl ON cl.id_role_ancestor = c.id_role
+        JOIN utilisateurs.t_roles u ON u.id_role = cl.id_role_descendant
+        LEFT JOIN utilisateurs.bib_organismes o ON o.id_organisme = u.id_organisme
+        WHERE u.groupe = false AND u.active = true
+        ORDER BY c.id_liste, u.id_role
+        """
+    )
+
+
+def downgrade():
+    op.execute("DROP VIEW utilisateurs.v_roles_listes")
+    op.drop_index(
+        "i_cor_role_liste_id_liste",
+        table_name="cor_role_liste",
+        schema="utilisateurs",
+    )
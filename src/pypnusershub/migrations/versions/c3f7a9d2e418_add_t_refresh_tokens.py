@@ -0,0 +1,70 @@
+"""add t_refresh_tokens, the rotating refresh tokens
+
+Revision ID: c3f7a9d2e418
+Revises: b5e2d8f14c06
+Create Date: 2026-10-19 16:42:11.803514
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import UUID
+
+
+# revision identifiers, used by Alembic.
+revision = "c3f7a9d2e418"
+down_revision = "b5e2d8f14c06"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "t_refresh_tokens",
+        sa.Column("id_refresh_token", sa.Integer, primary_key=True),
+        sa.Column(
+            "id_role",
+            sa.Integer,
+            sa.ForeignKey(
+                "utilisateurs.t_roles.id_role", onupdate="CASCADE", ondelete="CASCADE"
+            ),
+            nullable=False,
+        ),
+        # SHA-256 digest of the token
+        sa.Column("token", sa.Unicode(64), nullable=False),
+        # tokens issued by rotation from the same login
+        sa.Column("family", UUID(as_uuid=True), nullable=False),
+        sa.Column("expires_at", sa.DateTime, nullable=False),
+        sa.Column("revoked", sa.Boolean, nullable=False, server_default=sa.false()),
+        sa.Column("date_insert", sa.DateTime, server_default=sa.func.now()),
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_t_refresh_tokens_token",
+        "t_refresh_tokens",
+        ["token"],
+        unique=True,
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_t_refresh_tokens_family",
+        "t_refresh_tokens",
+        ["family"],
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_t_refresh_tokens_id_role",
+        "t_refresh_tokens",
+        ["id_role"],
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_t_refresh_tokens_expires_at",
+        "t_refresh_tokens",
+        ["expires_at"],
+        schema="utilisateurs",
+    )
+
+
+def downgrade():
+    op.drop_table("t_refresh_tokens", schema="utilisateurs")
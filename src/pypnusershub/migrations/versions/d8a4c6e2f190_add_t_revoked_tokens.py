@@ -0,0 +1,55 @@
+"""add t_revoked_tokens, the revocation list of tokens
+
+Revision ID: d8a4c6e2f190
+Revises: c3f7a9d2e418
+Create Date: 2026-10-19 17:26:48.157302
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d8a4c6e2f190"
+down_revision = "c3f7a9d2e418"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "t_revoked_tokens",
+        # jti claim of the revoked token
+        sa.Column("jti", sa.Unicode(64), primary_key=True),
+        sa.Column(
+            "id_role",
+            sa.Integer,
+            sa.ForeignKey(
+                "utilisateurs.t_roles.id_role", onupdate="CASCADE", ondelete="CASCADE"
+            ),
+        ),
+        # expiration of the token, the row is useless afterwards
+        sa.Column("expires_at", sa.DateTime, nullable=False),
+        sa.Column(
+            "date_insert", sa.DateTime, nullable=False, server_default=sa.func.now()
+        ),
+        schema="utilisateurs",
+    )
+    # workers fetch the revocations inserted since their last sync
+    op.create_index(
+        "i_t_revoked_tokens_date_insert",
+        "t_revoked_tokens",
+        ["date_insert"],
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_t_revoked_tokens_expires_at",
+        "t_revoked_tokens",
+        ["expires_at"],
+        schema="utilisateurs",
+    )
+
+
+def downgrade():
+    op.drop_table("t_revoked_tokens", schema="utilisateurs")
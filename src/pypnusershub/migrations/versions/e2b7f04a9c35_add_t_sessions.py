@@ -0,0 +1,38 @@
+"""add t_sessions, the server-side Flask sessions
+
+Revision ID: e2b7f04a9c35
+Revises: d8a4c6e2f190
+Create Date: 2026-10-19 18:12:37.640291
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e2b7f04a9c35"
+down_revision = "d8a4c6e2f190"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "t_sessions",
+        # SHA-256 digest of the session id carried by the cookie
+        sa.Column("sid", sa.Unicode(64), primary_key=True),
+        sa.Column("data", sa.UnicodeText, nullable=False),
+        sa.Column("expires_at", sa.DateTime, nullable=False),
+        schema="utilisateurs",
+    )
+    op.create_index(
+        "i_t_sessions_expires_at",
+        "t_sessions",
+        ["expires_at"],
+        schema="utilisateurs",
+    )
+
+
+def downgrade():
+    op.drop_table("t_sessions", schema="utilisateurs")
@@ -0,0 +1,92 @@
+# coding: utf8
+
+"""
+Password hashing helpers.
+
+bcrypt releases the GIL while hashing, so batches of passwords are spread
+over a thread pool sized to the number of CPUs.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from typing import Iterable, List, Optional
+
+import bcrypt
+
+_executor = None
+_executor_lock = Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix="pypnusershub-hash",
+            )
+        return _executor
+
+
+def hash_password(password: str, method: str = "hash") -> str:
+    """
+    Hash a password with the given method.
+
+    Parameters
+    ----------
+    password : str
+        the clear password
+    method : str, default="hash"
+        "hash" for bcrypt, "md5" for the legacy md5 digest (see PASS_METHOD)
+
+    Returns
+    -------
+    str
+        the hashed password
+
+    Raises
+    ------
+    ValueError
+        if the method is unknown
+    """
+    password = password.encode("utf-8")
+    if method == "md5":
+        return hashlib.md5(password).hexdigest()
+    elif method == "hash":
+        return bcrypt.hashpw(password, bcrypt.gensalt()).decode("utf-8")
+    raise ValueError(f"Unknown pass method {method}")
+
+
+def hash_passwords(
+    passwords: Iterable[str], method: str = "hash", max_workers: Optional[int] = None
+) -> List[str]:
+    """
+    Hash a batch of passwords in parallel.
+
+    Parameters
+    ----------
+    passwords : Iterable[str]
+        the clear passwords
+    method : str, default="hash"
+        "hash" for bcrypt, "md5" for the legacy md5 digest (see PASS_METHOD)
+    max_workers : int, optional
+        size of a dedicated pool; the shared pool sized to the CPU count is
+        used by default
+
+    Returns
+    -------
+    List[str]
+        the hashed passwords, in the same order as the input
+    """
+    passwords = list(passwords)
+    hash_ = partial(hash_password, method=method)
+    # md5 is cheap enough that dispatching to threads would only add overhead
+    if method == "md5" or len(passwords) < 2:
+        return [hash_(password) for password in passwords]
+    if max_workers is not None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(hash_, passwords))
+    return list(_get_executor().map(hash_, passwords))
@@ -0,0 +1,188 @@
+"""
+Connection pool profile of the database engine.
+
+The pool is configured by the following keys of the app config, applied to
+SQLALCHEMY_ENGINE_OPTIONS (options already set there take precedence) when
+the SQLAlchemy extension of this module is initialized:
+
+- DB_POOL_SIZE, DB_POOL_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE and
+  DB_POOL_PRE_PING: options of the SQLAlchemy pool
+- DB_STATEMENT_TIMEOUT: PostgreSQL `statement_timeout`, in milliseconds
+- DB_APPLICATION_NAME: PostgreSQL `application_name` of the connections,
+  shown in `pg_stat_activity`
+- DB_POOL_METRICS: measure the checkout wait time and the age of the
+  connections, see `get_pool_metrics`
+- DB_READ_REPLICA_URI: database answering the read-only queries (see
+  `pypnusershub.db.replica`), with the same pool profile
+
+Apps providing their own SQLAlchemy extension (FLASK_SQLALCHEMY_DB) call
+`configure_engine_options(app.config)` before `db.init_app(app)`.
+"""
+
+import threading
+import time
+from typing import Dict, Mapping, MutableMapping
+
+import sqlalchemy as sa
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.pool import QueuePool
+
+REPLICA_BIND = "pypnusershub_replica"
+
+# pool options, by config key
+POOL_OPTIONS = {
+    "DB_POOL_SIZE": "pool_size",
+    "DB_POOL_MAX_OVERFLOW": "max_overflow",
+    "DB_POOL_TIMEOUT": "pool_timeout",
+    "DB_POOL_RECYCLE": "pool_recycle",
+    "DB_POOL_PRE_PING": "pool_pre_ping",
+}
+
+
+def pool_options(config: Mapping) -> dict:
+    """
+    Return the engine options of the pool profile of a config.
+    """
+    options = {
+        option: config[key] for key, option in POOL_OPTIONS.items() if key in config
+    }
+    connect_args = {}
+    if config.get("DB_STATEMENT_TIMEOUT"):
+        connect_args["options"] = (
+            f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT'])}"
+        )
+    if config.get("DB_APPLICATION_NAME"):
+        connect_args["application_name"] = config["DB_APPLICATION_NAME"]
+    if connect_args:
+        options["connect_args"] = connect_args
+    if config.get("DB_POOL_METRICS"):
+        options["poolclass"] = InstrumentedQueuePool
+    return options
+
+
+def configure_engine_options(config: MutableMapping) -> None:
+    """
+    Add the pool profile to SQLALCHEMY_ENGINE_OPTIONS, and the read replica
+    to SQLALCHEMY_BINDS. Options already set are kept.
+    """
+    engine_options = config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    for option, value in pool_options(config).items():
+        if option == "connect_args":
+            engine_options["connect_args"] = {
+                **value,
+                **engine_options.get("connect_args", {}),
+            }
+        else:
+            engine_options.setdefault(option, value)
+    if config.get("DB_READ_REPLICA_URI"):
+        config.setdefault("SQLALCHEMY_BINDS", {}).setdefault(
+            REPLICA_BIND, config["DB_READ_REPLICA_URI"]
+        )
+
+
+class PoolMetrics:
+    """
+    Checkout wait time and age of the connections of a pool.
+
+    Times are in seconds. Counters are cumulated since the creation of the
+    pool.
+    """
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connected_at: Dict[int, float] = {}
+        self._lock = threading.Lock()
+
+    def record_wait(self, duration: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += duration
+            self.wait_max = max(self.wait_max, duration)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - connected_at for connected_at in self.connected_at.values()]
+            return {
+                "checkouts": self.checkouts,
+                "wait_total": self.wait_total,
+                "wait_mean": self.wait_total / self.checkouts if self.checkouts else 0,
+                "wait_max": self.wait_max,
+                "connections": len(ages),
+                "age_mean": sum(ages) / len(ages) if ages else 0,
+                "age_max": max(ages, default=0),
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool measuring the checkout wait time and the age of its
+    connections in `metrics`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        if "_dispatch" in kwargs:
+            # recreated pool: the listeners of the former pool are given
+            # with its dispatch and update the same metrics
+            return
+        sa.event.listen(self, "connect", self._on_connect)
+        # detached connections no longer belong to the pool
+        sa.event.listen(self, "close", self._on_close)
+        sa.event.listen(self, "detach", self._on_close)
+
+    def _on_connect(self, dbapi_connection, connection_record) -> None:
+        with self.metrics._lock:
+            self.metrics.connected_at[id(dbapi_connection)] = time.monotonic()
+
+    def _on_close(self, dbapi_connection, connection_record) -> None:
+        with self.metrics._lock:
+            self.metrics.connected_at.pop(id(dbapi_connection), None)
+
+    def _do_get(self):
+        # waiting for a free connection, or opening a new one
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.metrics.record_wait(time.perf_counter() - start)
+
+    def recreate(self) -> "InstrumentedQueuePool":
+        # on dispose: the new pool gets the listeners of this one, the
+        # metrics are kept
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "overflow": self.overflow(),
+            **self.metrics.snapshot(),
+        }
+
+
+def get_pool_metrics(engines: Mapping) -> Dict[str, dict]:
+    """
+    Return the status and metrics of the instrumented pools of engines
+    (e.g. `db.engines`), by bind name ("default" for the main engine).
+    """
+    return {
+        bind or "default": engine.pool.stats()
+        for bind, engine in engines.items()
+        if isinstance(engine.pool, InstrumentedQueuePool)
+    }
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension applying the pool profile of the app config.
+    """
+
+    def init_app(self, app) -> None:
+        configure_engine_options(app.config)
+        super().init_app(app)
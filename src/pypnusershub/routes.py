@@ -20,15 +20,32 @@ from flask import (
     redirect,
     request,
     session,
+    stream_with_context,
 )
 from flask_login import current_user, login_required, login_user, logout_user
+from authlib.jose.errors import JoseError
 from markupsafe import escape
 from pypnusershub.auth import oauth
+from pypnusershub.auth.rate_limit import rate_limiter
+from pypnusershub.auth.refresh_tokens import (
+    refresh_token_expiration,
+    revoke_refresh_tokens,
+    rotate_refresh_token,
+)
+from pypnusershub.auth.revocation import revoke_token
 from pypnusershub.db import db, models
-from pypnusershub.db.tools import encode_token
+from pypnusershub.db import listing
+from pypnusershub.db.listing import (
+    DEFAULT_ROLE_FIELDS,
+    PRIVATE_ROLE_FIELDS,
+    iter_roles,
+)
+from pypnusershub.db.rights import resolve_application
+from pypnusershub.db.tools import decode_token, encode_token
+from pypnusershub.keys import get_key_ring
 from pypnusershub.schemas import OrganismeSchema, UserSchema
 from pypnusershub.auth.authentication import Authentication
-from werkzeug.exceptions import Forbidden, Unauthorized
+from werkzeug.exceptions import BadRequest, Forbidden, Unauthorized
 
 log = logging.getLogger(__name__)
 # This module was originally designed as a submodule of designed
@@ -114,6 +131,22 @@ def get_providers():
     )
 
 
+@routes.route("/jwks.json", methods=["GET"])
+def jwks():
+    """
+    Publish the public keys verifying the tokens, as a JSON Web Key Set.
+
+    The set is empty if tokens are signed with SECRET_KEY (TOKEN_SIGNING_KEYS
+    not set). Clients may cache it TOKEN_JWKS_MAX_AGE seconds (300 by
+    default), and reload it when a token has an unknown `kid`.
+    """
+    key_ring = get_key_ring()
+    response = jsonify(key_ring.jwks() if key_ring else {"keys": []})
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get("TOKEN_JWKS_MAX_AGE", 300)
+    return response
+
+
 @routes.route("/get_current_user")
 @login_required
 def get_user_data():
@@ -136,6 +169,27 @@ def get_user_data():
     return jsonify(user_dict_with_token)
 
 
+def _json_field(name):
+    """
+    Return a string field of the JSON body of the request, None if there is
+    no JSON body or no such field.
+
+    Raises
+    ------
+    BadRequest
+        if the body is not a JSON object, or the field is not a string
+    """
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return None
+    if not isinstance(payload, dict):
+        raise BadRequest("The JSON body must be an object")
+    value = payload.get(name)
+    if value is not None and not isinstance(value, str):
+        raise BadRequest(f"{name} must be a string")
+    return value
+
+
 @routes.route("/login/<provider>", methods=["POST", "GET"])
 @routes.route(
     "/login", methods=["POST", "GET"], defaults={"provider": "local_provider"}
@@ -156,8 +210,12 @@ def login(provider):
         - `user`: The serialized user data.
         - `expires`: The expiration time of the token.
         - `token`: The JWT token.
+        - `refresh_token`, `refresh_expires`: a refresh token and its expiration
+          time, if ACCESS_TOKEN_EXPIRATION is set.
     - If the authentication fails, it returns the result of the authentication.
     """
+    # Throttle before any database query or password check
+    rate_limiter.check("login", identifiant=_json_field("login"))
     auth_provider = current_app.auth_manager.get_provider(provider)
     session["current_provider"] = provider
     auth_result = auth_provider.authenticate()
@@ -167,7 +225,8 @@ def login(provider):
         login_user(auth_result, remember=True)
         user_dict_with_token = UserSchema(
             exclude=["remarques"], only=["+max_level_profil", "+providers"]
-        ).dump_with_token(auth_result)
+        ).dump_with_token(auth_result, refresh=True)
+        db.session.commit()
         return jsonify(user_dict_with_token)
 
 
@@ -175,6 +234,7 @@ def login(provider):
 def public_login():
     if not current_app.config.get("PUBLIC_ACCESS_USERNAME", {}):
         raise Forbidden
+    rate_limiter.check("public_login")
     login = current_app.config.get("PUBLIC_ACCESS_USERNAME")
 
     user = db.session.execute(
@@ -185,13 +245,206 @@ def public_login():
 
     login_user(user)
 
-    return UserSchema(
+    user_dict_with_token = UserSchema(
+        exclude=["remarques"], only=["+max_level_profil", "+providers"]
+    ).dump_with_token(user, refresh=True)
+    db.session.commit()
+    return user_dict_with_token
+
+
+@routes.route("/refresh", methods=["POST"])
+def refresh():
+    """
+    Exchange a refresh token for a new access token.
+
+    The refresh token, given in the `refresh_token` field of the JSON body,
+    is revoked and replaced by a new one. The user is read from the
+    database, so a deactivated user can no longer obtain access tokens.
+
+    Returns
+    -------
+    dict
+        The same response as the login route: `user`, `token`, `expires`,
+        `refresh_token` and `refresh_expires`.
+    """
+    rate_limiter.check("refresh")
+    token = _json_field("refresh_token")
+    if not token:
+        raise BadRequest("Missing refresh_token")
+    rotated = rotate_refresh_token(token)
+    if rotated is None:
+        # keep the revocation of the family of a reused token
+        db.session.commit()
+        raise Unauthorized("Invalid or expired refresh token")
+    id_role, refresh_token = rotated
+    user = db.session.get(models.User, id_role)
+    if user is None or not user.active:
+        revoke_refresh_tokens(token=refresh_token)
+        db.session.commit()
+        raise Unauthorized("Inactive user")
+    user_dict_with_token = UserSchema(
         exclude=["remarques"], only=["+max_level_profil", "+providers"]
     ).dump_with_token(user)
+    refresh_exp = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=refresh_token_expiration()
+    )
+    user_dict_with_token["refresh_token"] = refresh_token
+    user_dict_with_token["refresh_expires"] = refresh_exp.isoformat()
+    db.session.commit()
+    return jsonify(user_dict_with_token)
+
+
+def _bool_arg(value):
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise ValueError(value)
+
+
+def _check_roles_access(fields):
+    """
+    Check that the current user may list roles, with the requested fields.
+
+    Listing roles requires a profile of at least ROLES_LISTING_MIN_LEVEL (1
+    by default) on the current application, and the private fields
+    (`PRIVATE_ROLE_FIELDS`) a profile of at least
+    ROLES_PRIVATE_FIELDS_MIN_LEVEL (6 by default). The public account
+    (PUBLIC_ACCESS_USERNAME) cannot list roles.
+    """
+    config = current_app.config
+    public_login = config.get("PUBLIC_ACCESS_USERNAME")
+    if public_login and current_user.identifiant == public_login:
+        raise Forbidden("The public account cannot list roles")
+    level = int(current_user.max_level_profil or 0)
+    if level < config.get("ROLES_LISTING_MIN_LEVEL", 1):
+        raise Forbidden("Insufficient profile to list roles")
+    private_fields = PRIVATE_ROLE_FIELDS.intersection(fields)
+    if private_fields and level < config.get("ROLES_PRIVATE_FIELDS_MIN_LEVEL", 6):
+        raise Forbidden(
+            f"Insufficient profile to read {', '.join(sorted(private_fields))}"
+        )
+
+
+def _roles_arguments():
+    """
+    Parse the fields and the filters of the routes listing roles, once the
+    access of the current user checked.
+    """
+    fields = request.args.get("fields", ",".join(DEFAULT_ROLE_FIELDS)).split(",")
+    _check_roles_access(fields)
+    # invalid values are ignored, as with any request.args.get(type=...)
+    filters = {
+        key: request.args.get(key, type=type_)
+        for key, type_ in (
+            ("id_application", int),
+            ("id_group", int),
+            ("id_liste", int),
+            ("id_organisme", int),
+            ("groupe", _bool_arg),
+            ("active", _bool_arg),
+        )
+    }
+    if "application" in request.args:
+        filters["id_application"] = resolve_application(request.args["application"])
+        if filters["id_application"] is None:
+            raise BadRequest(f"Unknown application {request.args['application']}")
+    return fields, filters
+
+
+@routes.route("/roles", methods=["GET"])
+@login_required
+def get_roles():
+    """
+    List roles, ordered by id_role, as a streamed JSON document
+    `{"items": [...], "next": <id_role or null>}`.
+
+    Query parameters:
+
+    - `fields`: comma separated list of returned fields
+      (default: id_role,nom_role,prenom_role,nom_complet)
+    - `after`: return roles whose id_role is greater than this one, use the
+      `next` value of the previous page
+    - `limit`: number of roles of the page, every matching role if not set
+    - `application` (code) or `id_application`: roles having a right on the
+      application
+    - `id_group`: members of the group (nested groups included)
+    - `id_liste`: roles of the list
+    - `id_organisme`: roles of the organism
+    - `groupe`: only groups (true) or users (false)
+    - `active`: only active (true) or inactive (false) roles
+
+    Access is restricted by profile, see `_check_roles_access`.
+    """
+    fields, filters = _roles_arguments()
+    after = request.args.get("after", type=int)
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit <= 0:
+        raise BadRequest("limit must be positive")
+    # the next page starts after the last id_role, which is always fetched
+    query_fields = fields if "id_role" in fields else [*fields, "id_role"]
+    try:
+        # fetch one more role to know if there is a next page
+        roles = iter_roles(
+            query_fields, after=after, limit=limit + 1 if limit else None, **filters
+        )
+        first = next(roles, None)
+    except KeyError as e:
+        raise BadRequest(str(e))
+
+    def generate():
+        dumps = current_app.json.dumps
+        yield '{"items": ['
+        role, count, last = first, 0, None
+        while role is not None:
+            if limit and count == limit:
+                break
+            item = {field: role[field] for field in fields}
+            yield ("," if count else "") + dumps(item)
+            count, last = count + 1, role["id_role"]
+            role = next(roles, None)
+        yield '], "next": ' + dumps(last if role is not None else None) + "}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@routes.route("/roles/search", methods=["GET"])
+@login_required
+def search_roles():
+    """
+    Search roles by name, accents and case ignored, best matches first.
+
+    Query parameters:
+
+    - `q`: searched text
+    - `limit`: maximum number of roles (default: 20, at most 100)
+    - `fields` and filters: as for `/roles`, with the same access rules
+    """
+    text = request.args.get("q", "").strip()
+    if not text:
+        raise BadRequest("Missing q parameter")
+    fields, filters = _roles_arguments()
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    try:
+        roles = listing.search_roles(text, fields, limit, **filters)
+    except KeyError as e:
+        raise BadRequest(str(e))
+    return jsonify({"items": roles})
 
 
 @routes.route("/logout", methods=["GET", "POST"])
 def logout():
+    # the bearer token, if any, is rejected until its expiration
+    bearer = request.headers.get("Authorization", "")
+    if bearer.startswith("Bearer "):
+        try:
+            revoke_token(decode_token(bearer[len("Bearer ") :]))
+        except JoseError:
+            pass
+    refresh_token = _json_field("refresh_token")
+    if refresh_token:
+        revoke_refresh_tokens(token=refresh_token)
+    db.session.commit()
     if not "current_provider" in session:
         raise Unauthorized("No provider in session")
     auth_provider = current_app.auth_manager.get_provider(session["current_provider"])
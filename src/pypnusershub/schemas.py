@@ -9,7 +9,12 @@ from utils_flask_sqla.schema import SmartRelationshipsMixin
 
 from pypnusershub.env import ma, db
 from pypnusershub.db.models import User, Organisme, Provider
-from pypnusershub.db.tools import encode_token
+from pypnusershub.auth.refresh_tokens import (
+    issue_refresh_token,
+    refresh_token_expiration,
+    refresh_tokens_enabled,
+)
+from pypnusershub.db.tools import encode_token, token_expiration
 
 
 class OrganismeSchema(SmartRelationshipsMixin, ma.SQLAlchemyAutoSchema):
@@ -33,6 +38,8 @@ class UserSchema(SmartRelationshipsMixin, ma.SQLAlchemyAutoSchema):
         load_instance = True
         sqla_session = db.session
         exclude = ("_password", "_password_plus", "champs_addi", "max_level_profil")
+        # maintained by triggers
+        dump_only = ("security_stamp",)
 
     max_level_profil = fields.Integer()
     nom_complet = fields.String()
@@ -47,7 +54,7 @@ class UserSchema(SmartRelationshipsMixin, ma.SQLAlchemyAutoSchema):
             return dict({"id_role": data})
         return data
 
-    def dump_with_token(self, obj):
+    def dump_with_token(self, obj, refresh=False):
         """
         Dumps user information with a JWT token and its expiration date.
 
@@ -55,6 +62,9 @@ class UserSchema(SmartRelationshipsMixin, ma.SQLAlchemyAutoSchema):
         ----------
         obj : User
             The user object to dump.
+        refresh : bool, default=False
+            Also issue a refresh token, if refresh tokens are enabled
+            (ACCESS_TOKEN_EXPIRATION is set). Used on login.
 
         Returns
         -------
@@ -62,13 +72,19 @@ class UserSchema(SmartRelationshipsMixin, ma.SQLAlchemyAutoSchema):
             A dictionary with the user information and the token. The token is
             encoded using the user's information and the secret key from the
             current Flask application configuration. The dictionary also
-            contains the expiration date of the token.
+            contains the expiration date of the token, and the refresh token
+            with its expiration date if one was issued.
         """
         user_dict = self.dump(obj)
-        token_exp = datetime.datetime.now(datetime.timezone.utc)
-        token_exp += datetime.timedelta(seconds=current_app.config["COOKIE_EXPIRATION"])
-        return {
+        now = datetime.datetime.now(datetime.timezone.utc)
+        token_exp = now + datetime.timedelta(seconds=token_expiration())
+        result = {
             "user": user_dict,
             "token": encode_token(user_dict).decode(),
             "expires": token_exp.isoformat(),
         }
+        if refresh and refresh_tokens_enabled():
+            refresh_exp = now + datetime.timedelta(seconds=refresh_token_expiration())
+            result["refresh_token"] = issue_refresh_token(obj.id_role)
+            result["refresh_expires"] = refresh_exp.isoformat()
+        return result
@@ -0,0 +1,505 @@
+"""
+Session interface of the module.
+
+`DigestSessionInterface` keeps Flask signed-cookie sessions, with three
+differences:
+
+- sessions of requests authenticated by a token (`g.login_via_request`)
+  are never saved, so API calls do not create cookies;
+- the digest of the session is computed when it is loaded, and the cookie
+  is only signed and sent again if the content changed (assigning the same
+  value, e.g. `session["current_provider"]` on every login, changes
+  nothing). Permanent sessions are still extended every
+  SESSION_REFRESH_INTERVAL seconds (1 hour by default);
+- with SESSION_STORE, the session data are kept server side and the cookie
+  only carries a signed session id. They are read from the store on first
+  access to the session, so requests which do not use it cost nothing. The
+  session id is renewed when the logged in user (`_user_id`) changes, so
+  an id obtained before the login cannot be used after it.
+
+Install it in the application:
+
+    app.session_interface = DigestSessionInterface()
+"""
+
+import functools
+import hashlib
+import importlib
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import timedelta
+from typing import Optional
+
+import sqlalchemy as sa
+from flask import g
+from flask.sessions import (
+    SecureCookieSession,
+    SecureCookieSessionInterface,
+    session_json_serializer,
+)
+from itsdangerous import BadSignature
+from sqlalchemy.dialects.postgresql import insert
+
+from pypnusershub.db.models import ServerSession
+from pypnusershub.db.purge import delete_in_batches
+from pypnusershub.env import db
+
+log = logging.getLogger(__name__)
+
+SESSION_STORE_KEY = "pypnusershub_session_store"
+
+# key of the session id in the cookie of server-side sessions
+SID_KEY = "_sid"
+
+
+class SessionStore:
+    """
+    Storage of server-side sessions.
+
+    Subclasses implement `get`, `set`, `delete` and `purge`, and may
+    implement `touch`. Session data are dicts serialized with the tagged
+    JSON serializer of Flask sessions.
+    """
+
+    def get(self, sid: str) -> Optional[dict]:
+        """
+        Return the data of a session, None if it is unknown or expired.
+        """
+        raise NotImplementedError
+
+    def set(self, sid: str, data: dict, ttl: int) -> None:
+        """
+        Save the data of a session, for `ttl` seconds.
+        """
+        raise NotImplementedError
+
+    def touch(self, sid: str, data: dict, ttl: int) -> None:
+        """
+        Extend an unchanged session for `ttl` seconds.
+        """
+        self.set(sid, data, ttl)
+
+    def delete(self, sid: str) -> None:
+        raise NotImplementedError
+
+    def purge(self) -> int:
+        """
+        Delete the expired sessions and return their number.
+        """
+        raise NotImplementedError
+
+
+class FileSystemSessionStore(SessionStore):
+    """
+    Sessions stored in files of a local directory, one per session.
+
+    Parameters
+    ----------
+    directory : str
+        directory of the session files, created if needed. It must be
+        shared by the workers of the application.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, sid: str) -> str:
+        # session ids are generated by secrets.token_urlsafe
+        if not sid or not all(c.isalnum() or c in "-_" for c in sid):
+            raise ValueError("Invalid session id")
+        return os.path.join(self.directory, sid)
+
+    def get(self, sid: str) -> Optional[dict]:
+        try:
+            with open(self._path(sid), encoding="UTF-8") as session_file:
+                expires = float(session_file.readline())
+                if expires < time.time():
+                    return None
+                return session_json_serializer.loads(session_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def set(self, sid: str, data: dict, ttl: int) -> None:
+        path = self._path(sid)
+        # written to a temporary file then renamed, so readers never see a
+        # partial session
+        temporary_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(temporary_path, "w", encoding="UTF-8") as session_file:
+            session_file.write(f"{time.time() + ttl}\n")
+            session_file.write(session_json_serializer.dumps(data))
+        os.replace(temporary_path, path)
+
+    def delete(self, sid: str) -> None:
+        try:
+            os.remove(self._path(sid))
+        except (OSError, ValueError):
+            pass
+
+    def purge(self) -> int:
+        deleted = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                with open(entry.path, encoding="UTF-8") as session_file:
+                    expires = float(session_file.readline() or 0)
+                if expires < now:
+                    os.remove(entry.path)
+                    deleted += 1
+            except (OSError, ValueError):
+                continue
+        return deleted
+
+
+class SQLSessionStore(SessionStore):
+    """
+    Sessions stored in the `utilisateurs.t_sessions` table, by the SHA-256
+    digest of their id.
+
+    Queries run on their own connections, outside of the transaction of the
+    request. Extensions of unchanged sessions (`touch`) are written behind:
+    they are queued and written in bulk by a background thread every
+    `flush_interval` seconds.
+
+    Parameters
+    ----------
+    write_behind : bool, default=False
+        also queue the changed sessions. A worker reads its own queued
+        sessions, but the others only see them once written: enable it
+        only if the requests of a client reach the same worker (sticky
+        sessions) or if losing the last second of changes on a crash is
+        acceptable.
+    flush_interval : float, default=1
+        interval between two bulk writes, in seconds
+    """
+
+    def __init__(self, write_behind: bool = False, flush_interval: float = 1) -> None:
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.engine = None
+        # queued writes: data (None for a touch) and ttl by digest of the id
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    @staticmethod
+    def _key(sid: str) -> str:
+        return hashlib.sha256(sid.encode("UTF-8")).hexdigest()
+
+    def _get_engine(self):
+        if self.engine is None:
+            self.engine = db.engine
+        return self.engine
+
+    def get(self, sid: str) -> Optional[dict]:
+        key = self._key(sid)
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None and pending[0] is not None:
+            return session_json_serializer.loads(pending[0])
+        with self._get_engine().connect() as connection:
+            data = connection.scalar(
+                sa.select(ServerSession.data)
+                .where(ServerSession.sid == key)
+                .where(ServerSession.expires_at > sa.func.now())
+            )
+        return session_json_serializer.loads(data) if data is not None else None
+
+    def set(self, sid: str, data: dict, ttl: int) -> None:
+        data = session_json_serializer.dumps(data)
+        if self.write_behind:
+            self._queue(self._key(sid), data, ttl)
+        else:
+            self._write([{"sid": self._key(sid), "data": data, "ttl": ttl}], [])
+
+    def touch(self, sid: str, data: dict, ttl: int) -> None:
+        self._queue(self._key(sid), None, ttl)
+
+    def delete(self, sid: str) -> None:
+        key = self._key(sid)
+        with self._lock:
+            self._pending.pop(key, None)
+        with self._get_engine().begin() as connection:
+            connection.execute(sa.delete(ServerSession).where(ServerSession.sid == key))
+
+    def purge(self) -> int:
+        return delete_in_batches(
+            ServerSession, ServerSession.expires_at <= sa.func.now()
+        )
+
+    def _queue(self, key: str, data: Optional[str], ttl: int) -> None:
+        self._get_engine()
+        with self._lock:
+            previous = self._pending.get(key)
+            if data is None and previous is not None:
+                # a touch keeps the queued data
+                data = previous[0]
+            self._pending[key] = (data, ttl)
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._flush_periodically,
+                    name="pypnusershub-sessions",
+                    daemon=True,
+                )
+                self._flusher.start()
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error while writing the sessions")
+
+    def flush(self) -> None:
+        """
+        Write the queued sessions, in two bulk statements.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        upserts, touches = [], []
+        for key, (data, ttl) in pending.items():
+            if data is None:
+                # "sid" would name the column in the SET clause
+                touches.append({"key": key, "ttl": ttl})
+            else:
+                upserts.append({"sid": key, "data": data, "ttl": ttl})
+        self._write(upserts, touches)
+
+    def _write(self, upserts, touches) -> None:
+        # expiration dates are computed on the database clock
+        expires_at = sa.func.now() + sa.bindparam("ttl", type_=sa.Interval)
+        for row in upserts + touches:
+            row["ttl"] = timedelta(seconds=row["ttl"])
+        with self._get_engine().begin() as connection:
+            if upserts:
+                statement = insert(ServerSession).values(
+                    sid=sa.bindparam("sid"),
+                    data=sa.bindparam("data"),
+                    expires_at=expires_at,
+                )
+                connection.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=[ServerSession.sid],
+                        set_={
+                            "data": statement.excluded.data,
+                            "expires_at": statement.excluded.expires_at,
+                        },
+                    ),
+                    upserts,
+                )
+            if touches:
+                connection.execute(
+                    sa.update(ServerSession.__table__)
+                    .where(ServerSession.sid == sa.bindparam("key"))
+                    .values(expires_at=expires_at),
+                    touches,
+                )
+
+
+class DigestSession(SecureCookieSession):
+    """
+    Session remembering the digest of its content when it was loaded.
+    """
+
+    loaded = True
+
+    def __init__(self, initial=None, sid: Optional[str] = None) -> None:
+        super().__init__(initial)
+        self.sid = sid
+        self.digest: Optional[bytes] = None
+        self.issued_at = None
+        # logged in user when the session was loaded
+        self.loaded_user_id = None
+
+
+class LazySession(DigestSession):
+    """
+    Server-side session whose data are read from the store on first access.
+    """
+
+    def __init__(self, sid: str, loader) -> None:
+        super().__init__(sid=sid)
+        self._loader = loader
+        self.loaded = False
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        self.loaded = True
+        data = self._loader()
+        if data is None:
+            # unknown or expired session, a new id is given if it is saved
+            self.sid = None
+            data = {}
+        dict.update(self, data)
+        self.digest = session_digest(data)
+        self.loaded_user_id = data.get("_user_id")
+
+
+def _loading(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+for _name in (
+    "__contains__",
+    "__delitem__",
+    "__eq__",
+    "__getitem__",
+    "__iter__",
+    "__len__",
+    "__repr__",
+    "__setitem__",
+    "clear",
+    "copy",
+    "get",
+    "items",
+    "keys",
+    "pop",
+    "popitem",
+    "setdefault",
+    "update",
+    "values",
+):
+    setattr(LazySession, _name, _loading(getattr(DigestSession, _name)))
+
+
+def session_digest(data: dict) -> bytes:
+    return hashlib.blake2b(
+        session_json_serializer.dumps(data).encode("UTF-8"), digest_size=16
+    ).digest()
+
+
+def get_session_store(app) -> Optional[SessionStore]:
+    """
+    Return the session store of an application, built from SESSION_STORE
+    (python path of a `SessionStore` class) and SESSION_STORE_OPTIONS
+    (keyword arguments of the class), None if SESSION_STORE is not set.
+    """
+    if SESSION_STORE_KEY not in app.extensions:
+        store = None
+        path_store = app.config.get("SESSION_STORE")
+        if path_store:
+            import_path, class_name = path_store.rsplit(".", 1)
+            class_ = getattr(importlib.import_module(import_path), class_name)
+            store = class_(**app.config.get("SESSION_STORE_OPTIONS", {}))
+        app.extensions[SESSION_STORE_KEY] = store
+    return app.extensions[SESSION_STORE_KEY]
+
+
+class DigestSessionInterface(SecureCookieSessionInterface):
+    """
+    Signed-cookie session interface skipping unchanged sessions, with an
+    optional server-side store (see the module documentation).
+
+    Parameters
+    ----------
+    store : SessionStore, optional
+        store of the session data, SESSION_STORE by default
+    """
+
+    session_class = DigestSession
+
+    def __init__(self, store: Optional[SessionStore] = None) -> None:
+        self.store = store
+
+    def get_store(self, app) -> Optional[SessionStore]:
+        return self.store if self.store is not None else get_session_store(app)
+
+    def open_session(self, app, request):
+        serializer = self.get_signing_serializer(app)
+        if serializer is None:
+            return None
+        value = request.cookies.get(self.get_cookie_name(app))
+        if not value:
+            return self.session_class()
+        max_age = int(app.permanent_session_lifetime.total_seconds())
+        try:
+            data, issued_at = serializer.loads(
+                value, max_age=max_age, return_timestamp=True
+            )
+        except BadSignature:
+            return self.session_class()
+        store = self.get_store(app)
+        if store is None:
+            session = self.session_class(data)
+            session.digest = session_digest(data)
+        elif data.get(SID_KEY):
+            sid = data[SID_KEY]
+            session = LazySession(sid, functools.partial(store.get, sid))
+        else:
+            return self.session_class()
+        session.issued_at = issued_at
+        return session
+
+    @staticmethod
+    def is_changed(session) -> bool:
+        return session.digest is None or session_digest(dict(session)) != session.digest
+
+    def should_set_cookie(self, app, session) -> bool:
+        if self.is_changed(session):
+            return True
+        # unchanged: permanent sessions are extended now and then only
+        if not (session.permanent and app.config["SESSION_REFRESH_EACH_REQUEST"]):
+            return False
+        age = time.time() - session.issued_at.timestamp()
+        return age > app.config.get("SESSION_REFRESH_INTERVAL", 3600)
+
+    def save_session(self, app, session, response):
+        if g.get("login_via_request"):
+            return
+        store = self.get_store(app)
+        if store is None:
+            return super().save_session(app, session, response)
+        if not session.loaded:
+            # the session was not used, so it did not change
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session:
+            if session.sid is not None:
+                store.delete(session.sid)
+            if session.modified or session.sid is not None:
+                response.delete_cookie(
+                    self.get_cookie_name(app),
+                    domain=self.get_cookie_domain(app),
+                    path=self.get_cookie_path(app),
+                    secure=self.get_cookie_secure(app),
+                    partitioned=self.get_cookie_partitioned(app),
+                    samesite=self.get_cookie_samesite(app),
+                    httponly=self.get_cookie_httponly(app),
+                )
+                response.vary.add("Cookie")
+            return
+        if session.sid is not None and session.get("_user_id") != (
+            session.loaded_user_id
+        ):
+            # login, logout or change of user: the session gets a new id
+            # (against session fixation) and the former one is deleted
+            store.delete(session.sid)
+            session.sid = None
+        if not self.should_set_cookie(app, session):
+            return
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            store.set(session.sid, dict(session), ttl)
+        elif self.is_changed(session):
+            store.set(session.sid, dict(session), ttl)
+        else:
+            store.touch(session.sid, dict(session), ttl)
+        # the cookie only carries the session id, signed as usual
+        cookie_session = self.session_class({SID_KEY: session.sid})
+        cookie_session.permanent = session.permanent
+        super().save_session(app, cookie_session, response)
@@ -1,9 +1,12 @@
 import pytest
 
-from flask import Flask
+from flask import Flask, url_for
 
 from pypnusershub.auth.auth_manager import AuthManager
 from pypnusershub.auth.providers.openid_provider import OpenIDProvider
+from pypnusershub.auth.rate_limit import MemoryBackend, rate_limiter
+from pypnusershub.db.tools import encode_token
+from pypnusershub.introspect import create_app
 from pypnusershub.tests.fixtures import *
 
 
@@ -34,3 +37,92 @@ class TestAuthManager:
         provider = auth_manager.get_provider("bis")
         assert provider.group_claim_name == "provided_groups"
         assert provider.group_mapping == {"group1": 1, "group2": 2}
+
+
+class TestRateLimiter:
+    def test_memory_backend(self):
+        backend = MemoryBackend(max_keys=2)
+        assert backend.hit("a", 2, 60)
+        assert backend.hit("a", 2, 60)
+        assert not backend.hit("a", 2, 60)
+        # a different key has its own bucket
+        assert backend.hit("b", 2, 60)
+        # least recently used keys are dropped beyond max_keys
+        backend.hit("c", 2, 60)
+        assert "a" not in backend._buckets
+        backend.reset()
+        assert not backend._buckets
+
+    def test_login_rate_limited(self, app):
+        config = {
+            "RATE_LIMIT_ENABLED": True,
+            "RATE_LIMIT_IP": 100,
+            "RATE_LIMIT_IDENTIFIANT": 0,
+        }
+        previous = {key: app.config.get(key) for key in config}
+        app.config.update(config)
+        try:
+            response = app.test_client().post(
+                url_for("auth.login"), json={"login": "admin", "password": "admin"}
+            )
+            assert response.status_code == 429
+        finally:
+            app.config.update(previous)
+            rate_limiter.backend.reset()
+
+    def test_json_body_not_an_object(self, app):
+        client = app.test_client()
+        response = client.post(url_for("auth.login"), json=["admin"])
+        assert response.status_code == 400
+        response = client.post(url_for("auth.refresh"), json={"refresh_token": 1})
+        assert response.status_code == 400
+        response = client.post(url_for("auth.logout"), json="token")
+        assert response.status_code == 400
+
+
+class TestIntrospect:
+    def test_introspect(self, app):
+        token = encode_token({"id_role": 1, "identifiant": "admin"}).decode()
+        client = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+                "SECRET_KEY": app.config["SECRET_KEY"],
+            }
+        ).test_client()
+
+        # no application is requested: no level is queried
+        response = client.post(
+            "/introspect", json={"tokens": [token, "invalid"], "applications": []}
+        )
+        assert response.status_code == 200
+        active, invalid = response.json["results"]
+        assert active["active"] and active["id_role"] == 1
+        assert active["levels"] == {}
+        assert invalid == {"active": False}
+
+        response = client.get(
+            "/introspect", headers={"Authorization": "Bearer " + token[:-2]}
+        )
+        assert response.json == {"active": False}
+        assert client.get("/introspect").status_code == 400
+
+    def test_introspect_bad_request(self):
+        client = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "postgresql://localhost/introspect",
+                "SECRET_KEY": "secret",
+                "INTROSPECT_MAX_BATCH_SIZE": 2,
+            }
+        ).test_client()
+        # checked before any token verification or database access
+        for payload in (
+            ["token"],
+            {"tokens": "token"},
+            {"tokens": ["token", 1]},
+            {"tokens": ["token"] * 3},
+            {"token": "token", "applications": "GN"},
+            {"token": "token", "applications": ["GN", "GEONATURE", "OCCTAX"]},
+            {"token": ["token"]},
+        ):
+            assert client.post("/introspect", json=payload).status_code == 400
+        assert client.get("/introspect?token=t&applications=A,B,C").status_code == 400
@@ -0,0 +1,98 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy as sa
+
+from pypnusershub.commands import user
+from pypnusershub.db.models import TempUser
+from pypnusershub.tests.fixtures import *
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestExport:
+    def test_export_users_jsonl(self, app, group_and_users):
+        result = app.test_cli_runner().invoke(
+            user, ["export", "users", "--format", "jsonl", "--batch-size", "2"]
+        )
+        assert result.exit_code == 0, result.output
+
+        rows = [json.loads(line) for line in result.output.splitlines()]
+        identifiants = {row["identifiant"] for row in rows}
+        assert {"group1", "user_of_group1", "user2"}.issubset(identifiants)
+        assert all("pass" not in row and "pass_plus" not in row for row in rows)
+
+    def test_export_groups_csv(self, app, group_and_users):
+        result = app.test_cli_runner().invoke(user, ["export", "groups"])
+        assert result.exit_code == 0, result.output
+
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        assert {
+            "id_role_groupe": str(group_and_users["group1"].id_role),
+            "id_role_utilisateur": str(group_and_users["user1"].id_role),
+        } in rows
+
+    def test_export_parquet_requires_output(self, app):
+        result = app.test_cli_runner().invoke(
+            user, ["export", "rights", "--format", "parquet"]
+        )
+        assert result.exit_code != 0
+        assert "--output" in result.output
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestChangePasswords:
+    def test_change_passwords(self, app, group_and_users, tmp_path):
+        passwords_file = tmp_path / "passwords.csv"
+        passwords_file.write_text(
+            "identifiant,password\nuser_of_group1,secret1\nuser2,secret2\n"
+        )
+        result = app.test_cli_runner().invoke(
+            user, ["change-passwords", str(passwords_file), "--batch-size", "1"]
+        )
+        assert result.exit_code == 0, result.output
+
+        for user_, password in (
+            (group_and_users["user1"], "secret1"),
+            (group_and_users["user_no_group"], "secret2"),
+        ):
+            db.session.refresh(user_)
+            assert user_.check_password(password)
+
+    def test_change_passwords_unknown_user(self, app, tmp_path):
+        passwords_file = tmp_path / "passwords.csv"
+        passwords_file.write_text("identifiant,password\nunknown_user,secret\n")
+        result = app.test_cli_runner().invoke(
+            user, ["change-passwords", str(passwords_file)]
+        )
+        assert result.exit_code != 0
+        assert "unknown_user" in result.output
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestPurge:
+    def test_purge(self, app, applications):
+        with db.session.begin_nested():
+            for identifiant in ("old_temp_user", "new_temp_user"):
+                db.session.add(
+                    TempUser(
+                        identifiant=identifiant,
+                        email=f"{identifiant}@test.com",
+                        id_application=applications["app1"].id_application,
+                    )
+                )
+        # date_insert is set by a trigger on insert
+        db.session.execute(
+            sa.update(TempUser)
+            .where(TempUser.identifiant == "old_temp_user")
+            .values(date_insert=datetime.now() - timedelta(days=30))
+        )
+
+        result = app.test_cli_runner().invoke(user, ["purge", "--batch-size", "1"])
+        assert result.exit_code == 0, result.output
+
+        identifiants = db.session.scalars(sa.select(TempUser.identifiant)).all()
+        assert "old_temp_user" not in identifiants
+        assert "new_temp_user" in identifiants
@@ -9,6 +9,7 @@ from pypnusershub.db.models import (
     CorRoleToken,
     UserApplicationRight,
 )
+from pypnusershub.auth.reset_tokens import hash_token, issue_role_token
 from pypnusershub.auth.subscribe import (
     generate_token,
     create_cor_role_token,
@@ -21,7 +22,7 @@ from .fixtures import group_and_users, applications, profils
 
 
 def test_generate_token_random():
-    """Token should be a random 128-bit string"""
+    """Token should be a random string"""
     token1 = generate_token()
     token2 = generate_token()
     assert isinstance(token1, str)
@@ -82,7 +83,10 @@ def test_create_cor_role_token_success(group_and_users):
         sa.select(CorRoleToken).where(CorRoleToken.id_role == user.id_role)
     ).first()
     assert cor_token is not None
-    assert cor_token.token == result["token"]
+    # only the digest of the token is stored
+    assert cor_token.token == hash_token(result["token"])
+    assert cor_token.expires_at > datetime.now()
+    assert not cor_token.used
 
 
 # ===============================================================
@@ -203,20 +207,25 @@ def test_change_password_token_not_found(app):
 def test_change_password_success(app, group_and_users):
     """Valid case: updates password and deletes token"""
     user = group_and_users["user1"]
-    token = "tok123"
-
-    # Clean any existing tokens for this user to avoid duplicates
-    db.session.query(CorRoleToken).filter_by(id_role=user.id_role).delete()
-    db.session.flush()
-
-    db.session.add(CorRoleToken(id_role=user.id_role, token=token))
+    token = issue_role_token(user.id_role)
     db.session.flush()
 
     result = change_password(token, "newpw", "newpw")
     assert result["identifiant"] == user.identifiant
 
-    # Ensure CorRoleToken deleted
-    cors = db.session.scalars(
-        sa.select(CorRoleToken).where(CorRoleToken.token == token)
-    ).first()
-    assert cors is None
+    # Ensure CorRoleToken is flagged as used and can't be used twice
+    cor_token = db.session.scalars(
+        sa.select(CorRoleToken).where(CorRoleToken.token == hash_token(token))
+    ).one()
+    assert cor_token.used
+    with pytest.raises(ValueError, match="Pas d'id role associée"):
+        change_password(token, "otherpw", "otherpw")
+
+
+def test_change_password_expired_token(app, group_and_users):
+    user = group_and_users["user1"]
+    token = issue_role_token(user.id_role, expiration=-1)
+    db.session.flush()
+
+    with pytest.raises(ValueError, match="Pas d'id role associée"):
+        change_password(token, "newpw", "newpw")
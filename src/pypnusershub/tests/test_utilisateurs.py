@@ -3,14 +3,36 @@ from flask import url_for, session
 
 import pytest
 
-from pypnusershub.db.models import Organisme, User
+from pypnusershub.db.applications import (
+    get_application_id,
+    get_application_index,
+    invalidate_application_index,
+)
+from pypnusershub.db.listing import iter_roles, list_roles, search_roles
+from pypnusershub.db.models import (
+    Application,
+    Organisme,
+    User,
+    UserList,
+    UserListMember,
+    cor_roles_closure,
+)
+from pypnusershub.db.rights import (
+    get_max_level_profil,
+    get_rights_cache,
+    get_security_stamps,
+    max_levels,
+)
+from pypnusershub.env import db
 
 from pypnusershub.routes import insert_or_update_organism
 from pypnusershub.schemas import OrganismeSchema, UserSchema
 from pypnusershub.tests.fixtures import *
-from pypnusershub.tests.utils import set_logged_user
+from pypnusershub.tests.utils import count_relationship_loads, set_logged_user
+from pypnusershub.utils import get_current_app_id
 
 from sqlalchemy import select
+from sqlalchemy.orm.exc import NoResultFound
 
 from pypnusershub.auth.auth_manager import auth_manager, Authentication
 
@@ -134,6 +156,117 @@ class TestUtilisateurs:
         # the token expiration must be tz aware to avoid issue in date comparison
         assert datetime_expires.tzinfo is not None
 
+    def test_refresh_token(self, app, group_and_users, monkeypatch):
+        monkeypatch.setitem(app.config, "ACCESS_TOKEN_EXPIRATION", 300)
+        resp = self.client.post(
+            url_for("auth.login"), json={"login": "user_of_group1", "password": "admin"}
+        )
+        assert resp.status_code == 200
+        first_token = resp.json["refresh_token"]
+
+        # a short-lived access token is trusted without reading the database
+        resp = self.client.get(
+            url_for("auth.get_user_data"),
+            headers={"Authorization": f"Bearer {resp.json['token']}"},
+        )
+        assert resp.status_code == 200
+        assert resp.json["user"]["id_role"] == group_and_users["user1"].id_role
+
+        resp = self.client.post(
+            url_for("auth.refresh"), json={"refresh_token": first_token}
+        )
+        assert resp.status_code == 200
+        assert "token" in resp.json
+        second_token = resp.json["refresh_token"]
+        assert second_token != first_token
+
+        # a refresh token is used once, its reuse revokes the whole family
+        resp = self.client.post(
+            url_for("auth.refresh"), json={"refresh_token": first_token}
+        )
+        assert resp.status_code == 401
+        resp = self.client.post(
+            url_for("auth.refresh"), json={"refresh_token": second_token}
+        )
+        assert resp.status_code == 401
+
+    def test_logout_revokes_token(self, group_and_users):
+        resp = self.client.post(
+            url_for("auth.login"), json={"login": "user_of_group1", "password": "admin"}
+        )
+        headers = {"Authorization": f"Bearer {resp.json['token']}"}
+        resp = self.client.post(url_for("auth.logout"), headers=headers)
+        assert resp.status_code == 302
+        # the token is refused although it did not expire
+        resp = self.client.get(url_for("auth.get_user_data"), headers=headers)
+        assert resp.status_code == 401
+
+    def test_remember_cookie(self, app, group_and_users):
+        resp = self.client.post(
+            url_for("auth.login"), json={"login": "user_of_group1", "password": "admin"}
+        )
+        assert resp.status_code == 200
+        cookie = self.client.get_cookie(app.config["REMEMBER_COOKIE_NAME"]).value
+        # the user is built from the cookie alone, even without the session
+        self.client.delete_cookie("session")
+        resp = self.client.get(url_for("auth.get_user_data"))
+        assert resp.status_code == 200
+        assert resp.json["user"]["id_role"] == group_and_users["user1"].id_role
+
+        # a password change is only seen on revalidation
+        group_and_users["user1"].password = "changed"
+        db.session.flush()
+        assert self.client.get(url_for("auth.get_user_data")).status_code == 200
+        # as in a new session: the stamp bumped by the trigger is read again
+        db.session.expire(group_and_users["user1"])
+        app.config["REMEMBER_COOKIE_REVALIDATE_INTERVAL"] = 0
+        try:
+            resp = self.client.get(url_for("auth.get_user_data"))
+            assert resp.status_code == 401
+            self.client.set_cookie(app.config["REMEMBER_COOKIE_NAME"], cookie)
+            assert self.client.get(url_for("auth.get_user_data")).status_code == 401
+        finally:
+            del app.config["REMEMBER_COOKIE_REVALIDATE_INTERVAL"]
+
+    def test_security_stamp(self, app, group_and_users):
+        user1, group1 = group_and_users["user1"], group_and_users["group1"]
+        resp = self.client.post(
+            url_for("auth.login"), json={"login": "user_of_group1", "password": "admin"}
+        )
+        headers = {"Authorization": f"Bearer {resp.json['token']}"}
+        stamp = resp.json["user"]["security_stamp"]
+        group_stamp = group1.security_stamp
+        # the stamp of the user is bumped when their groups change
+        user1.groups.remove(group1)
+        db.session.flush()
+        assert get_security_stamps([user1.id_role, group1.id_role]) == {
+            user1.id_role: stamp + 1,
+            group1.id_role: group_stamp,
+        }
+        # and the tokens issued before are refused
+        self.client.delete_cookie("session")
+        self.client.delete_cookie(app.config["REMEMBER_COOKIE_NAME"])
+        resp = self.client.get(url_for("auth.get_user_data"), headers=headers)
+        assert resp.status_code == 401
+
+    def test_auth_routes_relationship_loads(self, group_and_users):
+        # providers are dumped, groups may be loaded with the users
+        # (USERSHUB_AUTH_LOADING_PROFILE=optimized)
+        max_loads = 2
+        with count_relationship_loads() as loads:
+            resp = self.client.post(
+                url_for("auth.login"),
+                json={"login": "user_of_group1", "password": "admin"},
+            )
+        assert resp.status_code == 200
+        assert len(loads) <= max_loads, loads
+
+        set_logged_user(self.client, group_and_users["user1"])
+        with count_relationship_loads() as loads:
+            resp = self.client.get(url_for("auth.get_user_data"))
+        assert resp.status_code == 200
+        assert len(loads) <= max_loads, loads
+
     def test_get_user_data(self, group_and_users):
         set_logged_user(self.client, group_and_users["user1"])
 
@@ -146,3 +279,312 @@ class TestUtilisateurs:
 
         assert "max_level_profil" in data["user"]
         assert "providers" in data["user"]
+
+    def test_get_roles(self, group_and_users):
+        set_logged_user(self.client, group_and_users["user1"])
+        ids, after = [], None
+        while True:
+            resp = self.client.get(
+                url_for(
+                    "auth.get_roles",
+                    application="APPLI_1",
+                    fields="id_role,identifiant",
+                    limit=1,
+                    **({"after": after} if after else {}),
+                )
+            )
+            assert resp.status_code == 200
+            assert len(resp.json["items"]) <= 1
+            ids += [item["id_role"] for item in resp.json["items"]]
+            after = resp.json["next"]
+            if after is None:
+                break
+        assert ids == sorted(
+            role.id_role
+            for role in (
+                group_and_users["group1"],
+                group_and_users["user1"],
+                group_and_users["user_no_group"],
+            )
+        )
+
+        resp = self.client.get(url_for("auth.get_roles", fields="password"))
+        assert resp.status_code == 400
+
+    def test_roles_access(self, app, group_and_users):
+        # user_no_group has a profile of 1 on the application
+        set_logged_user(self.client, group_and_users["user_no_group"])
+        assert self.client.get(url_for("auth.get_roles")).status_code == 200
+        for route in ("auth.get_roles", "auth.search_roles"):
+            resp = self.client.get(url_for(route, q="dup", fields="id_role,email"))
+            assert resp.status_code == 403
+        app.config["PUBLIC_ACCESS_USERNAME"] = "user2"
+        try:
+            assert self.client.get(url_for("auth.get_roles")).status_code == 403
+        finally:
+            del app.config["PUBLIC_ACCESS_USERNAME"]
+
+    def test_iter_roles(self, group_and_users):
+        group1 = group_and_users["group1"]
+        roles = list(iter_roles(["identifiant"], id_group=group1.id_role, batch_size=1))
+        assert roles == [{"identifiant": "user_of_group1"}]
+        assert list_roles(
+            ["id_role"], groupe=True, after=group1.id_role - 1, limit=1
+        ) == [{"id_role": group1.id_role}]
+
+    def test_search_roles(self, app, group_and_users):
+        user1 = group_and_users["user1"]
+        with db.session.begin_nested():
+            user1.nom_role, user1.prenom_role = "Dupont", "Hélène"
+            group_and_users["user_no_group"].nom_role = "Dupuis"
+        set_logged_user(self.client, user1)
+
+        resp = self.client.get(url_for("auth.search_roles", q="helene dup"))
+        assert resp.status_code == 200
+        assert resp.json["items"][0]["id_role"] == user1.id_role
+        # short texts only match the beginning of names
+        assert db.session.scalars(User.search("du")).all()[:2] == [
+            user1,
+            group_and_users["user_no_group"],
+        ]
+        # typo, found by similarity
+        assert user1 in db.session.scalars(User.search("dupomt")).all()
+        assert self.client.get(url_for("auth.search_roles")).status_code == 400
+
+        app.config["ROLES_SEARCH_PREFIX_INDEX"] = True
+        try:
+            assert search_roles("hele", ["id_role"], groupe=False) == [
+                {"id_role": user1.id_role}
+            ]
+        finally:
+            del app.config["ROLES_SEARCH_PREFIX_INDEX"]
+
+    def test_members_page(self, organism, group_and_users):
+        group1, user1 = group_and_users["group1"], group_and_users["user1"]
+        with db.session.begin_nested():
+            user2 = User(groupe=False, identifiant="user2_of_group1")
+            group1.members.append(user2)
+            db.session.add(user2)
+            user1.organisme = user2.organisme = organism
+        assert group1.members_count() == 2
+        assert group1.members_page(limit=1) == [user1]
+        assert group1.members_page(after=user1.id_role) == [user2]
+        assert organism.members_count() == 2
+        assert organism.members_page(after=user1.id_role, limit=10) == [user2]
+
+    def test_list_members(self, group_and_users):
+        group1, user1 = group_and_users["group1"], group_and_users["user1"]
+        user2 = group_and_users["user_no_group"]
+        with db.session.begin_nested():
+            liste = UserList(code_liste="LISTE_1", nom_liste="liste 1")
+            # user1 is a member by itself and through group1
+            liste.users += [group1, user1, user2]
+            db.session.add(liste)
+        assert [member.id_role for member in liste.members] == sorted(
+            [user1.id_role, user2.id_role]
+        )
+        member = db.session.scalars(
+            select(UserListMember).where(
+                UserListMember.id_menu == liste.id_liste,
+                UserListMember.id_role == user1.id_role,
+            )
+        ).one()
+        assert member.identifiant == "user_of_group1"
+        assert member.role == user1
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestApplicationIndex:
+    def test_resolve(self, applications):
+        app1, app2 = applications["app1"], applications["app2"]
+        index = get_application_index()
+        assert index.get_id("APPLI_1") == app1.id_application
+        assert index.get_code(app2.id_application) == "APPLI_2"
+        assert index.resolve(["APPLI_1", "APPLI_2", "UNKNOWN"]) == {
+            "APPLI_1": app1.id_application,
+            "APPLI_2": app2.id_application,
+        }
+        assert get_application_index() is index
+
+    def test_invalidation(self, app, applications):
+        index = get_application_index()
+        with db.session.begin_nested():
+            child = Application(
+                code_application="APPLI_CHILD",
+                nom_application="child",
+                id_parent=applications["app1"].id_application,
+            )
+            db.session.add(child)
+        assert get_application_index() is not index
+        assert get_application_id("APPLI_CHILD") == child.id_application
+        assert get_application_index().children(
+            applications["app1"].id_application
+        ) == [child.id_application]
+
+        with pytest.raises(NoResultFound):
+            get_application_id("UNKNOWN")
+
+    def test_ancestors(self, applications):
+        app1 = applications["app1"]
+        with db.session.begin_nested():
+            child = Application(
+                code_application="CHILD",
+                nom_application="child",
+                id_parent=app1.id_application,
+            )
+            db.session.add(child)
+        with db.session.begin_nested():
+            grandchild = Application(
+                code_application="GRANDCHILD",
+                nom_application="grandchild",
+                id_parent=child.id_application,
+            )
+            db.session.add(grandchild)
+        assert get_application_index().ancestors(grandchild.id_application) == [
+            grandchild.id_application,
+            child.id_application,
+            app1.id_application,
+        ]
+
+    def test_get_current_app_id(self, app, applications):
+        invalidate_application_index()
+        app.config["CODE_APPLICATION"] = "APPLI_2"
+        try:
+            assert get_current_app_id() == applications["app2"].id_application
+        finally:
+            app.config["CODE_APPLICATION"] = "APPLI_1"
+
+
+@pytest.mark.usefixtures("temporary_transaction")
+class TestRights:
+    def test_max_level_profil_inherited(self, app, applications, group_and_users):
+        app1 = applications["app1"]
+        user1 = group_and_users["user1"]
+        with db.session.begin_nested():
+            child = Application(
+                code_application="CHILD",
+                nom_application="child",
+                id_parent=app1.id_application,
+            )
+            db.session.add(child)
+        assert int(get_max_level_profil(user1.id_role, app1.id_application)) == 6
+        assert get_max_level_profil(user1.id_role, child.id_application) == 0
+        assert (
+            int(
+                get_max_level_profil(
+                    user1.id_role, child.id_application, inherited=True
+                )
+            )
+            == 6
+        )
+
+        app.config["APPLICATION_RIGHTS_INHERITANCE"] = True
+        app.config["CODE_APPLICATION"] = "CHILD"
+        try:
+            assert int(user1.max_level_profil) == 6
+        finally:
+            app.config["APPLICATION_RIGHTS_INHERITANCE"] = False
+            app.config["CODE_APPLICATION"] = "APPLI_1"
+
+    def test_filter_by_app(self, applications, group_and_users):
+        user1, user_no_group = (
+            group_and_users["user1"],
+            group_and_users["user_no_group"],
+        )
+        group1, group2 = group_and_users["group1"], group_and_users["group2"]
+        with db.session.begin_nested():
+            # no right of its own, only the right of its group
+            member = User(groupe=False, identifiant="member_of_group1")
+            member.groups.append(group1)
+            db.session.add(member)
+        for code, expected in (
+            # direct rights and right inherited through group1, not group2
+            ("APPLI_1", {user1, user_no_group, group1, member}),
+            # no right
+            ("APPLI_2", set()),
+        ):
+            # IN semi-join
+            by_in = set(
+                db.session.scalars(select(User).where(User.filter_by_app(code)))
+            )
+            # EXISTS semi-join
+            by_exists = set(User.query.filter_by_app(code).all())
+            assert by_in == by_exists == expected
+            assert group2 not in by_in
+
+    def test_max_levels(self, app, applications, group_and_users):
+        id_application = applications["app1"].id_application
+        user1, user_no_group = (
+            group_and_users["user1"],
+            group_and_users["user_no_group"],
+        )
+        group2 = group_and_users["group2"]
+        expected = {
+            user1.id_role: 6,
+            user_no_group.id_role: 1,
+            group2.id_role: 0,
+        }
+        levels = max_levels(expected.keys(), id_application)
+        assert {id_role: int(level) for id_role, level in levels.items()} == expected
+
+        app.config["RIGHTS_CACHE_TTL"] = 60
+        try:
+            assert max_levels(expected.keys(), id_application) == levels
+            assert len(get_rights_cache()) == 3
+            # cached levels are reused
+            assert max_levels([user1.id_role], id_application) == {
+                user1.id_role: levels[user1.id_role]
+            }
+            # and dropped when rights change
+            with db.session.begin_nested():
+                user1.groups.remove(group_and_users["group1"])
+            assert len(get_rights_cache()) == 0
+            assert int(max_levels([user1.id_role], id_application)[user1.id_role]) == 1
+        finally:
+            app.config.pop("RIGHTS_CACHE_TTL")
+
+    def test_nested_groups(self, applications, group_and_users):
+        group1, group2 = group_and_users["group1"], group_and_users["group2"]
+        with db.session.begin_nested():
+            nested_user = User(groupe=False, identifiant="user_of_group2")
+            nested_user.groups.append(group2)
+            group2.groups.append(group1)
+            db.session.add(nested_user)
+
+        depths = dict(
+            db.session.execute(
+                select(
+                    cor_roles_closure.c.id_role_ancestor, cor_roles_closure.c.depth
+                ).where(cor_roles_closure.c.id_role_descendant == nested_user.id_role)
+            ).all()
+        )
+        assert depths == {
+            nested_user.id_role: 0,
+            group2.id_role: 1,
+            group1.id_role: 2,
+        }
+        assert (
+            int(
+                get_max_level_profil(
+                    nested_user.id_role, applications["app1"].id_application
+                )
+            )
+            == 6
+        )
+        roles = db.session.scalars(
+            select(User).where(User.filter_by_app("APPLI_1"))
+        ).all()
+        assert nested_user in roles
+
+        with db.session.begin_nested():
+            group2.groups.remove(group1)
+        assert (
+            get_max_level_profil(
+                nested_user.id_role, applications["app1"].id_application
+            )
+            == 0
+        )
+        roles = db.session.scalars(
+            select(User).where(User.filter_by_app("APPLI_1"))
+        ).all()
+        assert nested_user not in roles
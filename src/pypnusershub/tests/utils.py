@@ -5,7 +5,7 @@ from werkzeug.http import dump_cookie
 from werkzeug.datastructures import Headers
 
 from flask_login import login_user, logout_user
-from sqlalchemy import select
+from sqlalchemy import event, select
 
 from pypnusershub.utils import get_current_app_id
 from pypnusershub.db.models import User
@@ -49,6 +49,30 @@ def logged_user(client, user):
 unset_logged_user_cookie = unset_logged_user
 
 
+@contextmanager
+def count_relationship_loads():
+    """
+    Record the queries loading relationships (lazy or eager) run in the block.
+
+    Usage:
+
+        with count_relationship_loads() as loads:
+            response = client.get(url)
+        assert len(loads) <= 1, loads
+    """
+    loads = []
+
+    def record(orm_execute_state):
+        if orm_execute_state.is_relationship_load:
+            loads.append(str(orm_execute_state.loader_strategy_path))
+
+    event.listen(db.session, "do_orm_execute", record)
+    try:
+        yield loads
+    finally:
+        event.remove(db.session, "do_orm_execute", record)
+
+
 def logged_user_headers(user, headers=None):
     user = db.session.execute(
         select(User).filter_by(
@@ -13,9 +13,6 @@ from typing import Optional
 from urllib.parse import urlsplit
 
 from flask import current_app, Response
-from sqlalchemy import select
-
-from pypnusershub.env import db
 
 
 class RessourceError(EnvironmentError):
@@ -79,13 +76,10 @@ def get_current_app_id():
     if "ID_APP" in current_app.config:
         return current_app.config["ID_APP"]
     elif "CODE_APPLICATION" in current_app.config:
-        from pypnusershub.db.models import Application
+        # resolved from the application index cached per app
+        from pypnusershub.db.applications import get_application_id
 
-        return db.session.execute(
-            select(Application.id_application).filter_by(
-                code_application=current_app.config["CODE_APPLICATION"],
-            )
-        ).scalar_one()
+        return get_application_id(current_app.config["CODE_APPLICATION"])
     else:
         return None
 